@@ -0,0 +1,116 @@
+import hashlib
+import json
+import threading
+import time
+
+from common_utils import get_env_key
+from vectorizer.cache.two_tier_cache import TwoTierCache
+
+COMPRESSION_CACHE_ENABLED = get_env_key('COMPRESSION_CACHE_ENABLED', 'true').lower() == 'true'
+# in-process LRU tier
+COMPRESSION_CACHE_MAX_ITEMS = int(get_env_key('COMPRESSION_CACHE_MAX_ITEMS', '1000'))
+# persistent SQLite tier
+COMPRESSION_CACHE_DB_PATH = get_env_key('COMPRESSION_CACHE_DB_PATH', 'compression_cache.sqlite3')
+COMPRESSION_CACHE_MAX_DB_ITEMS = int(get_env_key('COMPRESSION_CACHE_MAX_DB_ITEMS', '20000'))
+# entries older than this are treated as missing in both tiers
+COMPRESSION_CACHE_TTL_SECONDS = int(get_env_key('COMPRESSION_CACHE_TTL_SECONDS', str(7 * 24 * 60 * 60)))
+
+# run the size based eviction of the persistent tier once every N writes instead of on every write
+_DB_EVICTION_INTERVAL = 200
+
+
+def get_compression_cache_key(request: dict, model: str) -> str:
+    """
+    Hash of everything that decides the compressed prompt: the model, instruction, question, the context segments
+    in order and every compression parameter (target_token, rank_method, dynamic_context_compression_ratio, ...).
+    """
+    raw_key = json.dumps({"model": model, "request": request}, sort_keys=True, default=str)
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+
+def get_compression_ratio(compressed: dict) -> float:
+    """Original over compressed token count as reported by LLMLingua, 0 when it did not report both."""
+    origin_tokens, compressed_tokens = compressed.get("origin_tokens"), compressed.get("compressed_tokens")
+    if not origin_tokens or not compressed_tokens:
+        return 0.0
+    return origin_tokens / compressed_tokens
+
+
+class CompressedContextCache(TwoTierCache):
+    """
+    Two tier cache of LLMLingua compressions keyed by get_compression_cache_key, see TwoTierCache. The persistent
+    tier stores the compress_prompt result as JSON together with its compression ratio, the latency of the
+    compression and how often the entry was hit.
+    """
+
+    table = "compressions"
+    value_columns = ("compressed TEXT NOT NULL", "compression_ratio REAL NOT NULL", "latency_ms REAL NOT NULL",
+                     "hits INTEGER NOT NULL DEFAULT 0")
+    counts_hits = True
+    description = "compression cache"
+
+    def __init__(self, db_path: str = COMPRESSION_CACHE_DB_PATH,
+                 max_items: int = COMPRESSION_CACHE_MAX_ITEMS,
+                 max_db_items: int = COMPRESSION_CACHE_MAX_DB_ITEMS,
+                 ttl_seconds: int = COMPRESSION_CACHE_TTL_SECONDS):
+        super().__init__(db_path=db_path, max_items=max_items, max_db_items=max_db_items, ttl_seconds=ttl_seconds,
+                         eviction_interval=_DB_EVICTION_INTERVAL)
+        self.latency_saved_ms = 0.0
+        self._compression_ratio_sum = 0.0
+        self._compressions = 0
+
+    # entries are (created_at, compressed, compression_ratio, latency_ms)
+
+    def _encode(self, entry: tuple) -> tuple:
+        return json.dumps(entry[1]), entry[2], entry[3]
+
+    def _decode(self, row: tuple, created_at: float) -> tuple:
+        compressed, compression_ratio, latency_ms = row
+        return created_at, json.loads(compressed), compression_ratio, latency_ms
+
+    def _on_hit(self, entry: tuple):
+        self.latency_saved_ms += entry[3]
+
+    def get(self, key: str):
+        entry = self.get_entry(key)
+        return entry[1] if entry is not None else None
+
+    def set(self, key: str, compressed: dict, latency_ms: float):
+        """latency_ms: what the compression cost, counted as saved on every hit."""
+        compression_ratio = get_compression_ratio(compressed)
+        with self._lock:
+            self._compression_ratio_sum += compression_ratio
+            self._compressions += 1
+        self.put_entry(key, (time.time(), compressed, compression_ratio, latency_ms))
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        with self._lock:
+            stats.update({
+                "latency_saved_ms": self.latency_saved_ms,
+                # over the compressions this process ran
+                "average_compression_ratio": self._compression_ratio_sum / self._compressions
+                if self._compressions else 0.0,
+            })
+        return stats
+
+
+_compressed_context_cache = None
+_compressed_context_cache_lock = threading.Lock()
+
+
+def get_compressed_context_cache():
+    """Returns the process wide compression cache, or None when caching is disabled."""
+    global _compressed_context_cache
+    if not COMPRESSION_CACHE_ENABLED:
+        return None
+    if _compressed_context_cache is None:
+        with _compressed_context_cache_lock:
+            if _compressed_context_cache is None:
+                _compressed_context_cache = CompressedContextCache()
+    return _compressed_context_cache
+
+
+def get_compressed_context_cache_stats() -> dict:
+    cache = get_compressed_context_cache()
+    return cache.stats() if cache is not None else {}
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from common_utils import get_env_key
+from memory.mongo_db.service.collection_generation_service import get_collection_generation
+
+SEMANTIC_CACHE_ENABLED = get_env_key('SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true'
+# a query is answered from the cache when its cosine distance to a cached query is at most this
+SEMANTIC_CACHE_MAX_DISTANCE = float(get_env_key('SEMANTIC_CACHE_MAX_DISTANCE', '0.05'))
+SEMANTIC_CACHE_MAX_ITEMS = int(get_env_key('SEMANTIC_CACHE_MAX_ITEMS', '1000'))
+SEMANTIC_CACHE_TTL_SECONDS = int(get_env_key('SEMANTIC_CACHE_TTL_SECONDS', str(60 * 60)))
+
+
+def get_semantic_cache_scope(db_name: str, collection_name: str, variant: str, filters=None) -> tuple:
+    """
+    Answers are only shared between queries on the same collection, pipeline variant and filters, and only while
+    the collection's generation is unchanged: answers cached before an ingestion in another process are not reached.
+    """
+    filters_hash = hashlib.sha256(json.dumps(filters, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return db_name, collection_name, variant, filters_hash, get_collection_generation(db_name, collection_name)
+
+
+class _Scope:
+    """Cached answers of one scope; their query vectors are kept stacked for a single matrix-vector lookup."""
+
+    def __init__(self):
+        self.entries = OrderedDict()  # entry id -> (query vector, answer, created_at, latency_ms)
+        self._matrix = None
+        self._ids = []
+
+    def changed(self):
+        self._matrix = None
+
+    def matrix(self):
+        if self._matrix is None:
+            self._ids = list(self.entries.keys())
+            self._matrix = np.stack([self.entries[i][0] for i in self._ids]) if self._ids else None
+        return self._ids, self._matrix
+
+
+class SemanticAnswerCache:
+    """
+    In-process cache of RAG answers keyed by query embedding.
+
+    A lookup returns the answer of the most similar cached query of the same scope if it is within max_distance
+    (cosine distance). Entries are evicted by LRU over all scopes and by TTL, and a collection's entries are dropped
+    when ingestion in this process changes it; the scope's generation hides them from the other processes.
+    """
+
+    def __init__(self, max_distance: float = SEMANTIC_CACHE_MAX_DISTANCE,
+                 max_items: int = SEMANTIC_CACHE_MAX_ITEMS,
+                 ttl_seconds: int = SEMANTIC_CACHE_TTL_SECONDS):
+        self.max_distance = max_distance
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+
+        self._scopes = {}
+        self._lru = OrderedDict()  # entry id -> scope
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.latency_saved_ms = 0.0
+
+    @staticmethod
+    def _normalise(query_vector) -> np.ndarray:
+        vector = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id: int, scope: tuple):
+        self._lru.pop(entry_id, None)
+        entries = self._scopes.get(scope)
+        if entries is not None:
+            entries.entries.pop(entry_id, None)
+            entries.changed()
+            if not entries.entries:
+                del self._scopes[scope]
+
+    def get(self, query_vector, scope: tuple):
+        vector = self._normalise(query_vector)
+        now = time.time()
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if entries is not None:
+                ids, matrix = entries.matrix()
+                similarities = matrix @ vector
+                for position in np.argsort(-similarities).tolist():
+                    if 1 - similarities[position] > self.max_distance:
+                        break
+                    entry_id = ids[position]
+                    _, answer, created_at, latency_ms = entries.entries[entry_id]
+                    if self.ttl_seconds > 0 and now - created_at > self.ttl_seconds:
+                        self._remove(entry_id, scope)
+                        self.evictions += 1
+                        continue
+                    self._lru.move_to_end(entry_id)
+                    self.hits += 1
+                    self.latency_saved_ms += latency_ms
+                    return answer
+            self.misses += 1
+            return None
+
+    def set(self, query_vector, scope: tuple, answer: str, latency_ms: float):
+        """latency_ms: what producing the answer cost, counted as saved on every hit."""
+        vector = self._normalise(query_vector)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._scopes.setdefault(scope, _Scope()).entries[entry_id] = (vector, answer, time.time(), latency_ms)
+            self._scopes[scope].changed()
+            self._lru[entry_id] = scope
+            while len(self._lru) > self.max_items:
+                oldest_id, oldest_scope = next(iter(self._lru.items()))
+                self._remove(oldest_id, oldest_scope)
+                self.evictions += 1
+
+    def invalidate(self, db_name: str, collection_name: str):
+        """Drops the answers based on a collection, e.g. after ingestion changed it."""
+        with self._lock:
+            for scope in [s for s in self._scopes if s[:2] == (db_name, collection_name)]:
+                for entry_id in list(self._scopes[scope].entries):
+                    self._remove(entry_id, scope)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._scopes = {}
+            self._lru.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "items": len(self._lru),
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "latency_saved_ms": self.latency_saved_ms,
+            }
+
+
+_semantic_answer_cache = None
+_semantic_answer_cache_lock = threading.Lock()
+
+
+def get_semantic_answer_cache():
+    """Returns the process wide semantic answer cache, or None when it is disabled."""
+    global _semantic_answer_cache
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    if _semantic_answer_cache is None:
+        with _semantic_answer_cache_lock:
+            if _semantic_answer_cache is None:
+                _semantic_answer_cache = SemanticAnswerCache()
+    return _semantic_answer_cache
+
+
+def get_semantic_answer_cache_stats() -> dict:
+    cache = get_semantic_answer_cache()
+    return cache.stats() if cache is not None else {}
+
+
+def invalidate_semantic_answer_cache(db_name: str, collection_name: str):
+    cache = get_semantic_answer_cache()
+    if cache is not None:
+        cache.invalidate(db_name, collection_name)
@@ -0,0 +1,146 @@
+"""
+LLMLingua prompt compression on a bounded worker pool.
+
+The LLMLingua-2 model is loaded on the first compression, not at import, so processes that never compress do not pay
+for it. Compressions run on LLMLINGUA_WORKERS threads that share the one model; PromptCompressor.compress_prompt
+takes one prompt per call, so each request is compressed on its own as soon as a worker is free. At most
+LLMLINGUA_MAX_QUEUE_SIZE requests wait for a worker; when that many are waiting, callers wait up to
+LLMLINGUA_QUEUE_TIMEOUT_SECONDS for room and then get CompressionQueueFull.
+
+Compressions are memoized in the compressed context cache, a repeated request is answered without queueing, and
+identical requests in flight at the same time share one compression.
+"""
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common_utils import get_env_key
+from llm.cache.compressed_context_cache import get_compressed_context_cache, get_compression_cache_key
+
+LLMLINGUA_MODEL_NAME = get_env_key('LLMLINGUA_MODEL_NAME',
+                                   'microsoft/llmlingua-2-bert-base-multilingual-cased-meetingbank')
+LLMLINGUA_DEVICE_MAP = get_env_key('LLMLINGUA_DEVICE_MAP', 'cpu')
+LLMLINGUA_WORKERS = int(get_env_key('LLMLINGUA_WORKERS', '1'))
+LLMLINGUA_MAX_QUEUE_SIZE = int(get_env_key('LLMLINGUA_MAX_QUEUE_SIZE', '32'))
+LLMLINGUA_QUEUE_TIMEOUT_SECONDS = float(get_env_key('LLMLINGUA_QUEUE_TIMEOUT_SECONDS', '5'))
+# how long a caller waits for its compressed prompt once it is queued
+LLMLINGUA_COMPRESSION_TIMEOUT_SECONDS = float(get_env_key('LLMLINGUA_COMPRESSION_TIMEOUT_SECONDS', '60'))
+
+_prompt_compressor = None
+_prompt_compressor_lock = threading.Lock()
+_compression_executor = ThreadPoolExecutor(max_workers=LLMLINGUA_WORKERS, thread_name_prefix="llmlingua-compressor")
+# one slot per running or waiting compression
+_compression_slots = threading.BoundedSemaphore(LLMLINGUA_WORKERS + LLMLINGUA_MAX_QUEUE_SIZE)
+# request key -> Future of the compression running for it
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+class CompressionQueueFull(Exception):
+    """The compression queue stayed full for LLMLINGUA_QUEUE_TIMEOUT_SECONDS."""
+
+
+def get_prompt_compressor():
+    global _prompt_compressor
+    if _prompt_compressor is None:
+        with _prompt_compressor_lock:
+            if _prompt_compressor is None:
+                from llmlingua import PromptCompressor
+                started_at = time.perf_counter()
+                _prompt_compressor = PromptCompressor(
+                    model_name=LLMLINGUA_MODEL_NAME,
+                    model_config={"revision": "main"},
+                    use_llmlingua2=True,
+                    device_map=LLMLINGUA_DEVICE_MAP,
+                )
+                print(f"Loaded {LLMLINGUA_MODEL_NAME} in {time.perf_counter() - started_at:.1f}s")
+    return _prompt_compressor
+
+
+def get_compression_request(context: list, instruction: str, question: str, **options) -> dict:
+    """Arguments of one PromptCompressor.compress_prompt call; options are passed through unchanged."""
+    return {"context": list(context), "instruction": instruction, "question": question, **options}
+
+
+def _request_key(request: dict) -> str:
+    return json.dumps(request, sort_keys=True, default=str)
+
+
+def _compress(request: dict) -> dict:
+    compressor = get_prompt_compressor()
+    started_at = time.perf_counter()
+    compressed = compressor.compress_prompt(**request)
+    cache = get_compressed_context_cache()
+    if cache is not None:
+        cache.set(get_compression_cache_key(request, model=LLMLINGUA_MODEL_NAME), compressed,
+                  latency_ms=(time.perf_counter() - started_at) * 1000)
+    return compressed
+
+
+def _submit(request: dict, acquire_slot):
+    """
+    Future of the compression of the request, joining an identical one in flight. acquire_slot() takes a slot of
+    the queue and returns False when there is none.
+    """
+    key = _request_key(request)
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+    if future is not None:
+        return future
+    if not acquire_slot():
+        raise CompressionQueueFull(f"{LLMLINGUA_MAX_QUEUE_SIZE} compressions are already queued")
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        if future is not None:
+            _compression_slots.release()
+            return future
+        future = _compression_executor.submit(_compress, request)
+        _in_flight[key] = future
+
+    def done(_):
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
+        _compression_slots.release()
+
+    future.add_done_callback(done)
+    return future
+
+
+def _get_cached(request: dict):
+    cache = get_compressed_context_cache()
+    if cache is None:
+        return None
+    return cache.get(get_compression_cache_key(request, model=LLMLINGUA_MODEL_NAME))
+
+
+def compress_prompt(request: dict, timeout: float = LLMLINGUA_COMPRESSION_TIMEOUT_SECONDS) -> dict:
+    """
+    Compresses a request of get_compression_request on the pool; blocks while the queue is full. Raises
+    CompressionQueueFull, TimeoutError after `timeout` seconds, or the exception of the model.
+    """
+    compressed = _get_cached(request)
+    if compressed is not None:
+        return compressed
+    future = _submit(request, lambda: _compression_slots.acquire(timeout=LLMLINGUA_QUEUE_TIMEOUT_SECONDS))
+    return future.result(timeout=timeout)
+
+
+async def compress_prompt_async(request: dict, timeout: float = LLMLINGUA_COMPRESSION_TIMEOUT_SECONDS) -> dict:
+    """Coroutine version of compress_prompt; waits for room in the queue without blocking the event loop."""
+    compressed = _get_cached(request)
+    if compressed is not None:
+        return compressed
+    deadline = time.monotonic() + LLMLINGUA_QUEUE_TIMEOUT_SECONDS
+    delay = 0.005
+    while True:
+        try:
+            future = _submit(request, lambda: _compression_slots.acquire(blocking=False))
+            break
+        except CompressionQueueFull:
+            if time.monotonic() >= deadline:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+    return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout)
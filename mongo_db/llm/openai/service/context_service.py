@@ -0,0 +1,155 @@
+"""
+Compact LLM context from vector search results.
+
+Every listing becomes one line of "field: value" pairs in the field order of its result model, e.g.
+    [1] name: Ribeira Charming Duplex | accommodates: 8 | address: Porto, Porto, Portugal | summary: ...
+Empty values, excluded fields and longer text already given earlier in the same listing are left out (numbers and
+other short values are always kept), and a listing that renders the same as an earlier one is skipped. Nested
+values drop repeated atomic parts (address components, amenities); free text such as review comments is kept as
+written. Listings are
+added in rank order until LLM_CONTEXT_TOKEN_BUDGET tokens of the LLM's tokenizer are used; the listing that crosses
+the budget is cut to fit.
+"""
+import re
+
+from pydantic import BaseModel
+
+from common_utils import get_env_key
+from llm.openai.service.llm_service import LLM_MODEL
+
+try:
+    import tiktoken
+except ImportError:  # token counts fall back to a character based estimate
+    tiktoken = None
+
+LLM_CONTEXT_TOKEN_BUDGET = int(get_env_key('LLM_CONTEXT_TOKEN_BUDGET', '2000'))
+# fields left out at any nesting level, e.g. coordinates mean nothing to the LLM
+LLM_CONTEXT_EXCLUDED_FIELDS = frozenset(
+    f for f in get_env_key('LLM_CONTEXT_EXCLUDED_FIELDS', 'location').split(",") if f)
+# a listing cut to less than this many tokens is left out instead
+LLM_CONTEXT_MIN_LISTING_TOKENS = 32
+# only text at least this long is dropped as repeated; short values such as counts recur by chance
+LLM_CONTEXT_DEDUPE_MIN_CHARS = 20
+# comma separated parts up to this long, in text without sentences, are atomic values that may be deduplicated
+LLM_CONTEXT_ATOMIC_MAX_CHARS = 40
+_SENTENCE_END = re.compile(r"[.!?;:](\s|$)")
+
+FIELD_SEPARATOR = " | "
+
+_tokenizers = {}
+
+
+def _get_tokenizer(model: str):
+    if model not in _tokenizers:
+        try:
+            _tokenizers[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _tokenizers[model] = tiktoken.get_encoding("cl100k_base")
+    return _tokenizers[model]
+
+
+def count_llm_tokens(text: str, model: str = LLM_MODEL) -> int:
+    if tiktoken is None:
+        return len(text) // 4 + 1
+    return len(_get_tokenizer(model).encode(text, disallowed_special=()))
+
+
+def truncate_to_llm_tokens(text: str, max_tokens: int, model: str = LLM_MODEL) -> str:
+    if tiktoken is None:
+        return text[:max_tokens * 4]
+    tokenizer = _get_tokenizer(model)
+    return tokenizer.decode(tokenizer.encode(text, disallowed_special=())[:max_tokens])
+
+
+def _normalise(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+
+def format_value(value, excluded_fields=LLM_CONTEXT_EXCLUDED_FIELDS) -> str:
+    """Text of a field value; nested documents are reduced to their values, e.g. an address to its parts."""
+    if value is None or isinstance(value, bool):
+        # flags read as noise without their field name
+        return ""
+    if isinstance(value, float):
+        return f"{value:.2f}".rstrip("0").rstrip(".")
+    if isinstance(value, dict):
+        return _join_unique((format_value(v, excluded_fields) for k, v in value.items() if k not in excluded_fields),
+                            split=True)
+    if isinstance(value, (list, tuple)):
+        return _join_unique(format_value(v, excluded_fields) for v in value)
+    return " ".join(str(value).split())
+
+
+def _is_atomic(text: str) -> bool:
+    """Whether the text is a list of short values, e.g. "Porto, Porto, Portugal", rather than prose."""
+    return not _SENTENCE_END.search(text) and all(len(part) <= LLM_CONTEXT_ATOMIC_MAX_CHARS
+                                                  for part in text.split(", "))
+
+
+def _join_unique(texts, split: bool = False) -> str:
+    """
+    Joins with ", " keeping the first of repeated atomic values, e.g. amenities; with split the values of a
+    document are split into their parts first, e.g. street "Porto, Porto, Portugal" and market "Porto". Free text
+    is neither split nor deduplicated.
+    """
+    parts = {}
+    for position, text in enumerate(texts):
+        if not text:
+            continue
+        if not _is_atomic(text):
+            # keyed by position, so repeated prose stays
+            parts[position] = text
+            continue
+        for part in text.split(", ") if split else [text]:
+            if part:
+                parts.setdefault(part.lower(), part)
+    return ", ".join(parts.values())
+
+
+def format_listing(listing, excluded_fields=LLM_CONTEXT_EXCLUDED_FIELDS) -> str:
+    """One line of "field: value" pairs; empty fields and longer text repeated from earlier fields are dropped."""
+    if isinstance(listing, BaseModel):
+        listing = listing.model_dump()
+    parts = []
+    seen = []  # normalised text of the longer fields already written
+    for field, value in listing.items():
+        if field in excluded_fields:
+            continue
+        text = format_value(value, excluded_fields)
+        normalised = _normalise(text)
+        if not normalised:
+            continue
+        if len(normalised) >= LLM_CONTEXT_DEDUPE_MIN_CHARS:
+            if any(normalised in s for s in seen):
+                continue
+            # e.g. descriptions that start with the summary
+            repeated = next((s for s in seen if normalised.startswith(s)), None)
+            if repeated is not None:
+                text = text[len(repeated):].lstrip(" .,;")
+            seen.append(normalised)
+        parts.append(f"{field}: {text}")
+    return FIELD_SEPARATOR.join(parts)
+
+
+def build_context(search_results: list, model: str = LLM_MODEL, token_budget: int = LLM_CONTEXT_TOKEN_BUDGET,
+                  excluded_fields=LLM_CONTEXT_EXCLUDED_FIELDS) -> str:
+    """Context of the search results (dicts or result models) in rank order, within token_budget tokens."""
+    lines = []
+    seen = set()
+    used_tokens = 0
+    for listing in search_results:
+        text = format_listing(listing, excluded_fields)
+        if not text or _normalise(text) in seen:
+            continue
+        seen.add(_normalise(text))
+        line = f"[{len(lines) + 1}] {text}"
+        # +1 for the newline between listings
+        tokens = count_llm_tokens(line, model) + 1
+        if used_tokens + tokens > token_budget:
+            remaining = token_budget - used_tokens - 1
+            if remaining >= LLM_CONTEXT_MIN_LISTING_TOKENS:
+                lines.append(truncate_to_llm_tokens(line, remaining, model))
+            break
+        lines.append(line)
+        used_tokens += tokens
+    return "\n".join(lines)
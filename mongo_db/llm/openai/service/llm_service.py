@@ -1,33 +1,34 @@
 from pprint import pprint
 import openai
 import json
-from llmlingua import PromptCompressor
 from common_utils import get_env_key
+from llm.llmlingua.service.compression_service import get_compression_request, compress_prompt, \
+    compress_prompt_async, CompressionQueueFull
+from vectorizer.openai.service.openai_service import get_async_openai_client
 
 OPENAI_API_KEY = get_env_key('OPENAI_API_KEY')
 openai.api_key = OPENAI_API_KEY
 
-llm_lingua = PromptCompressor(
-    model_name="microsoft/llmlingua-2-bert-base-multilingual-cased-meetingbank",
-    model_config={"revision": "main"},
-    use_llmlingua2=True,
-    device_map="cpu",  # run on CPU
-)
+LLM_MODEL = "gpt-3.5-turbo"
+
+
+def get_llm_messages(query: str, context: str) -> list:
+    return [
+        {
+            "role": "system",
+            "content": "You are a airbnb listing recommendation system."},
+        {
+            "role": "user",
+            "content": f"Answer this user query: {query} with the following context:\n{context}"
+        }
+    ]
 
 
 def generate_llm_response(query: str, context: str):
     """Generate system response using OpenAI's completion"""
     completion = openai.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a airbnb listing recommendation system."},
-            {
-                "role": "user",
-                "content": f"Answer this user query: {query} with the following context:\n{context}"
-            }
-        ]
+        model=LLM_MODEL,
+        messages=get_llm_messages(query=query, context=context)
     )
 
     system_response = completion.choices[0].message.content
@@ -40,16 +41,24 @@ def generate_llm_response(query: str, context: str):
     return system_response
 
 
-def compress_query_prompt(query: str):
-    demonstration_str = query['demonstration_str']
-    instruction = query['instruction']
-    question = query['question']
+async def stream_llm_response_async(query: str, context: str):
+    """Async generator of the response tokens as the completion streams in."""
+    stream = await get_async_openai_client().chat.completions.create(
+        model=LLM_MODEL,
+        messages=get_llm_messages(query=query, context=context),
+        stream=True,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
 
+def get_query_compression_request(query: dict) -> dict:
     # 6x Compression
-    compressed_prompt = llm_lingua.compress_prompt(
-        demonstration_str.split("\n"),
-        instruction=instruction,
-        question=question,
+    return get_compression_request(
+        query['demonstration_str'].split("\n"),
+        instruction=query['instruction'],
+        question=query['question'],
         target_token=500,
         rank_method="longllmlingua",
         context_budget="+100",
@@ -57,19 +66,38 @@ def compress_query_prompt(query: str):
         reorder_context="sort",
     )
 
+
+def compress_query_prompt(query: dict):
+    """Compresses on the LLMLingua worker pool, the model is loaded there on first use."""
+    compressed_prompt = compress_prompt(get_query_compression_request(query))
     return json.dumps(compressed_prompt, indent=4)
 
 
-def get_compressed_context_for_query(query: str, context: str):
-    # Prepare information for compression
-    query_info = {
+async def compress_query_prompt_async(query: dict):
+    compressed_prompt = await compress_prompt_async(get_query_compression_request(query))
+    return json.dumps(compressed_prompt, indent=4)
+
+
+def get_query_info(query: str, context: str) -> dict:
+    return {
         'demonstration_str': context,  # Results from information retrieval process
         'instruction': "Write a high-quality answer for the given question using only the provided search results.",
         'question': query  # User query
     }
 
+
+def get_compressed_context_for_query(query: str, context: str):
     # Compress the query prompt using predefined function
-    compressed_prompt = compress_query_prompt(query_info)
+    try:
+        compressed_prompt = compress_query_prompt(get_query_info(query, context))
+    except CompressionQueueFull as e:
+        # shed the compression rather than the request, the LLM gets the full context
+        print(f"Skipping compression: {e}")
+        return context
+    except Exception as e:
+        # timed out waiting for the pool (TimeoutError) or the model failed, the LLM gets the full context too
+        print(f"Compression failed, using the full context: {e!r}")
+        return context
 
     # Optional: Print compressed prompts for debugging
     print("Compressed Prompt:\n")
@@ -77,3 +105,14 @@ def get_compressed_context_for_query(query: str, context: str):
     print("\n" + "=" * 80 + "\n")
 
     return compressed_prompt
+
+
+async def get_compressed_context_for_query_async(query: str, context: str):
+    try:
+        return await compress_query_prompt_async(get_query_info(query, context))
+    except CompressionQueueFull as e:
+        print(f"Skipping compression: {e}")
+        return context
+    except Exception as e:
+        print(f"Compression failed, using the full context: {e!r}")
+        return context
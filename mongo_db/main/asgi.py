@@ -10,21 +10,28 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-from main.routing import websocket_urlpatterns  # Import your routing file
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "main.settings")
 
 # default
 # application = get_asgi_application()
 
+# set up Django before importing the consumers, they import the apps' services
+django_asgi_application = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+from channels.auth import AuthMiddlewareStack  # noqa: E402
+from channels.security.websocket import AllowedHostsOriginValidator  # noqa: E402
+from main.routing import websocket_urlpatterns  # noqa: E402 Import your routing file
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
-        URLRouter(
-            websocket_urlpatterns  # Define websocket URL patterns or websocket routes in your app
+    "http": django_asgi_application,
+    # reject websocket handshakes from origins that are not in ALLOWED_HOSTS
+    "websocket": AllowedHostsOriginValidator(
+        AuthMiddlewareStack(
+            URLRouter(
+                websocket_urlpatterns  # Define websocket URL patterns or websocket routes in your app
+            )
         )
     ),
 })
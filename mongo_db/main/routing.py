@@ -0,0 +1,7 @@
+from django.urls import path
+
+from memory.consumers import RAGStreamConsumer
+
+websocket_urlpatterns = [
+    path('ws/rag', RAGStreamConsumer.as_asgi()),
+]
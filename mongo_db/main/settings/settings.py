@@ -45,6 +45,8 @@ DEBUG = False
 # Application definition
 
 INSTALLED_APPS = [
+    # ASGI server for runserver, serves the Channels websocket routes
+    "daphne",
     "django.contrib.admin",
     "django.contrib.auth",
     "django.contrib.contenttypes",
@@ -0,0 +1,112 @@
+import asyncio
+
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from llm.openai.service.llm_service import stream_llm_response_async, get_compressed_context_for_query_async
+from llm.openai.service.context_service import build_context
+from memory.mongo_db.service.mongo_service import get_vector_search_result_for_query_async, check_mmr
+from memory.mongo_db.vector_search.hybrid_search import check_search_mode
+from memory.mongo_db.vector_search.mmr import MMR_LAMBDA
+from memory.mongo_db.service.mongo_sample_data_service import get_db_and_collection_for_sample_data, \
+    get_vector_search_index_name_for_sample_data, get_vector_embedding_field_name_for_sample_data, \
+    get_text_search_index_name_for_sample_data, \
+    get_post_filter_stage_for_sample_data, get_query_pre_filters_for_sample_data, ListingSearchResultItem1, \
+    ListingSearchResultItem2, get_vector_index_filter_fields_for_sample_data
+
+
+def get_rag_variant(variant: str) -> dict:
+    """Search settings of the RAG mutations that can be streamed, by name."""
+    if variant == "pre_filter":
+        return {"result_model": ListingSearchResultItem2, "filters": get_query_pre_filters_for_sample_data()}
+    if variant == "post_filter":
+        return {"result_model": ListingSearchResultItem2,
+                "additional_stages": [get_post_filter_stage_for_sample_data()],
+                "filter_fields": get_vector_index_filter_fields_for_sample_data()}
+    if variant == "compressed":
+        return {"result_model": ListingSearchResultItem2,
+                "additional_stages": [get_post_filter_stage_for_sample_data()],
+                "filter_fields": get_vector_index_filter_fields_for_sample_data(), "compress": True}
+    if variant == "default":
+        return {"result_model": ListingSearchResultItem1}
+    raise ValueError(f"Unknown RAG variant '{variant}'")
+
+
+class RAGStreamConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Streaming RAG over a websocket (ws/rag).
+
+    The client sends {"query": "...", "variant": "default" | "pre_filter" | "post_filter" | "compressed",
+    "search_mode": "vector" | "hybrid", "mmr_k": ..., "mmr_lambda": ...} (all but the query optional) and receives
+        {"type": "results", "results": [...]}       as soon as the search finished
+        {"type": "token", "content": "..."}          for every piece of the answer as the LLM streams it
+        {"type": "done"}                             when the answer is complete
+        {"type": "error", "message": "..."}
+    A new query cancels the one still streaming on the same connection. Every session is a coroutine on the
+    worker's event loop, so one worker serves many concurrent sessions.
+    """
+
+    async def connect(self):
+        self.rag_task = None
+        await self.accept()
+
+    async def disconnect(self, code):
+        if self.rag_task is not None:
+            self.rag_task.cancel()
+
+    async def receive_json(self, content, **kwargs):
+        query = content.get("query")
+        if not query or not isinstance(query, str):
+            await self.send_json({"type": "error", "message": "A query is required"})
+            return
+        try:
+            variant = get_rag_variant(content.get("variant", "default"))
+            search_mode = content.get("search_mode", "vector")
+            check_search_mode(search_mode)
+            mmr = {"mmr_k": content.get("mmr_k"), "mmr_lambda": content.get("mmr_lambda", MMR_LAMBDA)}
+            check_mmr(search_mode, **mmr)
+        except ValueError as e:
+            await self.send_json({"type": "error", "message": str(e)})
+            return
+
+        if self.rag_task is not None:
+            self.rag_task.cancel()
+        self.rag_task = asyncio.create_task(self.stream_rag_answer(query=query, search_mode=search_mode, **mmr,
+                                                                   **variant))
+
+    async def stream_rag_answer(self, query: str, result_model, search_mode: str = "vector", mmr_k: int = None,
+                                mmr_lambda: float = MMR_LAMBDA, filters: dict = {}, additional_stages: list = [],
+                                filter_fields: tuple = (), compress: bool = False):
+        db_name, collection_name = get_db_and_collection_for_sample_data()
+        try:
+            results = await get_vector_search_result_for_query_async(
+                query=query,
+                db_name=db_name,
+                collection_name=collection_name,
+                vector_search_index_name=get_vector_search_index_name_for_sample_data(),
+                vector_embedding_field_name=get_vector_embedding_field_name_for_sample_data(),
+                additional_stages=additional_stages,
+                filters=filters,
+                filter_fields=filter_fields,
+                result_model=result_model,
+                search_mode=search_mode,
+                mmr_k=mmr_k,
+                mmr_lambda=mmr_lambda,
+                text_search_index_name=get_text_search_index_name_for_sample_data())
+            search_results = [result_model(**result).model_dump(mode="json") for result in results]
+            await self.send_json({"type": "results", "results": search_results})
+            if not search_results:
+                await self.send_json({"type": "done"})
+                return
+
+            context = build_context(search_results)
+            if compress:
+                # runs on the LLMLingua worker pool, the event loop keeps serving other sessions meanwhile
+                context = await get_compressed_context_for_query_async(query=query, context=context)
+            async for token in stream_llm_response_async(query=query, context=context):
+                await self.send_json({"type": "token", "content": token})
+            await self.send_json({"type": "done"})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error in stream_rag_answer: {e}")
+            await self.send_json({"type": "error", "message": "Failed to answer the query"})
@@ -0,0 +1,86 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from memory.mongo_db.service.mongo_sample_data_service import DATABASE_NAME, COLLECTION_NAME, SAMPLE_DATA_LIMIT, \
+    get_vector_search_index_name_for_sample_data, get_vector_embedding_field_name_for_sample_data, \
+    get_query_pre_filters_for_sample_data
+from memory.mongo_db.vector_search.benchmark import BENCHMARK_BACKENDS, BENCHMARK_DATA_SOURCES, \
+    load_benchmark_documents, load_queries, generate_queries, save_queries, run_benchmark, GroundTruth
+from memory.mongo_db.vector_search.local_vector_search import VECTOR_SEARCH_LOCAL_INDEX
+
+
+def parse_num_candidates(value: str):
+    return value if value == "exact" else int(value)
+
+
+class Command(BaseCommand):
+    help = "Measures recall@k, latency percentiles and throughput of vector search for each backend and " \
+           "parameter combination against an exact brute force ground truth, and writes the results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--backend", nargs="+", choices=BENCHMARK_BACKENDS, default=["local"])
+        parser.add_argument("--index-type", nargs="+", choices=("exact", "hnsw", "ivfpq"),
+                            default=[VECTOR_SEARCH_LOCAL_INDEX],
+                            help="indexes of the local backend; hnsw answers collections smaller than "
+                                 "HNSW_BRUTE_FORCE_THRESHOLD exactly")
+        parser.add_argument("--source", choices=BENCHMARK_DATA_SOURCES, default="huggingface",
+                            help="where the vectors come from; the atlas backend needs mongo")
+        parser.add_argument("--database", default=DATABASE_NAME)
+        parser.add_argument("--collection", default=COLLECTION_NAME)
+        parser.add_argument("--vector-index", default=get_vector_search_index_name_for_sample_data())
+        parser.add_argument("--documents", type=int, default=SAMPLE_DATA_LIMIT,
+                            help="0 loads every document; the atlas backend always loads the whole collection")
+        parser.add_argument("--queries", help="JSON lines query set to replay, see benchmark.load_queries")
+        parser.add_argument("--query-count", type=int, default=100, help="size of a generated query set")
+        parser.add_argument("--query-noise", type=float, default=0.05)
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--save-queries", help="write the query set as JSON lines, to replay it in a later run")
+        parser.add_argument("--limit", nargs="+", type=int, default=[10])
+        parser.add_argument("--num-candidates", nargs="+", type=parse_num_candidates, default=[50, 150, 500],
+                            help="numCandidates values, 'exact' for an exact (ENN) search")
+        parser.add_argument("--filter", nargs="*", type=json.loads, default=None,
+                            help="$vectorSearch filters as JSON; by default no filter and the sample pre-filter")
+        parser.add_argument("--warmup", type=int, default=5, help="searches run before measuring each case")
+        parser.add_argument("--output", default="vector_search_benchmark.json")
+
+    def handle(self, *args, **options):
+        if "atlas" in options["backend"] and options["source"] != "mongo":
+            raise CommandError("The atlas backend needs --source mongo, the ground truth must cover the same "
+                               "documents as the index")
+
+        limit = options["documents"]
+        if "atlas" in options["backend"] and limit:
+            # the Atlas index searches the whole collection, a ground truth over a subset would miss its results
+            self.stdout.write(self.style.WARNING("--documents is ignored with the atlas backend, loading the whole "
+                                                 "collection"))
+            limit = 0
+
+        embedding_field = get_vector_embedding_field_name_for_sample_data()
+        documents = load_benchmark_documents(source=options["source"], db_name=options["database"],
+                                             collection_name=options["collection"], limit=limit)
+        if not documents:
+            raise CommandError("No documents to benchmark")
+
+        ground_truth = GroundTruth(documents=documents, embedding_field=embedding_field)
+        if options["queries"]:
+            queries = load_queries(options["queries"])
+        else:
+            queries = generate_queries(ground_truth.vectors, count=options["query_count"], noise=options["query_noise"],
+                                       seed=options["seed"])
+        if options["save_queries"]:
+            save_queries(queries, options["save_queries"])
+
+        filters = options["filter"] if options["filter"] is not None else [{}, get_query_pre_filters_for_sample_data()]
+        results = run_benchmark(documents=documents, queries=queries, embedding_field=embedding_field,
+                                backends=options["backend"], index_types=options["index_type"], filters=filters,
+                                limits=options["limit"], num_candidates=options["num_candidates"],
+                                db_name=options["database"], collection_name=options["collection"],
+                                vector_index=options["vector_index"], warmup=options["warmup"],
+                                ground_truth=ground_truth)
+        results["parameters"] = {k: options[k] for k in ("backend", "index_type", "source", "database",
+                                                         "collection", "vector_index", "queries", "query_count",
+                                                         "query_noise", "seed", "limit", "num_candidates", "warmup")}
+        with open(options["output"], "w") as f:
+            json.dump(results, f, indent=2, default=str)
+        self.stdout.write(self.style.SUCCESS(f"{len(results['runs'])} benchmark runs written to {options['output']}"))
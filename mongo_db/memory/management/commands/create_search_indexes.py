@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from memory.mongo_db.service.mongo_service import create_vector_search_index_on_collection, \
+    create_text_search_index_on_collection
+from memory.mongo_db.service.mongo_sample_data_service import get_db_and_collection_for_sample_data, \
+    get_vector_search_index_name_for_sample_data, get_vector_embedding_field_name_for_sample_data, \
+    get_vector_index_pre_filters_for_sample_data, get_text_search_index_name_for_sample_data
+
+
+class Command(BaseCommand):
+    help = "Creates or updates the vector search and text search indexes of the sample collection and waits until " \
+           "they are queryable."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--no-wait", action="store_true", help="do not wait until the index is queryable")
+
+    def handle(self, *args, **options):
+        db_name, collection_name = get_db_and_collection_for_sample_data()
+        ready = create_vector_search_index_on_collection(
+            db_name=db_name, collection_name=collection_name,
+            vector_search_index_name=get_vector_search_index_name_for_sample_data(),
+            vector_embedding_field_name=get_vector_embedding_field_name_for_sample_data(),
+            vector_index_pre_filters=get_vector_index_pre_filters_for_sample_data(),
+            wait=not options["no_wait"])
+        if ready:
+            self.stdout.write(self.style.SUCCESS("Vector search index is ready"))
+        else:
+            self.stdout.write(self.style.WARNING("Vector search index is not ready yet"))
+
+        ready = create_text_search_index_on_collection(
+            db_name=db_name, collection_name=collection_name,
+            text_search_index_name=get_text_search_index_name_for_sample_data(),
+            wait=not options["no_wait"])
+        if ready:
+            self.stdout.write(self.style.SUCCESS("Text search index is ready"))
+        else:
+            self.stdout.write(self.style.WARNING("Text search index is not ready yet"))
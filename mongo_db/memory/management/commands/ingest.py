@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from memory.mongo_db.service.mongo_ingest_service import ingest_listings_from_file, INGEST_FILE_FORMATS
+from memory.mongo_db.service.mongo_sample_data_service import DATABASE_NAME, COLLECTION_NAME, INGEST_CHUNK_SIZE, \
+    INGEST_MAX_IN_FLIGHT
+
+
+class Command(BaseCommand):
+    help = "Incrementally ingests listings from an NDJSON or Parquet file: only new or changed listings are " \
+           "embedded and upserted, listings missing from the file are deleted."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="NDJSON (one listing per line) or Parquet file")
+        parser.add_argument("--format", choices=INGEST_FILE_FORMATS, default=None,
+                            help="file format, inferred from the file extension by default")
+        parser.add_argument("--database", default=DATABASE_NAME)
+        parser.add_argument("--collection", default=COLLECTION_NAME)
+        parser.add_argument("--keep-missing", action="store_true",
+                            help="do not delete stored listings that are missing from the file")
+        parser.add_argument("--chunk-size", type=int, default=INGEST_CHUNK_SIZE)
+        parser.add_argument("--max-in-flight", type=int, default=INGEST_MAX_IN_FLIGHT)
+
+    def handle(self, *args, **options):
+        stats = ingest_listings_from_file(path=options["path"],
+                                          file_format=options["format"],
+                                          db_name=options["database"],
+                                          collection_name=options["collection"],
+                                          delete_missing=not options["keep_missing"],
+                                          chunk_size=options["chunk_size"],
+                                          max_in_flight=options["max_in_flight"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Read {stats['read_count']} listings: {stats['upserted_count']} upserted "
+            f"({stats['embedded_count']} embedded), {stats['unchanged_count']} unchanged, "
+            f"{stats['quarantined_count']} quarantined, {stats['deleted_count']} deleted "
+            f"in {stats['elapsed_seconds']:.1f}s"))
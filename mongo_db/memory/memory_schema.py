@@ -1,19 +1,34 @@
-from graphene import ObjectType, String, Boolean, Mutation, Int, Field
+from graphene import ObjectType, String, Boolean, Mutation, Int, Field, Float, List, JSONString
 
+from llm.cache.compressed_context_cache import get_compressed_context_cache_stats
+from llm.cache.semantic_answer_cache import get_semantic_answer_cache_stats
 from llm.openai.service.llm_service import get_compressed_context_for_query
+from llm.openai.service.context_service import build_context
+from vectorizer.cache.embedding_cache import get_embedding_cache_stats
 from memory.mongo_db.service.mongo_service import create_vector_search_index_on_collection, \
-    get_vector_search_result_for_query, execute_rag_for_query_based_on_context, execute_rag_with_compressed_query_based_on_context
+    get_vector_search_result_for_query, execute_rag_for_query_based_on_context, \
+    execute_rag_with_compressed_query_based_on_context, get_vector_search_query_profiles, \
+    get_rag_answer_with_semantic_cache, get_vector_search_index_status
 
+from memory.mongo_db.vector_search.mmr import MMR_LAMBDA
 from memory.mongo_db.service.mongo_sample_data_service import load_sample_data, get_db_and_collection_for_sample_data, \
     get_vector_search_index_name_for_sample_data, get_vector_embedding_field_name_for_sample_data, \
-    get_post_filter_stage_for_sample_data, ListingSearchResultItem1, ListingSearchResultItem2, ListingSearchResultItem3, \
+    get_text_search_index_name_for_sample_data, get_post_filter_stage_for_sample_data, \
+    ListingSearchResultItem1, ListingSearchResultItem2, ListingSearchResultItem3, \
     ListingSearchResultItem4, \
     get_vector_index_pre_filters_for_sample_data, get_query_pre_filters_for_sample_data, \
-    get_projection_stage_for_sample_data, get_average_review_score_based_document_boosting_post_filter_for_sample_data, \
+    get_vector_index_filter_fields_for_sample_data, \
+    get_average_review_score_based_document_boosting_post_filter_for_sample_data, \
     get_weighted_average_review_based_document_boosting_post_filter_for_sample_data, \
     get_sorting_based_document_boosting_post_filter_for_sample_data
 
 
+def get_rag_variant_name(mutation_name: str, search_mode: str, mmr_k: int = None, mmr_lambda: float = None) -> str:
+    """Semantic cache variant: answers are only shared between requests with the same search settings."""
+    variant = f"{mutation_name}:{search_mode}"
+    return f"{variant}:mmr{mmr_k}@{mmr_lambda}" if mmr_k else variant
+
+
 class LoadSampleData(Mutation):
     ok = Boolean()
     database_name = String()
@@ -21,29 +36,54 @@ class LoadSampleData(Mutation):
     vector_search_index_name = String()
     vector_embedding_document_field_name = String()
     ingested_data_sample = String()
+    ingested_count = Int()
+    quarantined_count = Int()
+    elapsed_seconds = Float()
+    listings_per_second = Float()
 
     class Arguments:
         param = String()
+        # number of listings to ingest, 0 for the full dataset
+        limit = Int()
 
-    def mutate(self, info, param):
-        response = load_sample_data()
+    def mutate(self, info, param, limit=None):
+        response = load_sample_data() if limit is None else load_sample_data(limit=limit)
         return (LoadSampleData(ok=True, **response))
 
 
+class SearchIndexStatusType(ObjectType):
+    name = String()
+    # Atlas index status: PENDING, BUILDING, READY, FAILED, ... or DOES_NOT_EXIST
+    status = String()
+    queryable = Boolean()
+
+
 class CreateVectorSearchIndex(Mutation):
     ok = Boolean()
+    # poll vectorSearchIndexStatus until the index is queryable
+    status = Field(SearchIndexStatusType)
 
     class Arguments:
         param = String()
+        # block until the index is queryable, which can take minutes, instead of returning right away
+        wait = Boolean(default_value=False)
 
-    def mutate(self, info, param):
+    def mutate(self, info, param, wait=False):
         db_name, collection_name = get_db_and_collection_for_sample_data()
         vector_search_index_name = get_vector_search_index_name_for_sample_data()
         vector_embedding_field_name = get_vector_embedding_field_name_for_sample_data()
+        # the pre filter fields are indexed too, so the same index serves plain and pre-filtered searches
+        pre_filters = get_vector_index_pre_filters_for_sample_data()
         resp = create_vector_search_index_on_collection(db_name=db_name, collection_name=collection_name,
                                                         vector_search_index_name=vector_search_index_name,
-                                                        vector_embedding_field_name=vector_embedding_field_name)
-        return CreateVectorSearchIndex(ok=resp)
+                                                        vector_embedding_field_name=vector_embedding_field_name,
+                                                        vector_index_pre_filters=pre_filters,
+                                                        wait=wait)
+        status = get_vector_search_index_status(db_name=db_name, collection_name=collection_name,
+                                                vector_search_index_name=vector_search_index_name)
+        # without waiting, an index that is being built is a success too
+        ok = resp or status["status"] not in ("FAILED", "DOES_NOT_EXIST", "UNKNOWN")
+        return CreateVectorSearchIndex(ok=ok, status=SearchIndexStatusType(**status))
 
 
 class RunRAGQuery(Mutation):
@@ -52,8 +92,13 @@ class RunRAGQuery(Mutation):
 
     class Arguments:
         query = String()
+        # "vector" or "hybrid" (vector and Atlas Search text results fused)
+        search_mode = String()
+        # diversify the results by MMR: number of results and relevance/diversity trade-off (1 = relevance only)
+        mmr_k = Int()
+        mmr_lambda = Float()
 
-    def mutate(self, info, query):
+    def mutate(self, info, query, search_mode="vector", mmr_k=None, mmr_lambda=MMR_LAMBDA):
         """
         query =
             I want to stay in a place that's warm and friendly,
@@ -63,21 +108,31 @@ class RunRAGQuery(Mutation):
         db_name, collection_name = get_db_and_collection_for_sample_data()
         vector_search_index_name = get_vector_search_index_name_for_sample_data()
         vector_embedding_field_name = get_vector_embedding_field_name_for_sample_data()
-        results = get_vector_search_result_for_query(db_name=db_name, collection_name=collection_name,
-                                                     vector_search_index_name=vector_search_index_name,
-                                                     vector_embedding_field_name=vector_embedding_field_name,
-                                                     query=query)
-        if results != {}:
+        text_search_index_name = get_text_search_index_name_for_sample_data()
+
+        def answer():
+            results = get_vector_search_result_for_query(db_name=db_name, collection_name=collection_name,
+                                                         vector_search_index_name=vector_search_index_name,
+                                                         vector_embedding_field_name=vector_embedding_field_name,
+                                                         result_model=ListingSearchResultItem1,
+                                                         search_mode=search_mode,
+                                                         text_search_index_name=text_search_index_name,
+                                                         mmr_k=mmr_k,
+                                                         mmr_lambda=mmr_lambda,
+                                                         query=query)
+            if not bool(results):
+                return None
             # Convert search results into a list of SearchResultItem models
             search_results_models = [
                 ListingSearchResultItem1(**result)
                 for result in results
             ]
+            return execute_rag_for_query_based_on_context(query=query, context=build_context(search_results_models))
 
-            search_results = [item.dict() for item in search_results_models]
-            response = execute_rag_for_query_based_on_context(query=query, context=str(search_results))
-        else:
-            response = "No response"
+        variant = get_rag_variant_name("RunRAGQuery", search_mode, mmr_k, mmr_lambda)
+        response = get_rag_answer_with_semantic_cache(query=query, variant=variant,
+                                                      db_name=db_name, collection_name=collection_name,
+                                                      filters=None, answer_fn=answer) or "No response"
         return RunRAGQuery(ok=True, response=response)
 
 
@@ -87,8 +142,13 @@ class RunRAGQueryWithPreFilter(Mutation):
 
     class Arguments:
         query = String()
+        # "vector" or "hybrid" (vector and Atlas Search text results fused)
+        search_mode = String()
+        # diversify the results by MMR: number of results and relevance/diversity trade-off (1 = relevance only)
+        mmr_k = Int()
+        mmr_lambda = Float()
 
-    def mutate(self, info, query):
+    def mutate(self, info, query, search_mode="vector", mmr_k=None, mmr_lambda=MMR_LAMBDA):
         """
         query =
             I want to stay in a place that's warm and friendly,
@@ -98,28 +158,33 @@ class RunRAGQueryWithPreFilter(Mutation):
         db_name, collection_name = get_db_and_collection_for_sample_data()
         vector_search_index_name = get_vector_search_index_name_for_sample_data()
         vector_embedding_field_name = get_vector_embedding_field_name_for_sample_data()
-        pre_filters = get_vector_index_pre_filters_for_sample_data()
-
-        # this creates a new index where vector embeddings are filtered based on pre filter criteria and then indexed
-        create_vector_search_index_on_collection(db_name=db_name, collection_name=collection_name,
-                                                 vector_search_index_name=vector_search_index_name,
-                                                 vector_embedding_field_name=vector_embedding_field_name,
-                                                 vector_index_pre_filters=pre_filters)
+        text_search_index_name = get_text_search_index_name_for_sample_data()
 
+        # the pre filter fields are part of the index created by CreateVectorSearchIndex (or `manage.py
+        # create_search_indexes`), searches never create or check indexes
         filters = get_query_pre_filters_for_sample_data()
-        results = get_vector_search_result_for_query(db_name=db_name, collection_name=collection_name,
-                                                     vector_search_index_name=vector_search_index_name,
-                                                     vector_embedding_field_name=vector_embedding_field_name,
-                                                     query=query,
-                                                     filters=filters)
-        if bool(results):
+
+        def answer():
+            results = get_vector_search_result_for_query(db_name=db_name, collection_name=collection_name,
+                                                         vector_search_index_name=vector_search_index_name,
+                                                         vector_embedding_field_name=vector_embedding_field_name,
+                                                         result_model=ListingSearchResultItem2,
+                                                         search_mode=search_mode,
+                                                         text_search_index_name=text_search_index_name,
+                                                         mmr_k=mmr_k,
+                                                         mmr_lambda=mmr_lambda,
+                                                         query=query,
+                                                         filters=filters)
+            if not bool(results):
+                return None
             # Convert search results into a list of SearchResultItem models
             search_results_models = [ListingSearchResultItem2(**result) for result in results]
+            return execute_rag_for_query_based_on_context(query=query, context=build_context(search_results_models))
 
-            search_results = [item.dict() for item in search_results_models]
-            response = execute_rag_for_query_based_on_context(query=query, context=str(search_results))
-        else:
-            response = "No response"
+        variant = get_rag_variant_name("RunRAGQueryWithPreFilter", search_mode, mmr_k, mmr_lambda)
+        response = get_rag_answer_with_semantic_cache(query=query, variant=variant,
+                                                      db_name=db_name, collection_name=collection_name,
+                                                      filters=filters, answer_fn=answer) or "No response"
         return RunRAGQueryWithPreFilter(ok=True, response=response)
 
 
@@ -129,8 +194,13 @@ class RunRAGQueryWithPostFilter(Mutation):
 
     class Arguments:
         query = String()
+        # "vector" or "hybrid" (vector and Atlas Search text results fused)
+        search_mode = String()
+        # diversify the results by MMR: number of results and relevance/diversity trade-off (1 = relevance only)
+        mmr_k = Int()
+        mmr_lambda = Float()
 
-    def mutate(self, info, query):
+    def mutate(self, info, query, search_mode="vector", mmr_k=None, mmr_lambda=MMR_LAMBDA):
         """
         query =
             I want to stay in a place that's warm and friendly,
@@ -140,21 +210,33 @@ class RunRAGQueryWithPostFilter(Mutation):
         db_name, collection_name = get_db_and_collection_for_sample_data()
         vector_search_index_name = get_vector_search_index_name_for_sample_data()
         vector_embedding_field_name = get_vector_embedding_field_name_for_sample_data()
+        text_search_index_name = get_text_search_index_name_for_sample_data()
 
         match_stage = get_post_filter_stage_for_sample_data()
-        results = get_vector_search_result_for_query(db_name=db_name,
-                                                     collection_name=collection_name,
-                                                     vector_search_index_name=vector_search_index_name,
-                                                     vector_embedding_field_name=vector_embedding_field_name,
-                                                     additional_stages=[match_stage],
-                                                     query=query)
-        if bool(results):
+
+        def answer():
+            results = get_vector_search_result_for_query(db_name=db_name,
+                                                         collection_name=collection_name,
+                                                         vector_search_index_name=vector_search_index_name,
+                                                         vector_embedding_field_name=vector_embedding_field_name,
+                                                         additional_stages=[match_stage],
+                                                         filter_fields=get_vector_index_filter_fields_for_sample_data(),
+                                                         result_model=ListingSearchResultItem2,
+                                                         search_mode=search_mode,
+                                                         text_search_index_name=text_search_index_name,
+                                                         mmr_k=mmr_k,
+                                                         mmr_lambda=mmr_lambda,
+                                                         query=query)
+            if not bool(results):
+                return None
             # Convert search results into a list of SearchResultItem models
             search_results_models = [ListingSearchResultItem2(**result) for result in results]
-            search_results = [item.dict() for item in search_results_models]
-            response = execute_rag_for_query_based_on_context(query=query, context=str(search_results))
-        else:
-            response = "No response"
+            return execute_rag_for_query_based_on_context(query=query, context=build_context(search_results_models))
+
+        variant = get_rag_variant_name("RunRAGQueryWithPostFilter", search_mode, mmr_k, mmr_lambda)
+        response = get_rag_answer_with_semantic_cache(query=query, variant=variant,
+                                                      db_name=db_name, collection_name=collection_name,
+                                                      filters=match_stage, answer_fn=answer) or "No response"
         return RunRAGQueryWithPostFilter(ok=True, response=response)
 
 
@@ -164,8 +246,13 @@ class RunRAGQueryWithFieldProjections(Mutation):
 
     class Arguments:
         query = String()
+        # "vector" or "hybrid" (vector and Atlas Search text results fused)
+        search_mode = String()
+        # diversify the results by MMR: number of results and relevance/diversity trade-off (1 = relevance only)
+        mmr_k = Int()
+        mmr_lambda = Float()
 
-    def mutate(self, info, query):
+    def mutate(self, info, query, search_mode="vector", mmr_k=None, mmr_lambda=MMR_LAMBDA):
         """
         query =
             I want to stay in a place that's warm and friendly,
@@ -175,21 +262,30 @@ class RunRAGQueryWithFieldProjections(Mutation):
         db_name, collection_name = get_db_and_collection_for_sample_data()
         vector_search_index_name = get_vector_search_index_name_for_sample_data()
         vector_embedding_field_name = get_vector_embedding_field_name_for_sample_data()
-
-        projection_stage = get_projection_stage_for_sample_data()
-        results = get_vector_search_result_for_query(db_name=db_name,
-                                                     collection_name=collection_name,
-                                                     vector_search_index_name=vector_search_index_name,
-                                                     vector_embedding_field_name=vector_embedding_field_name,
-                                                     additional_stages=[projection_stage],
-                                                     query=query)
-        if bool(results):
+        text_search_index_name = get_text_search_index_name_for_sample_data()
+
+        def answer():
+            # the projection stage is generated from ListingSearchResultItem3
+            results = get_vector_search_result_for_query(db_name=db_name,
+                                                         collection_name=collection_name,
+                                                         vector_search_index_name=vector_search_index_name,
+                                                         vector_embedding_field_name=vector_embedding_field_name,
+                                                         result_model=ListingSearchResultItem3,
+                                                         search_mode=search_mode,
+                                                         text_search_index_name=text_search_index_name,
+                                                         mmr_k=mmr_k,
+                                                         mmr_lambda=mmr_lambda,
+                                                         query=query)
+            if not bool(results):
+                return None
             # Convert search results into a list of SearchResultItem models
             search_results_models = [ListingSearchResultItem3(**result) for result in results]
-            search_results = [item.dict() for item in search_results_models]
-            response = execute_rag_for_query_based_on_context(query=query, context=str(search_results))
-        else:
-            response = "No response"
+            return execute_rag_for_query_based_on_context(query=query, context=build_context(search_results_models))
+
+        variant = get_rag_variant_name("RunRAGQueryWithFieldProjections", search_mode, mmr_k, mmr_lambda)
+        response = get_rag_answer_with_semantic_cache(query=query, variant=variant,
+                                                      db_name=db_name, collection_name=collection_name,
+                                                      filters=None, answer_fn=answer) or "No response"
         return RunRAGQueryWithFieldProjections(ok=True, response=response)
 
 
@@ -199,8 +295,13 @@ class RunRAGQueryWithDocumentBoosting(Mutation):
 
     class Arguments:
         query = String()
+        # "vector" or "hybrid" (vector and Atlas Search text results fused)
+        search_mode = String()
+        # diversify the results by MMR: number of results and relevance/diversity trade-off (1 = relevance only)
+        mmr_k = Int()
+        mmr_lambda = Float()
 
-    def mutate(self, info, query):
+    def mutate(self, info, query, search_mode="vector", mmr_k=None, mmr_lambda=MMR_LAMBDA):
         """
         query =
             I want to stay in a place that's warm and friendly,
@@ -210,26 +311,36 @@ class RunRAGQueryWithDocumentBoosting(Mutation):
         db_name, collection_name = get_db_and_collection_for_sample_data()
         vector_search_index_name = get_vector_search_index_name_for_sample_data()
         vector_embedding_field_name = get_vector_embedding_field_name_for_sample_data()
+        text_search_index_name = get_text_search_index_name_for_sample_data()
 
         # Note: order of stages matter
         review_avg_stage = get_average_review_score_based_document_boosting_post_filter_for_sample_data()
         weighted_avg_stage = get_weighted_average_review_based_document_boosting_post_filter_for_sample_data()
         sorting_stage = get_sorting_based_document_boosting_post_filter_for_sample_data()
 
-        results = get_vector_search_result_for_query(db_name=db_name,
-                                                     collection_name=collection_name,
-                                                     vector_search_index_name=vector_search_index_name,
-                                                     vector_embedding_field_name=vector_embedding_field_name,
-                                                     additional_stages=[review_avg_stage, weighted_avg_stage,
-                                                                        sorting_stage],
-                                                     query=query)
-        if bool(results):
+        def answer():
+            results = get_vector_search_result_for_query(db_name=db_name,
+                                                         collection_name=collection_name,
+                                                         vector_search_index_name=vector_search_index_name,
+                                                         vector_embedding_field_name=vector_embedding_field_name,
+                                                         additional_stages=[review_avg_stage, weighted_avg_stage,
+                                                                            sorting_stage],
+                                                         result_model=ListingSearchResultItem4,
+                                                         search_mode=search_mode,
+                                                         text_search_index_name=text_search_index_name,
+                                                         mmr_k=mmr_k,
+                                                         mmr_lambda=mmr_lambda,
+                                                         query=query)
+            if not bool(results):
+                return None
             # Convert search results into a list of SearchResultItem models
             search_results_models = [ListingSearchResultItem4(**result) for result in results]
-            search_results = [item.dict() for item in search_results_models]
-            response = execute_rag_for_query_based_on_context(query=query, context=str(search_results))
-        else:
-            response = "No response"
+            return execute_rag_for_query_based_on_context(query=query, context=build_context(search_results_models))
+
+        variant = get_rag_variant_name("RunRAGQueryWithDocumentBoosting", search_mode, mmr_k, mmr_lambda)
+        response = get_rag_answer_with_semantic_cache(query=query, variant=variant,
+                                                      db_name=db_name, collection_name=collection_name,
+                                                      filters=None, answer_fn=answer) or "No response"
         return RunRAGQueryWithDocumentBoosting(ok=True, response=response)
 
 
@@ -239,8 +350,13 @@ class RunRAGWithCompressedQuery(Mutation):
 
     class Arguments:
         query = String()
+        # "vector" or "hybrid" (vector and Atlas Search text results fused)
+        search_mode = String()
+        # diversify the results by MMR: number of results and relevance/diversity trade-off (1 = relevance only)
+        mmr_k = Int()
+        mmr_lambda = Float()
 
-    def mutate(self, info, query):
+    def mutate(self, info, query, search_mode="vector", mmr_k=None, mmr_lambda=MMR_LAMBDA):
         """
         query =
             I want to stay in a place that's warm and friendly,
@@ -250,22 +366,35 @@ class RunRAGWithCompressedQuery(Mutation):
         db_name, collection_name = get_db_and_collection_for_sample_data()
         vector_search_index_name = get_vector_search_index_name_for_sample_data()
         vector_embedding_field_name = get_vector_embedding_field_name_for_sample_data()
+        text_search_index_name = get_text_search_index_name_for_sample_data()
 
         match_stage = get_post_filter_stage_for_sample_data()
-        results = get_vector_search_result_for_query(db_name=db_name,
-                                                     collection_name=collection_name,
-                                                     vector_search_index_name=vector_search_index_name,
-                                                     vector_embedding_field_name=vector_embedding_field_name,
-                                                     additional_stages=[match_stage],
-                                                     query=query)
-        if bool(results):
+
+        def answer():
+            results = get_vector_search_result_for_query(db_name=db_name,
+                                                         collection_name=collection_name,
+                                                         vector_search_index_name=vector_search_index_name,
+                                                         vector_embedding_field_name=vector_embedding_field_name,
+                                                         additional_stages=[match_stage],
+                                                         filter_fields=get_vector_index_filter_fields_for_sample_data(),
+                                                         result_model=ListingSearchResultItem2,
+                                                         search_mode=search_mode,
+                                                         text_search_index_name=text_search_index_name,
+                                                         mmr_k=mmr_k,
+                                                         mmr_lambda=mmr_lambda,
+                                                         query=query)
+            if not bool(results):
+                return None
             # Convert search results into a list of SearchResultItem models
             search_results_models = [ListingSearchResultItem2(**result) for result in results]
-            search_results = [item.dict() for item in search_results_models]
-            compressed_context = get_compressed_context_for_query(query=query, context=str(search_results))
-            response = execute_rag_with_compressed_query_based_on_context(query=query, context=compressed_context)
-        else:
-            response = "No response"
+            compressed_context = get_compressed_context_for_query(query=query,
+                                                                  context=build_context(search_results_models))
+            return execute_rag_with_compressed_query_based_on_context(query=query, context=compressed_context)
+
+        variant = get_rag_variant_name("RunRAGWithCompressedQuery", search_mode, mmr_k, mmr_lambda)
+        response = get_rag_answer_with_semantic_cache(query=query, variant=variant,
+                                                      db_name=db_name, collection_name=collection_name,
+                                                      filters=match_stage, answer_fn=answer) or "No response"
 
         return RunRAGWithCompressedQuery(ok=True, response=response)
 
@@ -288,8 +417,58 @@ class SampleDataListingType(ObjectType):
     vector_embedding_document_field_name = String()
 
 
+class EmbeddingCacheStatsType(ObjectType):
+    memory_hits = Int()
+    disk_hits = Int()
+    misses = Int()
+    evictions = Int()
+    memory_items = Int()
+    hit_rate = Float()
+
+
+class SemanticAnswerCacheStatsType(ObjectType):
+    hits = Int()
+    misses = Int()
+    evictions = Int()
+    invalidations = Int()
+    items = Int()
+    hit_rate = Float()
+    latency_saved_ms = Float()
+
+
+class CompressedContextCacheStatsType(ObjectType):
+    memory_hits = Int()
+    disk_hits = Int()
+    misses = Int()
+    evictions = Int()
+    memory_items = Int()
+    hit_rate = Float()
+    latency_saved_ms = Float()
+    average_compression_ratio = Float()
+
+
+class VectorSearchQueryProfileType(ObjectType):
+    timestamp = Float()
+    reason = String()
+    elapsed_ms = Float()
+    index = String()
+    num_candidates = Int()
+    exact = Boolean()
+    limit = Int()
+    filter = JSONString()
+    additional_stages = List(String)
+    server_millis_elapsed = Float()
+    collector_stats = JSONString()
+    explain_error = String()
+
+
 class Query(ObjectType):
     sample_collection_detail = Field(SampleDataListingType)
+    embedding_cache_stats = Field(EmbeddingCacheStatsType)
+    semantic_answer_cache_stats = Field(SemanticAnswerCacheStatsType)
+    compressed_context_cache_stats = Field(CompressedContextCacheStatsType)
+    vector_search_query_profiles = List(VectorSearchQueryProfileType, slow_only=Boolean(), limit=Int())
+    vector_search_index_status = Field(SearchIndexStatusType)
 
     def resolve_sample_collection_detail(self, info):
         db_name, collection_name = get_db_and_collection_for_sample_data()
@@ -299,3 +478,22 @@ class Query(ObjectType):
                                      collection_name=collection_name,
                                      vector_search_index_name=vector_search_index_name,
                                      vector_embedding_document_field_name=vector_embedding_field_name)
+
+    def resolve_vector_search_index_status(self, info):
+        db_name, collection_name = get_db_and_collection_for_sample_data()
+        status = get_vector_search_index_status(db_name=db_name, collection_name=collection_name,
+                                                vector_search_index_name=get_vector_search_index_name_for_sample_data())
+        return SearchIndexStatusType(**status)
+
+    def resolve_embedding_cache_stats(self, info):
+        return EmbeddingCacheStatsType(**get_embedding_cache_stats())
+
+    def resolve_semantic_answer_cache_stats(self, info):
+        return SemanticAnswerCacheStatsType(**get_semantic_answer_cache_stats())
+
+    def resolve_compressed_context_cache_stats(self, info):
+        return CompressedContextCacheStatsType(**get_compressed_context_cache_stats())
+
+    def resolve_vector_search_query_profiles(self, info, slow_only=False, limit=None):
+        return [VectorSearchQueryProfileType(**profile)
+                for profile in get_vector_search_query_profiles(slow_only=slow_only, limit=limit)]
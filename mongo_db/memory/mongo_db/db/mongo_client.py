@@ -1,3 +1,4 @@
+from pymongo import AsyncMongoClient
 from pymongo.mongo_client import MongoClient
 
 from common_utils import get_env_key
@@ -14,3 +15,14 @@ class MongoConnection:
             # maxIdleTimeMS=300000: ensures the connection will be closed automatically after 5 mins of inactivity.
             cls._client = MongoClient(MONGO_URI, appname="simple_mongo_app", maxIdleTimeMS=300000)
         return cls._client
+
+
+class AsyncMongoConnection:
+    _client = None
+
+    @classmethod
+    def initialise_client(cls):
+        if cls._client is None:
+            # PyMongo's native asyncio client; shares the connection settings of the sync client
+            cls._client = AsyncMongoClient(MONGO_URI, appname="simple_mongo_app", maxIdleTimeMS=300000)
+        return cls._client
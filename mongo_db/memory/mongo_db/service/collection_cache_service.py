@@ -0,0 +1,18 @@
+from llm.cache.semantic_answer_cache import invalidate_semantic_answer_cache
+from memory.mongo_db.vector_search.local_vector_search import invalidate_local_vector_collection
+from memory.mongo_db.service.collection_generation_service import bump_collection_generation
+from memory.mongo_db.vector_search.search_planner import invalidate_search_planner
+
+
+def invalidate_collection_caches(db_name: str, collection_name: str):
+    """
+    Called after the documents of a collection changed, e.g. by ingestion. The caches of this process are dropped
+    right away; other processes notice the bumped generation, see collection_generation_service.
+    """
+    # vectors loaded by the local vector search backend
+    invalidate_local_vector_collection(db_name, collection_name)
+    # cached vector search results and the answers based on them
+    bump_collection_generation(db_name, collection_name)
+    invalidate_semantic_answer_cache(db_name, collection_name)
+    # filter selectivity counts of the search planner
+    invalidate_search_planner(db_name, collection_name)
@@ -0,0 +1,140 @@
+"""
+Generation counter of every collection, bumped whenever its documents or its search index change.
+
+Caches of search results and answers (see result_cache, semantic_answer_cache, search_planner and the local vector
+search backend) read the generation on lookup and ignore what they cached under an older one. The counters live in
+a metadata document of the collection's database, so a bump by `manage.py ingest`, which runs in its own process,
+reaches every web worker. A worker reads the document at most every COLLECTION_GENERATION_CHECK_SECONDS.
+
+Coroutines read it with get_async, on the AsyncMongoConnection client. A sync get called from a running event loop
+(e.g. a cache key built inside a coroutine) does not block it: it returns the last known generation and refreshes it
+in a task; only a namespace never read before is read inline.
+"""
+import asyncio
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+from common_utils import get_env_key
+from memory.mongo_db.db.mongo_client import MONGO_URI, MongoConnection, AsyncMongoConnection
+
+# "mongo" shares generations between processes, "memory" keeps them per process (no MongoDB, e.g. the local
+# vector search backend reading the huggingface sample data)
+COLLECTION_GENERATION_STORE = get_env_key('COLLECTION_GENERATION_STORE', 'mongo' if MONGO_URI else 'memory')
+COLLECTION_GENERATION_COLLECTION = get_env_key('COLLECTION_GENERATION_COLLECTION', 'collection_generations')
+# how stale a worker's view of a generation may get; every check is one find_one
+COLLECTION_GENERATION_CHECK_SECONDS = float(get_env_key('COLLECTION_GENERATION_CHECK_SECONDS', '5'))
+
+
+class CollectionGenerations:
+
+    def __init__(self, store: str = COLLECTION_GENERATION_STORE,
+                 check_seconds: float = COLLECTION_GENERATION_CHECK_SECONDS):
+        self.store = store
+        self.check_seconds = check_seconds
+        # namespace -> (generation, read_at)
+        self._generations = {}
+        # background refreshes started by get inside an event loop, by namespace
+        self._refreshes = {}
+        self._lock = threading.Lock()
+
+    def _is_shared(self, namespace: tuple) -> bool:
+        return self.store == "mongo" and namespace[0] is not None
+
+    @staticmethod
+    def _metadata_collection(db_name: str):
+        return MongoConnection.initialise_client().get_database(db_name).get_collection(
+            COLLECTION_GENERATION_COLLECTION)
+
+    @staticmethod
+    def _async_metadata_collection(db_name: str):
+        return AsyncMongoConnection.initialise_client().get_database(db_name).get_collection(
+            COLLECTION_GENERATION_COLLECTION)
+
+    def _remember(self, namespace: tuple, generation: int):
+        with self._lock:
+            self._generations[namespace] = (generation, time.monotonic())
+
+    def _get_known(self, namespace: tuple):
+        """(last known generation, whether it is due for a read)"""
+        with self._lock:
+            known = self._generations.get(namespace)
+        if not self._is_shared(namespace) or (known and time.monotonic() - known[1] < self.check_seconds):
+            return (known[0] if known else 0), False
+        return known, True
+
+    def _read_failed(self, namespace: tuple, known, e: Exception) -> int:
+        print(f"Reading the generation of {namespace[0]}.{namespace[1]} failed, using the last known one: {e}")
+        return known[0] if known else 0
+
+    def get(self, namespace: tuple) -> int:
+        known, is_due = self._get_known(namespace)
+        if not is_due:
+            return known
+        if known and self._refresh_in_background(namespace):
+            return known[0]
+        try:
+            doc = self._metadata_collection(namespace[0]).find_one({"_id": namespace[1]})
+            generation = doc["generation"] if doc else 0
+        except Exception as e:
+            generation = self._read_failed(namespace, known, e)
+        self._remember(namespace, generation)
+        return generation
+
+    async def get_async(self, namespace: tuple) -> int:
+        known, is_due = self._get_known(namespace)
+        if not is_due:
+            return known
+        try:
+            doc = await self._async_metadata_collection(namespace[0]).find_one({"_id": namespace[1]})
+            generation = doc["generation"] if doc else 0
+        except Exception as e:
+            generation = self._read_failed(namespace, known, e)
+        self._remember(namespace, generation)
+        return generation
+
+    def _refresh_in_background(self, namespace: tuple) -> bool:
+        """Starts get_async in a task when called from a running event loop; False outside of one."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        with self._lock:
+            if namespace not in self._refreshes:
+                task = loop.create_task(self.get_async(namespace))
+                self._refreshes[namespace] = task
+                task.add_done_callback(lambda _: self._refreshes.pop(namespace, None))
+        return True
+
+    def bump(self, namespace: tuple) -> int:
+        with self._lock:
+            known = self._generations.get(namespace)
+        generation = (known[0] if known else 0) + 1
+        if self._is_shared(namespace):
+            try:
+                doc = self._metadata_collection(namespace[0]).find_one_and_update(
+                    {"_id": namespace[1]}, {"$inc": {"generation": 1}}, upsert=True,
+                    return_document=ReturnDocument.AFTER)
+                generation = doc["generation"]
+            except Exception as e:
+                print(f"Bumping the generation of {namespace[0]}.{namespace[1]} failed, only this process sees it: "
+                      f"{e}")
+        self._remember(namespace, generation)
+        return generation
+
+
+collection_generations = CollectionGenerations()
+
+
+def get_collection_generation(db_name: str, collection_name: str) -> int:
+    return collection_generations.get((db_name, collection_name))
+
+
+async def get_collection_generation_async(db_name: str, collection_name: str) -> int:
+    return await collection_generations.get_async((db_name, collection_name))
+
+
+def bump_collection_generation(db_name: str, collection_name: str) -> int:
+    """Makes everything cached for the collection stale, in this process and in every other one."""
+    return collection_generations.bump((db_name, collection_name))
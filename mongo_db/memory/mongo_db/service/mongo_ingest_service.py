@@ -0,0 +1,264 @@
+"""
+Incremental ingestion of listings from NDJSON or Parquet files.
+
+Every stored listing carries a hash of its content and of the text its embedding is computed from. A re-ingest
+compares them with the source and
+    skips listings whose content hash is unchanged,
+    reuses the stored embedding when only fields outside the embedding text changed,
+    embeds new or changed text in batches (get_embeddings), unless the source already carries an embedding,
+then bulk upserts by _id and, when asked to, deletes listings that are no longer in the source.
+
+_id values in extended JSON ({"$oid": ...}) are decoded to ObjectId, so a file exported from the collection matches
+the stored listings.
+
+Reading/validating, embedding and writing run as pipelined stages: while chunk n is written, chunk n + 1 is
+embedded and chunk n + 2 is read.
+"""
+import json
+import time
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+from bson import json_util
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from common_utils import get_env_key
+from memory.mongo_db.db.mongo_client import MongoConnection
+from memory.mongo_db.service.mongo_sample_data_service import DATABASE_NAME, COLLECTION_NAME, \
+    QUARANTINE_COLLECTION_NAME, VECTOR_EMBEDDING_DOCUMENT_FIELD_NAME, INGEST_CHUNK_SIZE, INGEST_MAX_IN_FLIGHT, \
+    clean_record, validate_listings
+from memory.mongo_db.service.collection_cache_service import invalidate_collection_caches
+from memory.mongo_db.vector_search.vector_encoding import encode_document_embeddings, get_full_precision_field_name
+from vectorizer.openai.service.openai_service import get_embeddings
+
+# listing fields the text embedding is computed from, in this order
+LISTING_EMBEDDING_TEXT_FIELDS = tuple(
+    get_env_key('LISTING_EMBEDDING_TEXT_FIELDS', 'name,summary,space,description,neighborhood_overview').split(","))
+
+CONTENT_HASH_FIELD_NAME = "_content_hash"
+EMBEDDING_TEXT_HASH_FIELD_NAME = "_embedding_text_hash"
+
+INGEST_FILE_FORMATS = ("ndjson", "parquet")
+
+
+def _hash(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def get_listing_embedding_text(listing: dict) -> str:
+    return "\n".join(str(listing[f]) for f in LISTING_EMBEDDING_TEXT_FIELDS if listing.get(f))
+
+
+def get_content_hash(listing: dict, vector_embedding_field_name: str) -> str:
+    excluded = {vector_embedding_field_name, get_full_precision_field_name(vector_embedding_field_name),
+                CONTENT_HASH_FIELD_NAME, EMBEDDING_TEXT_HASH_FIELD_NAME}
+    return _hash({k: v for k, v in listing.items() if k not in excluded})
+
+
+def get_file_format(path: str, file_format: str = None) -> str:
+    file_format = file_format or {".parquet": "parquet", ".pq": "parquet"}.get(Path(path).suffix.lower(), "ndjson")
+    if file_format not in INGEST_FILE_FORMATS:
+        raise ValueError(f"Unknown ingest file format '{file_format}', expected one of {INGEST_FILE_FORMATS}")
+    return file_format
+
+
+def decode_record_id(record: dict) -> dict:
+    """Decodes an extended JSON _id ({"$oid": ...}), e.g. read from Parquet, to its BSON value."""
+    if isinstance(record.get("_id"), dict):
+        record["_id"] = json_util.object_hook(record["_id"])
+    return record
+
+
+def has_valid_id(record: dict) -> bool:
+    # documents (that are not extended JSON) and arrays are not valid listing _ids
+    return record.get("_id") is not None and not isinstance(record["_id"], (dict, list))
+
+
+def iter_record_chunks(path: str, file_format: str = None, chunk_size: int = INGEST_CHUNK_SIZE):
+    """Yields lists of at most chunk_size raw records, reading the file incrementally."""
+    if get_file_format(path, file_format) == "parquet":
+        # pyarrow is installed with the datasets package
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield [decode_record_id(r) for r in batch.to_pylist()]
+        return
+
+    with open(path, encoding="utf-8") as f:
+        # json_util decodes extended JSON values such as {"$oid": ...} and {"$date": ...}
+        records = (json_util.loads(line) for line in f if line.strip())
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def prepare_chunk(collection, records: list, vector_embedding_field_name: str) -> dict:
+    """
+    Validates a chunk and diffs it against the stored listings.
+    Returns {"ids", "changed", "quarantined", "unchanged_count"} where changed are the listings to write, each
+    marked with whether it needs a new embedding.
+    """
+    records = [clean_record(r) for r in records]
+    without_id = [r for r in records if not has_valid_id(r)]
+    records = [r for r in records if has_valid_id(r)]
+
+    listings, quarantined = validate_listings(records, require_trusted_fields=False)
+    quarantined += [{"record": r, "errors": [{"loc": "_id", "msg": "Field required" if r.get("_id") is None
+                                              else "Must be a scalar or ObjectId"}]} for r in without_id]
+    # the Listing model does not keep _id, take it from the record
+    valid_ids = {id(r) for r in records} - {id(q["record"]) for q in quarantined}
+    ids = [r["_id"] for r in records if id(r) in valid_ids]
+    for _id, listing in zip(ids, listings):
+        listing["_id"] = _id
+
+    stored = {doc["_id"]: doc for doc in collection.find(
+        {"_id": {"$in": ids}}, {CONTENT_HASH_FIELD_NAME: 1, EMBEDDING_TEXT_HASH_FIELD_NAME: 1})}
+
+    changed = []
+    for listing in listings:
+        listing[CONTENT_HASH_FIELD_NAME] = get_content_hash(listing, vector_embedding_field_name)
+        listing[EMBEDDING_TEXT_HASH_FIELD_NAME] = _hash(get_listing_embedding_text(listing))
+        stored_listing = stored.get(listing["_id"], {})
+        if stored_listing.get(CONTENT_HASH_FIELD_NAME) == listing[CONTENT_HASH_FIELD_NAME]:
+            continue
+        if listing.get(vector_embedding_field_name):
+            # the source carries its own embedding
+            changed.append((listing, "source"))
+        elif stored_listing.get(EMBEDDING_TEXT_HASH_FIELD_NAME) == listing[EMBEDDING_TEXT_HASH_FIELD_NAME]:
+            changed.append((listing, "stored"))
+        else:
+            changed.append((listing, "embed"))
+
+    return {"ids": ids, "changed": changed, "quarantined": quarantined,
+            "unchanged_count": len(listings) - len(changed)}
+
+
+def embed_chunk(collection, chunk: dict, vector_embedding_field_name: str) -> dict:
+    """Fills in the embeddings of the changed listings: reused from the stored listing or computed in batches."""
+    full_precision_field_name = get_full_precision_field_name(vector_embedding_field_name)
+    embedding_fields = [vector_embedding_field_name, full_precision_field_name]
+
+    reused_ids = [listing["_id"] for listing, source in chunk["changed"] if source == "stored"]
+    stored = {doc["_id"]: doc for doc in collection.find(
+        {"_id": {"$in": reused_ids}}, {f: 1 for f in embedding_fields})} if reused_ids else {}
+
+    to_embed = [listing for listing, source in chunk["changed"] if source == "embed"]
+    embeddings = get_embeddings([get_listing_embedding_text(listing) for listing in to_embed]) if to_embed else []
+    embedded = {id(listing): embedding for listing, embedding in zip(to_embed, embeddings)}
+
+    documents = []
+    for listing, source in chunk["changed"]:
+        if source == "stored":
+            # already stored in the configured encoding
+            listing.update({f: stored[listing["_id"]][f] for f in embedding_fields if f in stored[listing["_id"]]})
+            documents.append(listing)
+            continue
+        if source == "embed":
+            if embedded[id(listing)] is None:
+                # embedding failed; leave the stored version, the next ingest retries
+                continue
+            listing[vector_embedding_field_name] = embedded[id(listing)]
+        # store the embeddings in the configured encoding (VECTOR_EMBEDDING_ENCODING)
+        documents.append(encode_document_embeddings(listing, vector_embedding_field_name))
+
+    return {**chunk, "documents": documents, "embedded_count": sum(e is not None for e in embeddings),
+            "failed_count": sum(e is None for e in embeddings)}
+
+
+def write_chunk(collection, quarantine_collection, embedded_chunk) -> dict:
+    """Bulk upserts the changed listings by _id; takes the future of embed_chunk so it can be pipelined."""
+    chunk = embedded_chunk.result()
+    upserted_count = 0
+    if chunk["documents"]:
+        requests = [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in chunk["documents"]]
+        try:
+            result = collection.bulk_write(requests, ordered=False)
+            upserted_count = result.upserted_count + result.modified_count
+        except BulkWriteError as e:
+            print(f"{len(e.details['writeErrors'])} listings failed to write: {e.details['writeErrors'][0]['errmsg']}")
+            upserted_count = e.details["nUpserted"] + e.details["nModified"]
+    if chunk["quarantined"]:
+        quarantine_collection.insert_many(chunk["quarantined"], ordered=False)
+    return {**chunk, "upserted_count": upserted_count}
+
+
+def delete_missing_listings(collection, seen_ids: set, batch_size: int = 1000) -> int:
+    """
+    Deletes stored listings whose _id was not in the source. Nothing is deleted when the source had no listings, or
+    when stored _ids are of a type the source has none of (e.g. ObjectIds against string _ids in the file): the
+    source then does not describe the stored listings.
+    """
+    if not seen_ids:
+        print("No listings read, refusing to delete the stored listings")
+        return 0
+    seen_types = {type(_id) for _id in seen_ids}
+    missing = [doc["_id"] for doc in collection.find({}, {"_id": 1}) if doc["_id"] not in seen_ids]
+    foreign_types = {type(_id).__name__ for _id in missing if type(_id) not in seen_types}
+    if foreign_types:
+        print(f"Stored listings have _ids of type {', '.join(sorted(foreign_types))} that the source has none of, "
+              f"refusing to delete {len(missing)} listings")
+        return 0
+
+    deleted_count = 0
+    for start in range(0, len(missing), batch_size):
+        deleted_count += collection.delete_many({"_id": {"$in": missing[start:start + batch_size]}}).deleted_count
+    return deleted_count
+
+
+def ingest_listings_from_file(path: str,
+                              file_format: str = None,
+                              db_name: str = DATABASE_NAME,
+                              collection_name: str = COLLECTION_NAME,
+                              vector_embedding_field_name: str = VECTOR_EMBEDDING_DOCUMENT_FIELD_NAME,
+                              delete_missing: bool = False,
+                              chunk_size: int = INGEST_CHUNK_SIZE,
+                              max_in_flight: int = INGEST_MAX_IN_FLIGHT) -> dict:
+    mclient = MongoConnection.initialise_client()
+    db = mclient.get_database(db_name)
+    collection = db.get_collection(collection_name)
+    quarantine_collection = db.get_collection(QUARANTINE_COLLECTION_NAME)
+
+    started_at = time.perf_counter()
+    stats = {"read_count": 0, "unchanged_count": 0, "embedded_count": 0, "embedding_failed_count": 0,
+             "upserted_count": 0, "quarantined_count": 0, "deleted_count": 0}
+    seen_ids = set()
+
+    def collect(written_chunk):
+        stats["unchanged_count"] += written_chunk["unchanged_count"]
+        stats["embedded_count"] += written_chunk["embedded_count"]
+        stats["embedding_failed_count"] += written_chunk["failed_count"]
+        stats["upserted_count"] += written_chunk["upserted_count"]
+        stats["quarantined_count"] += len(written_chunk["quarantined"])
+
+    # one worker per stage keeps each stage in order; at most max_in_flight chunks are between read and written
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest-embed") as embed_executor, \
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest-write") as write_executor:
+        for records in iter_record_chunks(path, file_format=file_format, chunk_size=chunk_size):
+            stats["read_count"] += len(records)
+            # quarantined listings count as seen, their stored version is kept
+            seen_ids.update(r["_id"] for r in records if has_valid_id(r))
+            chunk = prepare_chunk(collection, records, vector_embedding_field_name)
+            embedded_chunk = embed_executor.submit(embed_chunk, collection, chunk, vector_embedding_field_name)
+            if len(pending) >= max_in_flight:
+                collect(pending.popleft().result())
+            pending.append(write_executor.submit(write_chunk, collection, quarantine_collection, embedded_chunk))
+        while pending:
+            collect(pending.popleft().result())
+
+    if delete_missing:
+        stats["deleted_count"] = delete_missing_listings(collection, seen_ids)
+
+    stats["elapsed_seconds"] = time.perf_counter() - started_at
+    stats["listings_per_second"] = stats["read_count"] / stats["elapsed_seconds"] if stats["elapsed_seconds"] else 0.0
+    print(f"Ingested {path} into {db_name}.{collection_name}: {stats}")
+
+    if stats["upserted_count"] or stats["deleted_count"]:
+        # loaded vectors, cached search results and answers are stale now
+        invalidate_collection_caches(db_name, collection_name)
+    return stats
@@ -1,24 +1,49 @@
 import re
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
+from functools import lru_cache
 from typing import Optional, List
 from datetime import datetime
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel, ValidationError, TypeAdapter, create_model
 from datasets import load_dataset
-import pandas as pd
+from pymongo.errors import BulkWriteError
+
+from common_utils import get_env_key
 from memory.mongo_db.db.mongo_client import MongoConnection
+from memory.mongo_db.service.collection_cache_service import invalidate_collection_caches
+from memory.mongo_db.vector_search.vector_encoding import encode_document_embeddings
 
 DATASET_URI = "MongoDB/airbnb_embeddings"
 DATABASE_NAME = "airbnb_dataset"
 COLLECTION_NAME = "air_bnb_listings_reviews"
+# listings that failed validation, with their errors
+QUARANTINE_COLLECTION_NAME = f"{COLLECTION_NAME}_quarantine"
 
 # MongoDB Atlas Vector Search index name
 VECTOR_SEARCH_INDEX_NAME = "airbnb_text_vector_idx"
 VECTOR_PRE_FILTER_SEARCH_INDEX_NAME = "airbnb_text_vector_with_filter_idx"
+# MongoDB Atlas Search index of the text query of the hybrid search mode
+TEXT_SEARCH_INDEX_NAME = "airbnb_text_search_idx"
 
 # NOTE: This dataset contains text and image embeddings, but we only use the text embeddings
 # The field containing the text embeddings on each document within the collection
 VECTOR_EMBEDDING_DOCUMENT_FIELD_NAME = "text_embeddings"
 
+# number of listings to ingest from the dataset, 0 ingests the full dataset
+SAMPLE_DATA_LIMIT = int(get_env_key('SAMPLE_DATA_LIMIT', '100'))
+# listings cleaned, validated and written per chunk
+INGEST_CHUNK_SIZE = int(get_env_key('INGEST_CHUNK_SIZE', '500'))
+# chunks being written concurrently; also bounds how many chunks are held in memory
+INGEST_MAX_IN_FLIGHT = int(get_env_key('INGEST_MAX_IN_FLIGHT', '4'))
+# Listing fields whose values come from a trusted source (the dataset's precomputed embeddings): only their presence
+# is checked instead of validating them item by item. Comma separated, empty validates every field.
+LISTING_TRUSTED_FIELDS = tuple(f for f in get_env_key('LISTING_TRUSTED_FIELDS', VECTOR_EMBEDDING_DOCUMENT_FIELD_NAME)
+                               .split(",") if f)
+
 
 class Host(BaseModel):
     host_id: str
@@ -120,7 +145,7 @@ class ListingSearchResultItem2(BaseModel):
     space: str = None
 
 
-# Note: Ensure that the  projection document in the projection stage matches the search result model.
+# Note: the projection stage is generated from this model, see result_projection
 class ListingSearchResultItem3(BaseModel):
     name: str
     accommodates: Optional[int] = None
@@ -141,59 +166,170 @@ class ListingSearchResultItem4(BaseModel):
     combinedScore: Optional[float] = None
 
 
+# NOTE: Make sure the HF_token is set in the env vars.
+def clean_value(value):
+    """None for missing values (NaN), applied to list items as well; numeric vectors are returned as they are."""
+    if isinstance(value, list):
+        # dataset columns are typed, a list starting with a number (not NaN, which is unequal to itself) is a vector
+        # such as an embedding
+        if value and isinstance(value[0], (int, float)) and not isinstance(value[0], bool) and value[0] == value[0]:
+            return value
+        return [clean_value(v) for v in value]
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def clean_record(record: dict, trusted_fields: tuple = LISTING_TRUSTED_FIELDS) -> dict:
+    """clean_value of every field but the trusted ones, which are inserted as they are, see validate_listings."""
+    return {k: v if k in trusted_fields else clean_value(v) for k, v in record.items()}
+
+
+@lru_cache
+def get_listings_adapter(trusted_fields: tuple = LISTING_TRUSTED_FIELDS) -> TypeAdapter:
+    """List level adapter over the Listing schema without the trusted fields; a chunk is validated in one call."""
+    if not trusted_fields:
+        return TypeAdapter(List[Listing])
+    fields = {name: (field.annotation, field) for name, field in Listing.model_fields.items()
+              if name not in trusted_fields}
+    untrusted_listing = create_model("UntrustedListing", **fields)
+    return TypeAdapter(List[untrusted_listing])
+
+
+def _get_validation_errors(error: ValidationError) -> dict:
+    """Errors of a List[...] adapter grouped by the index of the failing record."""
+    errors = {}
+    for e in error.errors(include_url=False, include_context=False, include_input=False):
+        index, *loc = e["loc"]
+        errors.setdefault(index, []).append({"loc": ".".join(str(part) for part in loc), "msg": e["msg"]})
+    return errors
+
+
+def validate_listings(records: list, trusted_fields: tuple = LISTING_TRUSTED_FIELDS,
+                      require_trusted_fields: bool = True):
+    """
+    Validates records using the Listing schema and transforms them based on the schema into plain dicts ready for
+    insertion; trusted fields are passed through as they are, and may be missing if require_trusted_fields is False.
+    Returns (listings, quarantined): a record that fails validation is quarantined on its own as
+    {"record": ..., "errors": [...]} and the rest of the chunk is kept.
+    """
+    adapter = get_listings_adapter(trusted_fields)
+    errors = {}
+    for i, r in enumerate(records):
+        missing = [f for f in trusted_fields if not r.get(f)] if require_trusted_fields else []
+        if missing:
+            errors[i] = [{"loc": f, "msg": "Field required"} for f in missing]
+
+    untrusted = [{k: v for k, v in r.items() if k not in trusted_fields} for r in records]
+    try:
+        validated = adapter.validate_python(untrusted)
+    except ValidationError as e:
+        for i, record_errors in _get_validation_errors(e).items():
+            errors.setdefault(i, []).extend(record_errors)
+        validated = None
+
+    valid = [i for i in range(len(records)) if i not in errors]
+    if validated is None:
+        # the remaining records are valid, validate them again without the failing ones
+        validated = adapter.validate_python([untrusted[i] for i in valid])
+    elif errors:
+        validated = [validated[i] for i in valid]
+
+    listings = [{**listing, **{f: records[i][f] for f in trusted_fields if f in records[i]}}
+                for i, listing in zip(valid, adapter.dump_python(validated))]
+    quarantined = [{"record": records[i], "errors": e} for i, e in sorted(errors.items())]
+    return listings, quarantined
+
+
 # NOTE: Make sure the HF_token is set in the env vars.
 # NOTE: This dataset contains text and image embeddings, but this lessons only uses the text embeddings
-def load_sample_data_from_huggingface():
-    # load dataset
+def iter_sample_data_chunks_from_huggingface(limit: int = SAMPLE_DATA_LIMIT, chunk_size: int = INGEST_CHUNK_SIZE):
+    """
+    Streams the dataset and yields (listings, quarantined) per chunk of chunk_size records, see validate_listings;
+    only the current chunk is held in memory. limit=0 streams the full dataset.
+    """
     ds = load_dataset(DATASET_URI, streaming=True, split="train")
-    dataset = ds.take(100)
-
-    # convert dataset to dataframe
-    df = pd.DataFrame(dataset)
+    if limit:
+        ds = ds.take(limit)
 
-    # convert dataframe to dict
-    records = df.to_dict(orient='records')
+    records = iter(ds)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        # clean the records by setting empty values as None
+        chunk = [clean_record(r) for r in chunk]
+        yield validate_listings(chunk)
 
-    # clean the records by setting empty values as None
-    for r in records:
-        for k, v in r.items():
-            if isinstance(v, list):  # value is list
-                r[k] = [None if pd.isnull(i) else i for i in v]
-            else:
-                if pd.isnull(v):
-                    r[k] = None
 
-    # after cleaning the data records dict; transform to pydantic object with defined schema
+def load_sample_data_from_huggingface(limit: int = SAMPLE_DATA_LIMIT):
     listings = []
-    try:
-        # validate the records using Listing schema and transform based on the schema
-        listings = [Listing(**r).dict() for r in records]
-        # print(listings[0].keys())
-    except ValidationError as e:
-        print(e)
+    for chunk, _ in iter_sample_data_chunks_from_huggingface(limit=limit):
+        listings += chunk
     return listings
 
 
-def load_sample_data() -> dict:
-    sample_listings_data = load_sample_data_from_huggingface()
+def _insert_chunk(collection, listings: list) -> int:
+    if not listings:
+        return 0
+    try:
+        # unordered: the server may apply the writes in parallel and continues past a failing document
+        return len(collection.insert_many(listings, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        print(f"{len(e.details['writeErrors'])} listings failed to insert: {e.details['writeErrors'][0]['errmsg']}")
+        return e.details["nInserted"]
 
+
+def load_sample_data(limit: int = SAMPLE_DATA_LIMIT,
+                     chunk_size: int = INGEST_CHUNK_SIZE,
+                     max_in_flight: int = INGEST_MAX_IN_FLIGHT) -> dict:
     mclient = MongoConnection.initialise_client()
     # Pymongo client of database and collection
     db = mclient.get_database(DATABASE_NAME)
     collection = db.get_collection(COLLECTION_NAME)
 
+    quarantine_collection = db.get_collection(QUARANTINE_COLLECTION_NAME)
+
     # Delete any existing records in the collection
     collection.delete_many({})
-
-    # The ingestion process might take a few minutes
-    collection.insert_many(sample_listings_data)
-    print("Data ingestion into MongoDB completed")
+    quarantine_collection.delete_many({})
+
+    # The ingestion process might take a few minutes for the full dataset.
+    # Chunks are written while the next ones are streamed and validated, with at most max_in_flight pending writes.
+    started_at = time.perf_counter()
+    ingested_count = 0
+    quarantined_count = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="ingest") as executor:
+        for chunk, quarantined in iter_sample_data_chunks_from_huggingface(limit=limit, chunk_size=chunk_size):
+            if quarantined:
+                quarantine_collection.insert_many(quarantined, ordered=False)
+                quarantined_count += len(quarantined)
+            # store the embeddings in the configured encoding (VECTOR_EMBEDDING_ENCODING)
+            chunk = [encode_document_embeddings(listing, VECTOR_EMBEDDING_DOCUMENT_FIELD_NAME) for listing in chunk]
+            if len(pending) >= max_in_flight:
+                ingested_count += pending.popleft().result()
+            pending.append(executor.submit(_insert_chunk, collection, chunk))
+        while pending:
+            ingested_count += pending.popleft().result()
+
+    elapsed_seconds = time.perf_counter() - started_at
+    listings_per_second = ingested_count / elapsed_seconds if elapsed_seconds else 0.0
+    print(f"Data ingestion into MongoDB completed: {ingested_count} listings in {elapsed_seconds:.1f}s "
+          f"({listings_per_second:.0f} listings/s), {quarantined_count} quarantined in {QUARANTINE_COLLECTION_NAME}")
+
+    # loaded vectors, cached search results and answers are stale now
+    invalidate_collection_caches(DATABASE_NAME, COLLECTION_NAME)
 
     return {
         "database_name": DATABASE_NAME,
         "collection_name": COLLECTION_NAME,
         "vector_search_index_name": VECTOR_SEARCH_INDEX_NAME,
         "vector_embedding_document_field_name": VECTOR_EMBEDDING_DOCUMENT_FIELD_NAME,
+        "ingested_count": ingested_count,
+        "quarantined_count": quarantined_count,
+        "elapsed_seconds": elapsed_seconds,
+        "listings_per_second": listings_per_second,
         # "ingested_data_sample": str(sample_listings_data[0])
     }
 
@@ -206,6 +342,10 @@ def get_vector_search_index_name_for_sample_data():
     return VECTOR_SEARCH_INDEX_NAME
 
 
+def get_text_search_index_name_for_sample_data():
+    return TEXT_SEARCH_INDEX_NAME
+
+
 def get_vector_embedding_field_name_for_sample_data():
     return VECTOR_EMBEDDING_DOCUMENT_FIELD_NAME
 
@@ -218,7 +358,8 @@ def get_post_filter_stage_for_sample_data():
     # Specifying the metadata field to limit documents on
     search_path = "address.country"
 
-    # Create a match stage
+    # Create a match stage; the substring regex stays in the $match, only accommodates is pushed down into the
+    # $vectorSearch filter, see filter_pushdown
     match_stage = {
         "$match": {
             search_path: re.compile(r"United States"),
@@ -228,30 +369,6 @@ def get_post_filter_stage_for_sample_data():
     return match_stage
 
 
-def get_projection_stage_for_sample_data():
-    projection_stage = {
-        "$project": {
-            "_id": 0,
-            "name": 1,
-            "accommodates": 1,
-            "address.street": 1,
-            "address.government_area": 1,
-            "address.market": 1,
-            "address.country": 1,
-            "address.country_code": 1,
-            "address.location.type": 1,
-            "address.location.coordinates": 1,
-            "address.location.is_location_exact": 1,
-            "summary": 1,
-            "space": 1,
-            "neighborhood_overview": 1,
-            "notes": 1,
-            "score": {"$meta": "vectorSearchScore"}
-        }
-    }
-    return projection_stage
-
-
 def get_average_review_score_based_document_boosting_post_filter_for_sample_data():
     average_review_score_stage = {
         "$addFields": {
@@ -315,10 +432,17 @@ def get_vector_index_pre_filters_for_sample_data():
         },
         "bedrooms": {
             "type": "number"
+        },
+        "address.country": {
+            "type": "token"
         }
     }
 
 
+def get_vector_index_filter_fields_for_sample_data():
+    return tuple(get_vector_index_pre_filters_for_sample_data())
+
+
 def get_query_pre_filters_for_sample_data():
     return {
         "$and": [
@@ -1,8 +1,25 @@
-from memory.mongo_db.vector_search.mongo_vector_search import index_vector_embeddings, run_vs_for_query
+import asyncio
+import time
 
-from memory.mongo_db.db.mongo_client import MongoConnection
+from memory.mongo_db.vector_search.mongo_vector_search import index_vector_embeddings, run_vs_for_query, \
+    run_vs_for_query_async
 
+from memory.mongo_db.vector_search.hybrid_search import run_hybrid_search_for_query, \
+    run_hybrid_search_for_query_async, check_search_mode, get_text_search_index_model, HYBRID_FUSION_METHOD
+from memory.mongo_db.vector_search.mmr import run_mmr_vs_for_query, run_mmr_vs_for_query_async, MMR_LAMBDA
+from memory.mongo_db.vector_search.query_profiler import query_profiler
+from memory.mongo_db.vector_search.search_index_manager import search_index_manager
+from memory.mongo_db.vector_search.result_projection import get_projection_stage_for_model
+from memory.mongo_db.vector_search.pipeline_optimizer import get_optimized_stages
+from memory.mongo_db.vector_search.filter_pushdown import push_down_filters
+from memory.mongo_db.vector_search.local_vector_search import is_local_vector_search_backend, \
+    get_local_vector_collection
+
+from memory.mongo_db.db.mongo_client import MongoConnection, AsyncMongoConnection
+
+from llm.cache.semantic_answer_cache import get_semantic_answer_cache, get_semantic_cache_scope
 from llm.openai.service.llm_service import generate_llm_response
+from vectorizer.openai.service.openai_service import get_embedding
 
 
 def get_mongo_db_and_collection_conn(db_name: str, collection_name: str):
@@ -15,36 +32,239 @@ def get_mongo_db_and_collection_conn(db_name: str, collection_name: str):
     return db_conn, collection_conn
 
 
+def get_async_mongo_db_and_collection_conn(db_name: str, collection_name: str):
+    mclient = AsyncMongoConnection.initialise_client()
+
+    # Async Pymongo client of database and collection
+    db_conn = mclient.get_database(db_name)
+    collection_conn = db_conn.get_collection(collection_name)
+
+    return db_conn, collection_conn
+
+
 def create_vector_search_index_on_collection(db_name: str,
                                              collection_name: str,
                                              vector_search_index_name: str,
                                              vector_embedding_field_name: str,
-                                             vector_index_pre_filters: dict = {}
+                                             vector_index_pre_filters: dict = {},
+                                             wait: bool = True
                                              ):
+    """Not meant for the query path: searches expect the index to exist, see search_index_manager."""
+    if is_local_vector_search_backend():
+        # the local backend builds its index in-process when the collection is first searched
+        return True
     _, collection_conn = get_mongo_db_and_collection_conn(db_name=db_name, collection_name=collection_name)
     return index_vector_embeddings(collection_conn=collection_conn,
                                    vector_search_index_name=vector_search_index_name,
                                    vector_embedding_field_name=vector_embedding_field_name,
-                                   vector_index_pre_filters=vector_index_pre_filters
+                                   vector_index_pre_filters=vector_index_pre_filters,
+                                   wait=wait
                                    )
 
 
+def get_vector_search_index_status(db_name: str, collection_name: str, vector_search_index_name: str) -> dict:
+    """Status of the index ({"name", "status", "queryable"}) to poll after creating it without waiting."""
+    if is_local_vector_search_backend():
+        return {"name": vector_search_index_name, "status": "READY", "queryable": True}
+    _, collection_conn = get_mongo_db_and_collection_conn(db_name=db_name, collection_name=collection_name)
+    try:
+        return search_index_manager.get_status(collection_conn=collection_conn, name=vector_search_index_name)
+    except Exception as e:
+        print(f"Error reading the status of search index '{vector_search_index_name}': {e}")
+        return {"name": vector_search_index_name, "status": "UNKNOWN", "queryable": False}
+
+
+def check_mmr(search_mode: str, mmr_k: int = None, mmr_lambda: float = MMR_LAMBDA):
+    if mmr_k is None:
+        return
+    if search_mode != "vector":
+        raise ValueError("MMR re-ranking is only available in the vector search mode")
+    if mmr_k < 1 or not 0 <= mmr_lambda <= 1:
+        raise ValueError("MMR needs a k of at least 1 and a lambda between 0 and 1")
+
+
+def create_text_search_index_on_collection(db_name: str,
+                                           collection_name: str,
+                                           text_search_index_name: str,
+                                           wait: bool = True) -> bool:
+    """Atlas Search index of the text query of the hybrid search mode."""
+    if is_local_vector_search_backend():
+        return True
+    _, collection_conn = get_mongo_db_and_collection_conn(db_name=db_name, collection_name=collection_name)
+    try:
+        return search_index_manager.ensure_index(collection_conn=collection_conn,
+                                                 search_index_model=get_text_search_index_model(text_search_index_name),
+                                                 wait=wait)
+    except Exception as e:
+        print(f"Error creating text search index: {str(e)}")
+        return False
+
+
 def get_vector_search_result_for_query(query: str,
                                        db_name: str,
                                        collection_name: str,
                                        vector_search_index_name: str,
                                        vector_embedding_field_name: str,
                                        additional_stages: list = [],
-                                       filters: dict = {}) -> dict:
-    db_conn, collection_conn = get_mongo_db_and_collection_conn(db_name=db_name, collection_name=collection_name, )
-    results = run_vs_for_query(query=query, db=db_conn,
-                               collection=collection_conn,
-                               vector_index=vector_search_index_name,
-                               text_embedding_field=vector_embedding_field_name,
-                               additional_stages=additional_stages,
-                               filters=filters)
-
-    return results if isinstance(results, dict) else {}
+                                       filters: dict = {},
+                                       result_model=None,
+                                       search_mode: str = "vector",
+                                       text_search_index_name: str = None,
+                                       fusion_method: str = HYBRID_FUSION_METHOD,
+                                       mmr_k: int = None,
+                                       mmr_lambda: float = MMR_LAMBDA,
+                                       limit: int = 20,
+                                       filter_fields: tuple = ()) -> list:
+    """
+    search_mode "hybrid" fuses the vector results with an Atlas Search text query on text_search_index_name.
+    With mmr_k the vector results are re-ranked for diversity and mmr_k of them returned, see mmr.
+    filter_fields are the filter fields of the vector search index: the post $match predicates on them are pushed
+    into the $vectorSearch filter, see filter_pushdown.
+    """
+    check_search_mode(search_mode, fusion_method)
+    check_mmr(search_mode, mmr_k, mmr_lambda)
+    if filter_fields:
+        filters, additional_stages, limit = push_down_filters(filters=filters, additional_stages=additional_stages,
+                                                              filter_fields=filter_fields,
+                                                              limit=None if mmr_k else limit)
+    if result_model is not None:
+        # fetch only the fields the results are parsed into, not the whole listing with its embedding
+        additional_stages = additional_stages + [get_projection_stage_for_model(result_model)]
+    # merged $addFields, an early $project and no no-op stages, see pipeline_optimizer
+    additional_stages = get_optimized_stages(additional_stages)
+    if is_local_vector_search_backend():
+        db_conn = None
+        collection_conn = get_local_vector_collection(db_name=db_name, collection_name=collection_name,
+                                                      embedding_field=vector_embedding_field_name)
+    else:
+        db_conn, collection_conn = get_mongo_db_and_collection_conn(db_name=db_name, collection_name=collection_name)
+    if search_mode == "hybrid":
+        results = run_hybrid_search_for_query(query=query, db=db_conn,
+                                              collection=collection_conn,
+                                              vector_index=vector_search_index_name,
+                                              text_search_index=text_search_index_name,
+                                              text_embedding_field=vector_embedding_field_name,
+                                              additional_stages=additional_stages,
+                                              filters=filters,
+                                              limit=limit,
+                                              fusion_method=fusion_method)
+    elif mmr_k:
+        results = run_mmr_vs_for_query(query=query, db=db_conn,
+                                       collection=collection_conn,
+                                       vector_index=vector_search_index_name,
+                                       text_embedding_field=vector_embedding_field_name,
+                                       k=mmr_k,
+                                       lambda_mult=mmr_lambda,
+                                       additional_stages=additional_stages,
+                                       filters=filters)
+    else:
+        results = run_vs_for_query(query=query, db=db_conn,
+                                   collection=collection_conn,
+                                   vector_index=vector_search_index_name,
+                                   text_embedding_field=vector_embedding_field_name,
+                                   additional_stages=additional_stages,
+                                   filters=filters,
+                                   limit=limit)
+
+    # run_vs_for_query returns an error message instead of a result list when embedding fails
+    return results if isinstance(results, list) else []
+
+
+async def get_vector_search_result_for_query_async(query: str,
+                                                   db_name: str,
+                                                   collection_name: str,
+                                                   vector_search_index_name: str,
+                                                   vector_embedding_field_name: str,
+                                                   additional_stages: list = [],
+                                                   filters: dict = {},
+                                                   result_model=None,
+                                                   search_mode: str = "vector",
+                                                   text_search_index_name: str = None,
+                                                   fusion_method: str = HYBRID_FUSION_METHOD,
+                                                   mmr_k: int = None,
+                                                   mmr_lambda: float = MMR_LAMBDA,
+                                                   limit: int = 20,
+                                                   filter_fields: tuple = ()) -> list:
+    check_search_mode(search_mode, fusion_method)
+    check_mmr(search_mode, mmr_k, mmr_lambda)
+    if is_local_vector_search_backend():
+        # local search is CPU bound, keep it off the event loop
+        return await asyncio.to_thread(get_vector_search_result_for_query, query=query, db_name=db_name,
+                                       collection_name=collection_name,
+                                       vector_search_index_name=vector_search_index_name,
+                                       vector_embedding_field_name=vector_embedding_field_name,
+                                       additional_stages=additional_stages, filters=filters,
+                                       result_model=result_model, search_mode=search_mode,
+                                       text_search_index_name=text_search_index_name, fusion_method=fusion_method,
+                                       mmr_k=mmr_k, mmr_lambda=mmr_lambda, limit=limit,
+                                       filter_fields=filter_fields)
+    if filter_fields:
+        filters, additional_stages, limit = push_down_filters(filters=filters, additional_stages=additional_stages,
+                                                              filter_fields=filter_fields,
+                                                              limit=None if mmr_k else limit)
+    if result_model is not None:
+        additional_stages = additional_stages + [get_projection_stage_for_model(result_model)]
+    # merged $addFields, an early $project and no no-op stages, see pipeline_optimizer
+    additional_stages = get_optimized_stages(additional_stages)
+    db_conn, collection_conn = get_async_mongo_db_and_collection_conn(db_name=db_name,
+                                                                      collection_name=collection_name)
+    if search_mode == "hybrid":
+        results = await run_hybrid_search_for_query_async(query=query, db=db_conn,
+                                                          collection=collection_conn,
+                                                          vector_index=vector_search_index_name,
+                                                          text_search_index=text_search_index_name,
+                                                          text_embedding_field=vector_embedding_field_name,
+                                                          additional_stages=additional_stages,
+                                                          filters=filters,
+                                                          limit=limit,
+                                                          fusion_method=fusion_method)
+    elif mmr_k:
+        results = await run_mmr_vs_for_query_async(query=query, db=db_conn,
+                                                   collection=collection_conn,
+                                                   vector_index=vector_search_index_name,
+                                                   text_embedding_field=vector_embedding_field_name,
+                                                   k=mmr_k,
+                                                   lambda_mult=mmr_lambda,
+                                                   additional_stages=additional_stages,
+                                                   filters=filters)
+    else:
+        results = await run_vs_for_query_async(query=query, db=db_conn,
+                                               collection=collection_conn,
+                                               vector_index=vector_search_index_name,
+                                               text_embedding_field=vector_embedding_field_name,
+                                               additional_stages=additional_stages,
+                                               filters=filters,
+                                               limit=limit)
+
+    return results if isinstance(results, list) else []
+
+
+def get_vector_search_query_profiles(slow_only: bool = False, limit: int = None) -> list:
+    return query_profiler.get_profiles(slow_only=slow_only, limit=limit)
+
+
+def get_rag_answer_with_semantic_cache(query: str, variant: str, db_name: str, collection_name: str,
+                                       answer_fn, filters=None):
+    """
+    Returns the cached answer of a near-identical earlier query of the same variant and filters, otherwise calls
+    answer_fn() and caches its answer. answer_fn returns None when there is no answer, which is not cached.
+    """
+    cache = get_semantic_answer_cache()
+    query_embedding = get_embedding(query) if cache is not None else None
+    if query_embedding is None:
+        return answer_fn()
+
+    scope = get_semantic_cache_scope(db_name=db_name, collection_name=collection_name, variant=variant,
+                                     filters=filters)
+    answer = cache.get(query_embedding, scope)
+    if answer is not None:
+        return answer
+
+    started_at = time.perf_counter()
+    answer = answer_fn()
+    if answer is not None:
+        cache.set(query_embedding, scope, answer, latency_ms=(time.perf_counter() - started_at) * 1000)
+    return answer
 
 
 def execute_rag_for_query_based_on_context(query: str, context: str) -> str:
@@ -0,0 +1,227 @@
+"""
+Recall and latency benchmark of vector search, run by `manage.py benchmark_vector_search`.
+
+Every query of the query set runs against each backend and parameter combination (index type, filter, limit,
+numCandidates or exact); the exact top-k computed by brute force over the same vectors is the ground truth.
+    recall@k     fraction of the exact top-k returned, averaged over the queries
+    latency      p50 / p95 / p99 of the client side latency of one search, in ms
+    throughput   searches per second of a single client issuing them back to back
+
+The local backend (see local_vector_search) needs no cluster; the atlas backend searches the sample collection and
+reads the vectors for the ground truth from it. Searches bypass the result cache and the search planner, they
+measure the backend with exactly the parameters of the grid.
+"""
+import json
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from memory.mongo_db.vector_search.local_vector_search import LocalVectorCollection
+from memory.mongo_db.vector_search.vector_encoding import is_quantized_encoding, encode_vector
+from memory.mongo_db.vector_search.vector_index import recall_at_k
+
+BENCHMARK_BACKENDS = ("local", "atlas")
+BENCHMARK_DATA_SOURCES = ("huggingface", "mongo")
+
+
+def load_benchmark_documents(source: str, db_name: str, collection_name: str, limit: int) -> list:
+    if source == "huggingface":
+        from memory.mongo_db.service.mongo_sample_data_service import load_sample_data_from_huggingface
+        # the Listing model does not keep _id, give every document a stable one
+        return [{"_id": i, **doc} for i, doc in enumerate(load_sample_data_from_huggingface(limit=limit))]
+
+    from memory.mongo_db.service.mongo_service import get_mongo_db_and_collection_conn
+    _, collection = get_mongo_db_and_collection_conn(db_name=db_name, collection_name=collection_name)
+    return list(collection.find({}, limit=limit))
+
+
+def generate_queries(vectors: np.ndarray, count: int, noise: float = 0.05, seed: int = 42) -> list:
+    """
+    Query vectors near the stored ones: a random stored vector plus gaussian noise of `noise` times its norm,
+    so every query has a true neighbourhood without being an exact copy of a document.
+    """
+    rng = np.random.default_rng(seed)
+    picked = vectors[rng.choice(vectors.shape[0], size=count, replace=count > vectors.shape[0])]
+    noisy = picked + rng.normal(scale=noise / np.sqrt(vectors.shape[1]), size=picked.shape).astype(np.float32)
+    return (noisy / np.linalg.norm(noisy, axis=1, keepdims=True)).tolist()
+
+
+def load_queries(path: str) -> list:
+    """
+    Replays a query set, one JSON object per line: {"vector": [...]} as written by save_queries, or
+    {"query": "..."} which is embedded with the query embedding model.
+    """
+    from vectorizer.openai.service.openai_service import get_embedding
+    queries = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            vector = record.get("vector") or get_embedding(record["query"])
+            if vector is None:
+                print(f"Skipping query, embedding generation failed: {record.get('query')}")
+                continue
+            queries.append(vector)
+    return queries
+
+
+def save_queries(queries: list, path: str):
+    with open(path, "w") as f:
+        for vector in queries:
+            f.write(json.dumps({"vector": [float(v) for v in vector]}) + "\n")
+
+
+def get_latency_stats(latencies_ms: list) -> dict:
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99]).tolist()
+    return {"p50": p50, "p95": p95, "p99": p99, "mean": float(np.mean(latencies_ms))}
+
+
+def get_benchmark_pipeline(query_vector, vector_index: str, embedding_field: str, filters: dict, limit: int,
+                           num_candidates) -> list:
+    """num_candidates "exact" runs an exact (ENN) search."""
+    vector_search = {
+        "index": vector_index,
+        "queryVector": query_vector,
+        "path": embedding_field,
+        "limit": limit,
+    }
+    if num_candidates == "exact":
+        vector_search["exact"] = True
+    else:
+        vector_search["numCandidates"] = num_candidates
+    if filters:
+        vector_search["filter"] = filters
+    # only the ids are needed to compute the recall, do not let the transfer of documents skew the latency
+    return [{"$vectorSearch": vector_search}, {"$project": {"_id": 1}}]
+
+
+class GroundTruth:
+    """Exact top-k of each query by brute force, per filter."""
+
+    def __init__(self, documents: list, embedding_field: str):
+        self.collection = LocalVectorCollection(name="ground_truth", documents=documents,
+                                                embedding_field=embedding_field, index_type="exact")
+        # recall_at_k compares positions, Mongo ids are not integers
+        self.positions_by_id = {doc["_id"]: position for position, doc in enumerate(self.collection.documents)}
+        self._top_k = {}
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self.collection.index.vectors
+
+    def get_positions(self, documents: list) -> list:
+        return [self.positions_by_id[doc["_id"]] for doc in documents if doc.get("_id") in self.positions_by_id]
+
+    def get_top_k(self, queries: list, filters: dict, k: int) -> list:
+        key = (json.dumps(filters, sort_keys=True, default=str), k)
+        if key not in self._top_k:
+            self._top_k[key] = [
+                self.collection.index.search(np.asarray(query, dtype=np.float32), k,
+                                             mask=self.collection.filter_mask(filters))[0].tolist()
+                for query in queries]
+        return self._top_k[key]
+
+    def count_matching(self, filters: dict) -> int:
+        mask = self.collection.filter_mask(filters)
+        return len(self.positions_by_id) if mask is None else int(mask.sum())
+
+
+def run_benchmark_case(collection, ground_truth: GroundTruth, queries: list, vector_index: str,
+                       embedding_field: str, filters: dict, limit: int, num_candidates, warmup: int = 5,
+                       encode_queries: bool = False) -> dict:
+    truth = ground_truth.get_top_k(queries, filters=filters, k=limit)
+    pipelines = [get_benchmark_pipeline(query_vector=encode_vector(query) if encode_queries else query,
+                                        vector_index=vector_index, embedding_field=embedding_field,
+                                        filters=filters, limit=limit, num_candidates=num_candidates)
+                 for query in queries]
+
+    try:
+        for pipeline in pipelines[:warmup]:
+            list(collection.aggregate(pipeline))
+    except Exception as e:
+        print(f"Benchmark warmup failed: {e}")
+
+    latencies_ms, recalls, errors = [], [], 0
+    for pipeline, exact_positions in zip(pipelines, truth):
+        started_at = time.perf_counter()
+        try:
+            results = list(collection.aggregate(pipeline))
+        except Exception as e:
+            print(f"Benchmark search failed: {e}")
+            errors += 1
+            continue
+        latencies_ms.append((time.perf_counter() - started_at) * 1000)
+        recalls.append(recall_at_k(ground_truth.get_positions(results), exact_positions))
+
+    if not latencies_ms:
+        return {"errors": errors}
+    return {
+        "recall_at_k": float(np.mean(recalls)),
+        "min_recall_at_k": float(np.min(recalls)),
+        "latency_ms": get_latency_stats(latencies_ms),
+        "throughput_qps": len(latencies_ms) / (sum(latencies_ms) / 1000),
+        "errors": errors,
+    }
+
+
+def get_benchmark_targets(backends: list, index_types: list, documents: list, embedding_field: str,
+                          db_name: str, collection_name: str, vector_index: str):
+    """Yields (backend, index, collection, build_seconds) for every backend to benchmark."""
+    for backend in backends:
+        if backend == "atlas":
+            from memory.mongo_db.service.mongo_service import get_mongo_db_and_collection_conn
+            _, collection = get_mongo_db_and_collection_conn(db_name=db_name, collection_name=collection_name)
+            yield backend, vector_index, collection, None
+            continue
+        for index_type in index_types:
+            started_at = time.perf_counter()
+            collection = LocalVectorCollection(name=collection_name, documents=documents,
+                                               embedding_field=embedding_field, index_type=index_type)
+            yield backend, index_type, collection, time.perf_counter() - started_at
+
+
+def run_benchmark(documents: list, queries: list, embedding_field: str, backends: list, index_types: list,
+                  filters: list, limits: list, num_candidates: list, db_name: str = None, collection_name: str = None,
+                  vector_index: str = None, warmup: int = 5, ground_truth: GroundTruth = None) -> dict:
+    ground_truth = ground_truth or GroundTruth(documents=documents, embedding_field=embedding_field)
+    runs = []
+    targets = get_benchmark_targets(backends=backends, index_types=index_types, documents=documents,
+                                    embedding_field=embedding_field, db_name=db_name,
+                                    collection_name=collection_name, vector_index=vector_index)
+    for backend, index, collection, build_seconds in targets:
+        for case_filters in filters:
+            matching = ground_truth.count_matching(case_filters)
+            for limit in limits:
+                for candidates in num_candidates:
+                    if candidates != "exact" and candidates < limit:
+                        continue
+                    result = run_benchmark_case(collection=collection, ground_truth=ground_truth, queries=queries,
+                                                vector_index=vector_index, embedding_field=embedding_field,
+                                                filters=case_filters, limit=limit, num_candidates=candidates,
+                                                warmup=warmup,
+                                                encode_queries=backend == "atlas" and is_quantized_encoding())
+                    run = {"backend": backend, "index": index, "build_seconds": build_seconds,
+                           "filter": case_filters, "matching_documents": matching, "limit": limit,
+                           "num_candidates": candidates, **result}
+                    print(format_benchmark_run(run))
+                    runs.append(run)
+
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "documents": len(ground_truth.positions_by_id),
+        "dimensions": ground_truth.collection.dimensions,
+        "queries": len(queries),
+        "runs": runs,
+    }
+
+
+def format_benchmark_run(run: dict) -> str:
+    case = (f"{run['backend']}/{run['index']} filter={json.dumps(run['filter'], default=str)} "
+            f"limit={run['limit']} numCandidates={run['num_candidates']}")
+    if "recall_at_k" not in run:
+        return f"{case}: every search failed"
+    latency = run["latency_ms"]
+    return (f"{case}: recall@k {run['recall_at_k']:.3f}, p50 {latency['p50']:.2f}ms, p95 {latency['p95']:.2f}ms, "
+            f"p99 {latency['p99']:.2f}ms, {run['throughput_qps']:.1f} qps")
@@ -0,0 +1,125 @@
+"""
+Moves predicates of the $match stages that follow $vectorSearch into its `filter`.
+
+A $match after $vectorSearch only sees the `limit` nearest listings, so it returns fewer results than asked for and
+the candidates it drops were searched for nothing. Inside the filter the same predicate makes the search return
+`limit` listings that all match it. A predicate is pushed down when its field is a filter field of the index and
+the filter can express it:
+    equality         {"accommodates": 2}, {"$eq": ...}, {"$ne": ...}, {"$in": [...]}, {"$nin": [...]}
+    ranges           {"$gt": ...}, {"$gte": ...}, {"$lt": ...}, {"$lte": ...} on numbers and dates
+    anchored regex   re.compile(r"^United States$") becomes {"$eq": "United States"}
+Prefix and substring regexes stay in the $match: the filter has no string ranges or pattern operators.
+
+Only the leading $match stages are considered, later ones may read fields computed by the stages before them. When
+predicates stay behind, the search fetches PUSHDOWN_OVERFETCH_FACTOR times the limit and a $limit after the $match
+keeps `limit` of them, so the remaining filter still gets its `limit` results more often than not.
+"""
+import datetime
+import re
+
+from bson import ObjectId
+
+from common_utils import get_env_key
+
+# results fetched per result returned when predicates remain in the post $match
+PUSHDOWN_OVERFETCH_FACTOR = int(get_env_key('PUSHDOWN_OVERFETCH_FACTOR', '3'))
+
+EQUALITY_OPERATORS = ("$eq", "$ne")
+LIST_OPERATORS = ("$in", "$nin")
+RANGE_OPERATORS = ("$gt", "$gte", "$lt", "$lte")
+
+_REGEX_SPECIAL_CHARACTERS = set(".^$*+?{}[]\\|()")
+
+
+def _is_filter_value(value) -> bool:
+    return value is None or isinstance(value, (bool, int, float, str, ObjectId, datetime.datetime))
+
+
+def _is_range_value(value) -> bool:
+    return isinstance(value, (int, float, datetime.datetime)) and not isinstance(value, bool)
+
+
+def regex_to_equality(pattern: str, flags: int = 0):
+    """The string an anchored, literal regex matches exactly, else None."""
+    if flags & ~re.UNICODE or not (pattern.startswith("^") and pattern.endswith("$")):
+        return None
+    literal = pattern[1:-1]
+    if not literal or _REGEX_SPECIAL_CHARACTERS.intersection(literal):
+        return None
+    return literal
+
+
+def to_filter_condition(condition):
+    """The $vectorSearch filter condition equivalent to a $match condition, or None when there is none."""
+    if isinstance(condition, re.Pattern):
+        literal = regex_to_equality(condition.pattern, condition.flags)
+        return None if literal is None else {"$eq": literal}
+    if isinstance(condition, dict) and "$regex" in condition:
+        if set(condition) - {"$regex", "$options"} or condition.get("$options"):
+            return None
+        return to_filter_condition(condition["$regex"] if isinstance(condition["$regex"], re.Pattern)
+                                   else re.compile(condition["$regex"]))
+    if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+        for operator, operand in condition.items():
+            if operator in EQUALITY_OPERATORS and _is_filter_value(operand):
+                continue
+            if operator in LIST_OPERATORS and isinstance(operand, list) and all(map(_is_filter_value, operand)):
+                continue
+            if operator in RANGE_OPERATORS and _is_range_value(operand):
+                continue
+            return None
+        return condition
+    if _is_filter_value(condition):
+        return {"$eq": condition}
+    return None
+
+
+def split_match(query: dict, filter_fields: tuple) -> tuple:
+    """(predicates that can be pushed down as {field: condition}, the $match query of the rest)."""
+    pushed, remaining = [], {}
+    for key, condition in query.items():
+        if key == "$and":
+            for sub_query in condition:
+                sub_pushed, sub_remaining = split_match(sub_query, filter_fields)
+                pushed += sub_pushed
+                if sub_remaining:
+                    remaining.setdefault("$and", []).append(sub_remaining)
+            continue
+        filter_condition = to_filter_condition(condition) if key in filter_fields else None
+        if filter_condition is None:
+            remaining[key] = condition
+        else:
+            pushed.append({key: filter_condition})
+    return pushed, remaining
+
+
+def combine_filters(filters: dict, predicates: list) -> dict:
+    parts = filters["$and"] if filters and list(filters) == ["$and"] else [filters] if filters else []
+    parts = parts + predicates
+    if not parts:
+        return {}
+    return parts[0] if len(parts) == 1 else {"$and": parts}
+
+
+def push_down_filters(filters: dict, additional_stages: list, filter_fields: tuple, limit: int = None) -> tuple:
+    """
+    Returns (filters, additional_stages, limit) with the eligible predicates of the leading $match stages moved into
+    the filters. `limit` is the number of results of the search; it is raised to over-fetch when predicates remain,
+    pass None to leave it alone (the MMR search runs the leading $match stages before its selection).
+    """
+    predicates = []
+    position = 0
+    stages = []
+    while position < len(additional_stages) and "$match" in additional_stages[position]:
+        pushed, remaining = split_match(additional_stages[position]["$match"], filter_fields)
+        predicates += pushed
+        if remaining:
+            stages.append({"$match": remaining})
+        position += 1
+    if not predicates:
+        return filters, additional_stages, limit
+
+    if stages and limit is not None:
+        stages.append({"$limit": limit})
+        limit *= PUSHDOWN_OVERFETCH_FACTOR
+    return combine_filters(filters, predicates), stages + additional_stages[position:], limit
@@ -0,0 +1,420 @@
+"""
+Hierarchical Navigable Small World graph (Malkov & Yashunin) for the local vector search backend.
+
+The graph is array backed: vectors, levels and neighbour lists live in preallocated NumPy arrays that grow by doubling,
+instead of one Python object per node.
+    layer 0:      _layer0[node, :_layer0_count[node]]                  up to 2 * M neighbours
+    layers >= 1:  _upper[_upper_offset[node] + layer - 1, :count]     up to M neighbours, rows only for nodes that
+                                                                       reach that layer
+Deletes are tombstones: a deleted node keeps routing searches through the graph but is never returned.
+Searches and writes share one lock: the arrays are reallocated as the graph grows, and the beam search is bound by
+the GIL anyway.
+
+Inserts search each layer in batches (_search_layer_for_insert) and link the new node in one pass per layer, but are
+still built one vector at a time: with the default settings an insert of a 1536 dimensional vector takes about 7 ms.
+Building the graph of 100k listings takes over ten minutes, of 1M vectors about two hours, and the float32 vectors of
+1M x 1536 alone take 6 GB. Collections up to about 100k vectors are supported; larger ones are better served by the
+ivfpq index, or by the exact index with a pre-filter.
+
+The build is paid once: the graph is saved under HNSW_GRAPH_DIR (save/load) and LocalVectorCollection syncs a loaded
+graph with the collection, inserting only new or changed documents. Recall is checked by memory/tests/test_hnsw_index.
+"""
+import heapq
+import json
+import math
+import os
+import threading
+
+import numpy as np
+
+from common_utils import get_env_key
+from memory.mongo_db.vector_search.vector_index import normalise_rows, top_k, grow_rows, get_allowed_positions
+
+HNSW_M = int(get_env_key('HNSW_M', '16'))
+HNSW_EF_CONSTRUCTION = int(get_env_key('HNSW_EF_CONSTRUCTION', '200'))
+HNSW_EF_SEARCH = int(get_env_key('HNSW_EF_SEARCH', '64'))
+# filters that leave at most this many vectors are answered exactly, the graph gives poor recall for them
+HNSW_BRUTE_FORCE_THRESHOLD = int(get_env_key('HNSW_BRUTE_FORCE_THRESHOLD', '10000'))
+# nodes an insert expands per step of its layer search, see _search_layer_for_insert
+HNSW_INSERT_EXPANSION_BATCH = int(get_env_key('HNSW_INSERT_EXPANSION_BATCH', '16'))
+# graphs of the local backend are saved here, one file per database, collection and dimensions, and loaded on the
+# next start instead of being built again; empty disables saving them
+HNSW_GRAPH_DIR = get_env_key('HNSW_GRAPH_DIR', 'hnsw_graphs')
+
+
+class HNSWVectorIndex:
+
+    def __init__(self, dimensions: int,
+                 m: int = HNSW_M,
+                 ef_construction: int = HNSW_EF_CONSTRUCTION,
+                 ef_search: int = HNSW_EF_SEARCH,
+                 brute_force_threshold: int = HNSW_BRUTE_FORCE_THRESHOLD,
+                 expansion_batch: int = HNSW_INSERT_EXPANSION_BATCH,
+                 seed: int = 42):
+        self.dimensions = dimensions
+        self.m = m
+        self.m0 = 2 * m
+        self.ef_construction = max(ef_construction, m)
+        self.ef_search = ef_search
+        self.brute_force_threshold = brute_force_threshold
+        self.expansion_batch = max(expansion_batch, 1)
+        self._level_multiplier = 1 / math.log(m)
+        self._rng = np.random.default_rng(seed)
+
+        self.size = 0
+        self.entry_point = -1
+        self.max_level = -1
+
+        self._vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self._levels = np.zeros(0, dtype=np.int8)
+        self._deleted = np.zeros(0, dtype=bool)
+        self._layer0 = np.zeros((0, self.m0), dtype=np.int32)
+        self._layer0_count = np.zeros(0, dtype=np.int32)
+        self._upper_offset = np.zeros(0, dtype=np.int64)
+        self._upper = np.zeros((0, m), dtype=np.int32)
+        self._upper_count = np.zeros(0, dtype=np.int32)
+        self._upper_rows = 0
+
+        self._lock = threading.Lock()
+        self._visit_marks = np.zeros(0, dtype=np.int32)
+        # scratch space of _search_layer_for_insert
+        self._visit_slots = np.zeros(0, dtype=np.int64)
+        self._visit_tag = 0
+        # JSON metadata saved with the graph, see save()
+        self.metadata = {}
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[:self.size]
+
+    def get_vectors(self, positions) -> np.ndarray:
+        return self._vectors[np.asarray(positions, dtype=np.int64)]
+
+    # neighbour list storage
+
+    def _neighbors(self, node: int, layer: int) -> np.ndarray:
+        if layer == 0:
+            return self._layer0[node, :self._layer0_count[node]]
+        row = self._upper_offset[node] + layer - 1
+        return self._upper[row, :self._upper_count[row]]
+
+    def _set_neighbors(self, node: int, layer: int, neighbors: np.ndarray):
+        if layer == 0:
+            self._layer0[node, :len(neighbors)] = neighbors
+            self._layer0_count[node] = len(neighbors)
+        else:
+            row = self._upper_offset[node] + layer - 1
+            self._upper[row, :len(neighbors)] = neighbors
+            self._upper_count[row] = len(neighbors)
+
+    def _reserve(self, node: int, level: int):
+        self._vectors = grow_rows(self._vectors, node + 1)
+        self._levels = grow_rows(self._levels, node + 1)
+        self._deleted = grow_rows(self._deleted, node + 1, fill_value=False)
+        self._layer0 = grow_rows(self._layer0, node + 1, fill_value=-1)
+        self._layer0_count = grow_rows(self._layer0_count, node + 1)
+        self._upper_offset = grow_rows(self._upper_offset, node + 1, fill_value=-1)
+        if level > 0:
+            self._upper_offset[node] = self._upper_rows
+            self._upper_rows += level
+            self._upper = grow_rows(self._upper, self._upper_rows, fill_value=-1)
+            self._upper_count = grow_rows(self._upper_count, self._upper_rows)
+
+    # search
+
+    def _visited_array(self):
+        """Visit marks; a fresh tag per layer search avoids clearing the array."""
+        if self._visit_marks.shape[0] < self._vectors.shape[0]:
+            self._visit_marks = np.zeros(self._vectors.shape[0], dtype=np.int32)
+            self._visit_slots = np.zeros(self._vectors.shape[0], dtype=np.int64)
+            self._visit_tag = 0
+        self._visit_tag += 1
+        if self._visit_tag == np.iinfo(np.int32).max:
+            self._visit_marks[:] = 0
+            self._visit_tag = 1
+        return self._visit_marks, self._visit_tag
+
+    def _search_layer(self, query: np.ndarray, entry_points: np.ndarray, ef: int, layer: int,
+                      allowed: np.ndarray = None):
+        """Best-first beam search of one layer; returns (nodes, similarities) best first, at most ef of them."""
+        marks, tag = self._visited_array()
+        marks[entry_points] = tag
+        entry_similarities = self._vectors[entry_points] @ query
+
+        candidates = [(-s, n) for n, s in zip(entry_points.tolist(), entry_similarities.tolist())]
+        heapq.heapify(candidates)
+        results = [(s, n) for n, s in zip(entry_points.tolist(), entry_similarities.tolist())
+                   if allowed is None or allowed[n]]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            negative_similarity, node = heapq.heappop(candidates)
+            if len(results) >= ef and -negative_similarity < results[0][0]:
+                break
+            neighbors = self._neighbors(node, layer)
+            neighbors = neighbors[marks[neighbors] != tag]
+            if neighbors.size == 0:
+                continue
+            marks[neighbors] = tag
+            similarities = self._vectors[neighbors] @ query
+            if len(results) >= ef:
+                keep = similarities > results[0][0]
+                neighbors, similarities = neighbors[keep], similarities[keep]
+            for neighbor, similarity in zip(neighbors.tolist(), similarities.tolist()):
+                if len(results) < ef or similarity > results[0][0]:
+                    heapq.heappush(candidates, (-similarity, neighbor))
+                    if allowed is None or allowed[neighbor]:
+                        heapq.heappush(results, (similarity, neighbor))
+                        if len(results) > ef:
+                            heapq.heappop(results)
+
+        results.sort(reverse=True)
+        nodes = np.fromiter((n for _, n in results), dtype=np.int64, count=len(results))
+        similarities = np.fromiter((s for s, _ in results), dtype=np.float32, count=len(results))
+        return nodes, similarities
+
+    def _neighbors_of(self, nodes: np.ndarray, layer: int) -> np.ndarray:
+        """The neighbours of all the nodes, concatenated."""
+        if layer == 0:
+            lists, counts = self._layer0[nodes], self._layer0_count[nodes]
+        else:
+            rows = self._upper_offset[nodes] + layer - 1
+            lists, counts = self._upper[rows], self._upper_count[rows]
+        return lists[np.arange(lists.shape[1]) < counts[:, None]]
+
+    def _search_layer_for_insert(self, query: np.ndarray, entry_points: np.ndarray, ef: int, layer: int):
+        """
+        _search_layer for construction, on arrays instead of heaps: every step expands the best
+        HNSW_INSERT_EXPANSION_BATCH unexpanded results at once and scores all their neighbours in one product.
+        With a batch of 1 it visits the same nodes as _search_layer.
+        """
+        marks, tag = self._visited_array()
+        marks[entry_points] = tag
+        nodes = entry_points.astype(np.int64)
+        similarities = self._vectors[nodes] @ query
+        expanded = np.zeros(len(nodes), dtype=bool)
+        while True:
+            # results are kept best first, so the first unexpanded ones are the best candidates
+            unexpanded = np.flatnonzero(~expanded)[:self.expansion_batch]
+            if unexpanded.size == 0:
+                break
+            expanded[unexpanded] = True
+            neighbors = self._neighbors_of(nodes[unexpanded], layer)
+            neighbors = neighbors[marks[neighbors] != tag]
+            if neighbors.size == 0:
+                continue
+            # drop neighbours shared by several expanded nodes: of repeated writes to a slot only the last one sticks
+            positions = np.arange(neighbors.size)
+            self._visit_slots[neighbors] = positions
+            neighbors = neighbors[self._visit_slots[neighbors] == positions]
+            marks[neighbors] = tag
+            neighbor_similarities = self._vectors[neighbors] @ query
+            if len(nodes) >= ef:
+                keep = neighbor_similarities > similarities[-1]
+                neighbors, neighbor_similarities = neighbors[keep], neighbor_similarities[keep]
+                if neighbors.size == 0:
+                    continue
+            nodes = np.concatenate((nodes, neighbors))
+            similarities = np.concatenate((similarities, neighbor_similarities))
+            expanded = np.concatenate((expanded, np.zeros(len(neighbors), dtype=bool)))
+            order = np.argsort(-similarities, kind="stable")[:ef]
+            nodes, similarities, expanded = nodes[order], similarities[order], expanded[order]
+        return nodes, similarities
+
+    def _descend(self, query: np.ndarray, to_layer: int) -> np.ndarray:
+        """Greedy search from the entry point down to `to_layer`, returning the entry points for that layer."""
+        entry_points = np.array([self.entry_point], dtype=np.int64)
+        for layer in range(self.max_level, to_layer, -1):
+            entry_points, _ = self._search_layer(query, entry_points, 1, layer)
+        return entry_points
+
+    def search(self, query_vector: np.ndarray, k: int, mask: np.ndarray = None, exact: bool = False,
+               ef: int = None):
+        if self.size == 0 or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        with self._lock:
+            return self._search(query_vector, k, mask=mask, exact=exact, ef=ef)
+
+    def _search(self, query_vector: np.ndarray, k: int, mask: np.ndarray = None, exact: bool = False,
+                ef: int = None):
+        allowed = get_allowed_positions(self._deleted, self.size, mask)
+        allowed_count = int(allowed.sum())
+        if exact or allowed_count <= max(k, self.brute_force_threshold):
+            # selective filter: exact search over the few allowed vectors is cheaper and exact
+            positions = np.flatnonzero(allowed)
+            best, similarities = top_k(self._vectors[positions] @ query_vector, k)
+            return positions[best], similarities
+
+        ef = max(ef or self.ef_search, k)
+        entry_points = self._descend(query_vector, 0)
+        nodes, similarities = self._search_layer(query_vector, entry_points, ef, 0, allowed=allowed)
+        return nodes[:k], similarities[:k]
+
+    # construction
+
+    def _select_neighbors(self, base: np.ndarray, candidates: np.ndarray, similarities: np.ndarray,
+                          count: int, pairwise: np.ndarray = None) -> np.ndarray:
+        """
+        Neighbour selection heuristic: keep a candidate only if it is closer to the base than to every neighbour
+        already kept, which spreads links in different directions. Free slots are topped up with the closest
+        pruned candidates. `candidates` must be sorted best first; `pairwise` optionally holds their similarities
+        to each other, otherwise only the rows of the selected candidates are computed.
+        """
+        if len(candidates) <= count:
+            return candidates
+        candidate_vectors = self._vectors[candidates] if pairwise is None else None
+        # closest_selected[i]: similarity of candidate i to its most similar already selected neighbour
+        closest_selected = np.full(len(candidates), -np.inf, dtype=np.float32)
+        selected = []
+        for i, similarity in enumerate(similarities.tolist()):
+            if closest_selected[i] < similarity:
+                selected.append(i)
+                if len(selected) == count:
+                    break
+                row = pairwise[i] if pairwise is not None else candidate_vectors @ candidate_vectors[i]
+                np.maximum(closest_selected, row, out=closest_selected)
+        if len(selected) < count:
+            chosen = set(selected)
+            selected += [i for i in range(len(candidates)) if i not in chosen][:count - len(selected)]
+        return candidates[selected]
+
+    def _link(self, nodes: np.ndarray, new_neighbor: int, layer: int):
+        """Adds new_neighbor to the neighbour lists of all the nodes, re-selecting the lists that are full."""
+        capacity = self.m0 if layer == 0 else self.m
+        if layer == 0:
+            lists, counts, rows = self._layer0, self._layer0_count, nodes
+        else:
+            lists, counts, rows = self._upper, self._upper_count, self._upper_offset[nodes] + layer - 1
+        free = counts[rows] < capacity
+        lists[rows[free], counts[rows[free]]] = new_neighbor
+        counts[rows[free]] += 1
+
+        full_rows = rows[~free]
+        if full_rows.size == 0:
+            return
+        candidates = np.concatenate((lists[full_rows], np.full((full_rows.size, 1), new_neighbor, dtype=lists.dtype)),
+                                    axis=1).astype(np.int64)
+        full = nodes[~free]
+        # the similarities of every full node to its candidates and of the candidates to each other, in two products
+        candidate_vectors = self._vectors[candidates]
+        similarities = np.einsum("ncd,nd->nc", candidate_vectors, self._vectors[full])
+        pairwise = candidate_vectors @ candidate_vectors.transpose(0, 2, 1)
+        order = np.argsort(-similarities, axis=1)
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        similarities = np.take_along_axis(similarities, order, axis=1)
+        pairwise = pairwise[np.arange(full.size)[:, None, None], order[:, :, None], order[:, None, :]]
+        for i, node in enumerate(full.tolist()):
+            self._set_neighbors(node, layer, self._select_neighbors(self._vectors[node], candidates[i],
+                                                                    similarities[i], capacity, pairwise[i]))
+
+    def _insert(self, vector: np.ndarray) -> int:
+        node = self.size
+        level = min(int(-math.log(1 - self._rng.random()) * self._level_multiplier), 32)
+        self._reserve(node, level)
+        self._vectors[node] = vector
+        self._levels[node] = level
+
+        if self.entry_point < 0:
+            self.size += 1
+            self.entry_point, self.max_level = node, level
+            return node
+
+        entry_points = self._descend(vector, level)
+        for layer in range(min(level, self.max_level), -1, -1):
+            candidates, similarities = self._search_layer_for_insert(vector, entry_points, self.ef_construction,
+                                                                     layer)
+            neighbors = self._select_neighbors(vector, candidates, similarities, self.m)
+            self._set_neighbors(node, layer, neighbors)
+            self._link(neighbors, node, layer)
+            entry_points = candidates
+
+        self.size += 1
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+        return node
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = normalise_rows(vectors)
+        with self._lock:
+            return np.array([self._insert(v) for v in vectors], dtype=np.int64)
+
+    def delete(self, positions):
+        with self._lock:
+            self._deleted[np.asarray(positions, dtype=np.int64)] = True
+
+    # persistence
+
+    def save(self, path: str, metadata: dict = None):
+        """
+        Saves the graph to `path` (.npz) with JSON `metadata`, e.g. the documents of the positions. The file is written
+        next to `path` and renamed over it, so a process loading it never sees half of it.
+        """
+        params = {"dimensions": self.dimensions, "m": self.m, "ef_construction": self.ef_construction,
+                  "ef_search": self.ef_search, "brute_force_threshold": self.brute_force_threshold,
+                  "expansion_batch": self.expansion_batch}
+        with self._lock:
+            graph = {"entry_point": self.entry_point, "max_level": self.max_level}
+            arrays = {"vectors": self._vectors[:self.size], "levels": self._levels[:self.size],
+                      "deleted": self._deleted[:self.size], "layer0": self._layer0[:self.size],
+                      "layer0_count": self._layer0_count[:self.size], "upper_offset": self._upper_offset[:self.size],
+                      "upper": self._upper[:self._upper_rows], "upper_count": self._upper_count[:self._upper_rows]}
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            with open(temporary_path, "wb") as f:
+                np.savez(f, params=np.array(json.dumps(params)), graph=np.array(json.dumps(graph)),
+                         metadata=np.array(json.dumps(metadata or {})), **arrays)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path: str, **overrides):
+        """
+        Loads a graph saved with save(); search parameters such as ef_search can be overridden. The saved metadata is
+        in `metadata` of the index.
+        """
+        with np.load(path) as saved:
+            index = cls(**{**json.loads(str(saved["params"])), **overrides})
+            graph = json.loads(str(saved["graph"]))
+            index.metadata = json.loads(str(saved["metadata"]))
+            index.entry_point, index.max_level = graph["entry_point"], graph["max_level"]
+            index._vectors = saved["vectors"]
+            index._levels = saved["levels"]
+            index._deleted = saved["deleted"]
+            index._layer0 = saved["layer0"]
+            index._layer0_count = saved["layer0_count"]
+            index._upper_offset = saved["upper_offset"]
+            index._upper = saved["upper"]
+            index._upper_count = saved["upper_count"]
+        index.size = index._vectors.shape[0]
+        index._upper_rows = index._upper.shape[0]
+        return index
+
+
+def get_graph_path(db_name: str, collection_name: str, dimensions: int) -> str:
+    return os.path.join(HNSW_GRAPH_DIR, f"{db_name}.{collection_name}.{dimensions}d.npz")
+
+
+def create_hnsw_vector_index(dimensions: int, db_name: str = None, collection_name: str = None) -> HNSWVectorIndex:
+    """
+    HNSW index configured from the environment, starting from the graph saved for the collection when it was built
+    with the same dimensions, M and efConstruction. Indexes without a database and collection always start empty.
+    """
+    if not (HNSW_GRAPH_DIR and db_name and collection_name):
+        return HNSWVectorIndex(dimensions=dimensions)
+    graph_path = get_graph_path(db_name, collection_name, dimensions)
+    try:
+        index = HNSWVectorIndex.load(graph_path, ef_search=HNSW_EF_SEARCH,
+                                     brute_force_threshold=HNSW_BRUTE_FORCE_THRESHOLD,
+                                     expansion_batch=HNSW_INSERT_EXPANSION_BATCH)
+    except FileNotFoundError:
+        return HNSWVectorIndex(dimensions=dimensions)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Loading the HNSW graph {graph_path} failed, building it again: {e}")
+        return HNSWVectorIndex(dimensions=dimensions)
+    built = (index.dimensions, index.m, index.ef_construction)
+    configured = (dimensions, HNSW_M, max(HNSW_EF_CONSTRUCTION, HNSW_M))
+    if built != configured:
+        print(f"Rebuilding the HNSW graph, {graph_path} was built with (dimensions, M, efConstruction) {built}, "
+              f"not {configured}")
+        return HNSWVectorIndex(dimensions=dimensions)
+    return index
@@ -0,0 +1,300 @@
+"""
+Hybrid retrieval: an Atlas Search ($search) text query and the $vectorSearch query run concurrently and their ranked
+results are fused into one list.
+
+Fusion methods:
+    rrf       reciprocal rank fusion, sum over the result lists of weight / (HYBRID_RRF_K + rank)
+    weighted  sum of the min-max normalised scores of each list, times its weight
+
+The additional stages run on the fused results in-process (see local_pipeline), {"$meta": "vectorSearchScore"} and
+{"$meta": "searchScore"} resolving to the fused score. Each query returns only the fields those stages read, plus _id
+and its score for the fusion. When the text query fails, e.g. because the text search index does not exist, the
+vector results are used alone. The local vector search backend has no $search, hybrid search is rejected there.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo.operations import SearchIndexModel
+
+from common_utils import get_env_key
+from memory.mongo_db.vector_search.local_pipeline import run_pipeline
+from memory.mongo_db.vector_search.local_vector_search import is_local_vector_search_backend
+from memory.mongo_db.vector_search.mongo_vector_search import get_pipeline_for_query_embedding, profile_query, \
+    profile_query_async
+from memory.mongo_db.vector_search.pipeline_optimizer import WHOLE_DOCUMENT, get_paths_needed_by_stages, \
+    get_projection_for_paths
+from memory.mongo_db.vector_search.result_cache import get_vector_search_result_cache, get_collection_namespace, \
+    get_vector_search_cache_key
+from memory.mongo_db.vector_search.search_planner import plan_vector_search, plan_vector_search_async
+from memory.mongo_db.vector_search.vector_encoding import is_quantized_encoding, rescore_with_full_precision, \
+    get_full_precision_field_name
+from vectorizer.openai.service.openai_service import get_embedding, get_embedding_async
+
+SEARCH_MODES = ("vector", "hybrid")
+FUSION_METHODS = ("rrf", "weighted")
+
+HYBRID_FUSION_METHOD = get_env_key('HYBRID_FUSION_METHOD', 'rrf')
+HYBRID_RRF_K = int(get_env_key('HYBRID_RRF_K', '60'))
+# weight of the vector results; the text results get 1 - HYBRID_VECTOR_WEIGHT
+HYBRID_VECTOR_WEIGHT = float(get_env_key('HYBRID_VECTOR_WEIGHT', '0.5'))
+# results fetched from each of the two queries before fusion
+HYBRID_CANDIDATE_LIMIT = int(get_env_key('HYBRID_CANDIDATE_LIMIT', '50'))
+# fields of the text query, comma separated
+TEXT_SEARCH_FIELDS = tuple(get_env_key('TEXT_SEARCH_FIELDS', 'name,summary,description,amenities').split(","))
+
+# document field the stages put the score of each query into before fusion
+BRANCH_SCORE_FIELD_NAME = "_branch_score"
+
+# runs the text queries while the calling thread runs the vector query
+_text_search_executor = ThreadPoolExecutor(thread_name_prefix="hybrid-text-search")
+
+
+def check_search_mode(search_mode: str, fusion_method: str = HYBRID_FUSION_METHOD):
+    if search_mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode '{search_mode}', expected one of {SEARCH_MODES}")
+    if fusion_method not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method '{fusion_method}', expected one of {FUSION_METHODS}")
+    if search_mode == "hybrid" and is_local_vector_search_backend():
+        raise ValueError("Hybrid search needs Atlas Search, the local vector search backend only runs $vectorSearch")
+
+
+def get_text_search_index_model(text_search_index_name: str, fields: tuple = TEXT_SEARCH_FIELDS):
+    return SearchIndexModel(
+        definition={
+            "mappings": {
+                "dynamic": False,
+                # string fields are analysed with the standard analyzer; arrays of strings (amenities) as well
+                "fields": {field_name: {"type": "string"} for field_name in fields},
+            }
+        },
+        name=text_search_index_name,
+    )
+
+
+def _get_unset_stage(text_embedding_field: str) -> dict:
+    return {"$unset": [text_embedding_field, get_full_precision_field_name(text_embedding_field)]}
+
+
+def get_branch_stages(additional_stages: list, text_embedding_field: str, score_meta: str) -> list:
+    """
+    Last stages of the text and the vector query: the branch score and, projected on the server, the fields the
+    additional stages read after the fusion plus _id, which the fusion matches documents by. When those stages need
+    whole documents, the documents are returned without their embeddings.
+    """
+    branch_score = {BRANCH_SCORE_FIELD_NAME: {"$meta": score_meta}}
+    needed = get_paths_needed_by_stages(additional_stages)
+    if needed is WHOLE_DOCUMENT:
+        return [{"$addFields": branch_score}, _get_unset_stage(text_embedding_field)]
+    return [{"$project": {**get_projection_for_paths(needed | {"_id"})["$project"], **branch_score}}]
+
+
+def get_text_search_pipeline(query: str,
+                             text_search_index: str,
+                             text_embedding_field: str,
+                             fields: tuple = TEXT_SEARCH_FIELDS,
+                             filters: dict = {},
+                             limit: int = HYBRID_CANDIDATE_LIMIT,
+                             additional_stages: list = []) -> list:
+    pipeline = [{"$search": {"index": text_search_index, "text": {"query": query, "path": list(fields)}}}]
+    if filters:
+        # the $vectorSearch pre filter, applied to the text results so both lists cover the same listings
+        pipeline.append({"$match": filters})
+    pipeline.append({"$limit": limit})
+    return pipeline + get_branch_stages(additional_stages=additional_stages, text_embedding_field=text_embedding_field,
+                                        score_meta="searchScore")
+
+
+def get_hybrid_vector_pipeline(query_embedding: list,
+                               vector_index: str,
+                               text_embedding_field: str,
+                               filters: dict = {},
+                               limit: int = HYBRID_CANDIDATE_LIMIT,
+                               additional_stages: list = []) -> list:
+    """additional_stages: the stages run on the fused results, they decide which fields are fetched."""
+    # quantized searches only take the fields of these stages and are scored by rescore_with_full_precision instead
+    return get_pipeline_for_query_embedding(
+        query_embedding=query_embedding,
+        vector_index=vector_index,
+        text_embedding_field=text_embedding_field,
+        additional_stages=get_branch_stages(additional_stages=additional_stages,
+                                            text_embedding_field=text_embedding_field,
+                                            score_meta="vectorSearchScore"),
+        filters=filters,
+        limit=limit)
+
+
+def _get_ranked_rows(results: list) -> list:
+    return [(doc, doc.pop(BRANCH_SCORE_FIELD_NAME, 0.0)) for doc in results]
+
+
+def get_ranked_vector_rows(results: list, query_embedding: list, text_embedding_field: str, limit: int) -> list:
+    if is_quantized_encoding():
+        return rescore_with_full_precision(documents=results, query_vector=query_embedding,
+                                           vector_embedding_field_name=text_embedding_field, limit=limit)
+    return _get_ranked_rows(results)
+
+
+def fuse_ranked_results(ranked_lists: list, weights: list, fusion_method: str = HYBRID_FUSION_METHOD,
+                        rrf_k: int = HYBRID_RRF_K, limit: int = 20) -> list:
+    """
+    Fuses lists of (document, score) pairs, each best first, into the best `limit` (document, fused score) pairs.
+    Documents are matched by _id; the first list's copy of a document is kept.
+    """
+    documents = {}
+    fused_scores = {}
+    for rows, weight in zip(ranked_lists, weights):
+        if not rows:
+            continue
+        if fusion_method == "weighted":
+            scores = [score for _, score in rows]
+            low, high = min(scores), max(scores)
+            contributions = [weight * ((score - low) / (high - low) if high > low else 1.0) for score in scores]
+        else:
+            contributions = [weight / (rrf_k + rank) for rank in range(1, len(rows) + 1)]
+        for (doc, _), contribution in zip(rows, contributions):
+            documents.setdefault(doc["_id"], doc)
+            fused_scores[doc["_id"]] = fused_scores.get(doc["_id"], 0.0) + contribution
+
+    ranked_ids = sorted(fused_scores, key=fused_scores.get, reverse=True)[:limit]
+    return [(documents[_id], fused_scores[_id]) for _id in ranked_ids]
+
+
+def get_hybrid_cache_key(cache, db, collection, vector_pipeline: list, text_pipeline: list, additional_stages: list,
+                         fusion_method: str, vector_weight: float, limit: int, generation: int = None) -> str:
+    """generation is the collection's, read with cache.get_generation when not given (coroutines await it)."""
+    namespace = get_collection_namespace(db, collection)
+    if generation is None:
+        generation = cache.get_generation(namespace)
+    fusion = {"$fusion": {"method": fusion_method, "rrf_k": HYBRID_RRF_K, "vector_weight": vector_weight,
+                          "limit": limit}}
+    return get_vector_search_cache_key(namespace=namespace, pipeline=vector_pipeline + text_pipeline + [fusion],
+                                       additional_stages=additional_stages, generation=generation)
+
+
+def _run_text_search(collection, text_pipeline: list) -> list:
+    try:
+        return _get_ranked_rows(list(collection.aggregate(text_pipeline)))
+    except Exception as e:
+        print(f"Text search failed, using the vector results only: {e}")
+        return []
+
+
+def run_hybrid_search_for_query(db, collection,
+                                query: str,
+                                vector_index: str,
+                                text_search_index: str,
+                                text_embedding_field: str,
+                                additional_stages: list = [],
+                                filters: dict = {},
+                                limit: int = 20,
+                                fusion_method: str = HYBRID_FUSION_METHOD,
+                                vector_weight: float = HYBRID_VECTOR_WEIGHT,
+                                candidate_limit: int = HYBRID_CANDIDATE_LIMIT):
+    """
+    Hybrid counterpart of run_vs_for_query: runs the text query on a worker thread while this thread runs the
+    vector query, fuses both and applies the additional stages to the fused `limit` best.
+    """
+    query_embedding = get_embedding(query)
+
+    if query_embedding is None:
+        return "Invalid query or embedding generation failed."
+
+    candidate_limit = max(candidate_limit, limit)
+    vector_pipeline = get_hybrid_vector_pipeline(query_embedding=query_embedding, vector_index=vector_index,
+                                                 text_embedding_field=text_embedding_field, filters=filters,
+                                                 limit=candidate_limit, additional_stages=additional_stages)
+    vector_pipeline = plan_vector_search(db=db, collection=collection, pipeline=vector_pipeline)
+    text_pipeline = get_text_search_pipeline(query=query, text_search_index=text_search_index,
+                                             text_embedding_field=text_embedding_field, filters=filters,
+                                             limit=candidate_limit, additional_stages=additional_stages)
+
+    def search():
+        print("Execute the hybrid search")
+        text_rows = _text_search_executor.submit(_run_text_search, collection, text_pipeline)
+
+        started_at = time.perf_counter()
+        vector_results = list(collection.aggregate(vector_pipeline))
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        profile_query(db=db, collection=collection, pipeline=vector_pipeline, elapsed_ms=elapsed_ms)
+
+        vector_rows = get_ranked_vector_rows(results=vector_results, query_embedding=query_embedding,
+                                             text_embedding_field=text_embedding_field, limit=candidate_limit)
+        rows = fuse_ranked_results([vector_rows, text_rows.result()], weights=[vector_weight, 1 - vector_weight],
+                                   fusion_method=fusion_method, limit=limit)
+        return run_pipeline(rows, additional_stages)
+
+    cache = get_vector_search_result_cache()
+    if cache is None:
+        return search()
+    cache_key = get_hybrid_cache_key(cache, db=db, collection=collection, vector_pipeline=vector_pipeline,
+                                     text_pipeline=text_pipeline, additional_stages=additional_stages,
+                                     fusion_method=fusion_method, vector_weight=vector_weight, limit=limit)
+    return cache.get_or_compute(cache_key, search)
+
+
+async def _run_text_search_async(collection, text_pipeline: list) -> list:
+    try:
+        cursor = await collection.aggregate(text_pipeline)
+        return _get_ranked_rows(await cursor.to_list())
+    except Exception as e:
+        print(f"Text search failed, using the vector results only: {e}")
+        return []
+
+
+async def run_hybrid_search_for_query_async(db, collection,
+                                            query: str,
+                                            vector_index: str,
+                                            text_search_index: str,
+                                            text_embedding_field: str,
+                                            additional_stages: list = [],
+                                            filters: dict = {},
+                                            limit: int = 20,
+                                            fusion_method: str = HYBRID_FUSION_METHOD,
+                                            vector_weight: float = HYBRID_VECTOR_WEIGHT,
+                                            candidate_limit: int = HYBRID_CANDIDATE_LIMIT):
+    """Coroutine version of run_hybrid_search_for_query. `db` and `collection` come from AsyncMongoConnection."""
+    query_embedding = await get_embedding_async(query)
+
+    if query_embedding is None:
+        return "Invalid query or embedding generation failed."
+
+    candidate_limit = max(candidate_limit, limit)
+    vector_pipeline = get_hybrid_vector_pipeline(query_embedding=query_embedding, vector_index=vector_index,
+                                                 text_embedding_field=text_embedding_field, filters=filters,
+                                                 limit=candidate_limit, additional_stages=additional_stages)
+    vector_pipeline = await plan_vector_search_async(db=db, collection=collection, pipeline=vector_pipeline)
+    text_pipeline = get_text_search_pipeline(query=query, text_search_index=text_search_index,
+                                             text_embedding_field=text_embedding_field, filters=filters,
+                                             limit=candidate_limit, additional_stages=additional_stages)
+
+    cache = get_vector_search_result_cache()
+    if cache is not None:
+        generation = await cache.get_generation_async(get_collection_namespace(db, collection))
+        cache_key = get_hybrid_cache_key(cache, db=db, collection=collection, vector_pipeline=vector_pipeline,
+                                         text_pipeline=text_pipeline, additional_stages=additional_stages,
+                                         fusion_method=fusion_method, vector_weight=vector_weight, limit=limit,
+                                         generation=generation)
+        results = cache.get(cache_key)
+        if results is not None:
+            return results
+    print("Execute the hybrid search")
+
+    async def vector_search():
+        started_at = time.perf_counter()
+        cursor = await collection.aggregate(vector_pipeline)
+        results = await cursor.to_list()
+        await profile_query_async(db=db, collection=collection, pipeline=vector_pipeline,
+                                  elapsed_ms=(time.perf_counter() - started_at) * 1000)
+        return results
+
+    vector_results, text_rows = await asyncio.gather(vector_search(),
+                                                     _run_text_search_async(collection, text_pipeline))
+    vector_rows = get_ranked_vector_rows(results=vector_results, query_embedding=query_embedding,
+                                         text_embedding_field=text_embedding_field, limit=candidate_limit)
+    rows = fuse_ranked_results([vector_rows, text_rows], weights=[vector_weight, 1 - vector_weight],
+                               fusion_method=fusion_method, limit=limit)
+    results = run_pipeline(rows, additional_stages)
+    if cache is not None:
+        cache.set(cache_key, results)
+    return results
@@ -0,0 +1,354 @@
+"""
+Inverted file index with product quantization (Jégou et al.) for the local vector search backend.
+
+    coarse quantizer   nlist k-means centroids; every vector is filed under its nearest centroid
+    product quantizer  the residual (vector - centroid) is split into m sub-vectors, each replaced by the id of the
+                       nearest of 2**nbits sub-centroids, so a 1536 float32 vector (6 KB) is stored in m bytes
+    search             the nprobe lists nearest to the query are scanned with asymmetric distance: one (m, 2**nbits)
+                       lookup table of query-to-sub-centroid distances per list, summed over each code
+Optionally the best candidates are re-ranked exactly against full vectors. Those are appended to a file in
+IVFPQ_RERANK_VECTORS_DIR and memory-mapped, so only the pages of the shortlisted vectors are read into RAM.
+"""
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from common_utils import get_env_key
+from memory.mongo_db.vector_search.vector_index import normalise_rows, top_k, grow_rows, get_allowed_positions
+
+IVFPQ_NLIST = int(get_env_key('IVFPQ_NLIST', '1024'))
+IVFPQ_NPROBE = int(get_env_key('IVFPQ_NPROBE', '16'))
+IVFPQ_M = int(get_env_key('IVFPQ_M', '96'))
+IVFPQ_NBITS = int(get_env_key('IVFPQ_NBITS', '8'))
+# re-rank this many times k candidates against the full vectors; 0 keeps only the compressed codes
+IVFPQ_RERANK_FACTOR = int(get_env_key('IVFPQ_RERANK_FACTOR', '4'))
+# trained quantizers are saved here after the first training, one file per database, collection and dimensions,
+# and reused on the next load; empty disables saving them
+IVFPQ_TRAINING_DIR = get_env_key('IVFPQ_TRAINING_DIR', 'ivfpq_quantizers')
+# saved quantizers are retrained once the collection has grown to more than this many times their training set
+IVFPQ_RETRAIN_GROWTH = float(get_env_key('IVFPQ_RETRAIN_GROWTH', '4'))
+# directory of the memory-mapped re-rank vectors, the system temp directory when empty
+IVFPQ_RERANK_VECTORS_DIR = get_env_key('IVFPQ_RERANK_VECTORS_DIR', '')
+
+# number of vectors k-means trains on per centroid, as a sample of the data
+_KMEANS_POINTS_PER_CENTROID = 256
+_ASSIGN_CHUNK_ROWS = 65536
+
+
+def assign_to_nearest(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the nearest centroid (L2) for every row, computed in chunks to bound memory."""
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignment = np.empty(data.shape[0], dtype=np.int64)
+    for start in range(0, data.shape[0], _ASSIGN_CHUNK_ROWS):
+        chunk = data[start:start + _ASSIGN_CHUNK_ROWS]
+        # ||x - c||^2 without the ||x||^2 term, which does not change the argmin
+        assignment[start:start + chunk.shape[0]] = np.argmin(centroid_norms - 2 * chunk @ centroids.T, axis=1)
+    return assignment
+
+
+def kmeans(data: np.ndarray, k: int, iterations: int = 20, rng: np.random.Generator = None) -> np.ndarray:
+    rng = rng or np.random.default_rng(0)
+    max_points = k * _KMEANS_POINTS_PER_CENTROID
+    if data.shape[0] > max_points:
+        data = data[rng.choice(data.shape[0], max_points, replace=False)]
+    centroids = data[rng.choice(data.shape[0], k, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assignment = assign_to_nearest(data, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        order = np.argsort(assignment, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        non_empty = counts > 0
+        sums = np.add.reduceat(data[order], starts[non_empty], axis=0)
+        centroids[non_empty] = sums / counts[non_empty, None]
+        # re-seed empty clusters with random points so every centroid stays in use
+        empty = np.flatnonzero(~non_empty)
+        if empty.size:
+            centroids[empty] = data[rng.choice(data.shape[0], empty.size, replace=False)]
+    return centroids
+
+
+class IVFPQVectorIndex:
+
+    def __init__(self, dimensions: int,
+                 nlist: int = IVFPQ_NLIST,
+                 nprobe: int = IVFPQ_NPROBE,
+                 m: int = IVFPQ_M,
+                 nbits: int = IVFPQ_NBITS,
+                 rerank_factor: int = IVFPQ_RERANK_FACTOR,
+                 training_path: str = "",
+                 seed: int = 0):
+        if dimensions % m:
+            raise ValueError(f"IVF-PQ m ({m}) must divide the vector dimensions ({dimensions})")
+        if not 1 <= nbits <= 16:
+            raise ValueError("IVF-PQ nbits must be between 1 and 16")
+        self.dimensions = dimensions
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.m = m
+        self.nbits = nbits
+        self.rerank_factor = rerank_factor
+        self.training_path = training_path
+        self._rng = np.random.default_rng(seed)
+        self._code_dtype = np.uint8 if nbits <= 8 else np.uint16
+
+        self.coarse_centroids = None  # (nlist, dimensions)
+        self.codebooks = None  # (m, 2**nbits, dimensions / m)
+        # number of vectors the quantizers were trained on
+        self.training_size = 0
+        self._codebook_norms = None  # (m, 2**nbits)
+
+        self.size = 0
+        self._codes = np.zeros((0, m), dtype=self._code_dtype)
+        self._list_of = np.zeros(0, dtype=np.int32)
+        self._deleted = np.zeros(0, dtype=bool)
+        # memory-mapped (size, dimensions) re-rank vectors, backed by _vectors_file or a saved .vectors.npy
+        self._full_vectors = np.zeros((0, dimensions), dtype=np.float32) if rerank_factor else None
+        self._vectors_file = None
+        self._lists = []  # per list: growable array of positions
+        self._list_sizes = np.zeros(0, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    @property
+    def is_trained(self) -> bool:
+        return self.coarse_centroids is not None
+
+    def train(self, vectors: np.ndarray):
+        vectors = normalise_rows(vectors)
+        # small collections cannot fill every list or sub-codebook
+        nlist = min(self.nlist, vectors.shape[0])
+        ksub = min(2 ** self.nbits, vectors.shape[0])
+        self.coarse_centroids = kmeans(vectors, nlist, rng=self._rng)
+        residuals = vectors - self.coarse_centroids[assign_to_nearest(vectors, self.coarse_centroids)]
+        sub_dimensions = self.dimensions // self.m
+        self.codebooks = np.stack([
+            kmeans(np.ascontiguousarray(residuals[:, j * sub_dimensions:(j + 1) * sub_dimensions]), ksub,
+                   rng=self._rng)
+            for j in range(self.m)
+        ])
+        self.training_size = vectors.shape[0]
+        self._prepare_lists_and_tables()
+
+    @property
+    def training(self) -> dict:
+        """What the quantizers were trained with; nlist and ksub are clamped to the training set size."""
+        return {"nlist": self.coarse_centroids.shape[0], "ksub": self.codebooks.shape[1],
+                "training_size": self.training_size}
+
+    def _prepare_lists_and_tables(self):
+        self._codebook_norms = (self.codebooks ** 2).sum(axis=2)
+        nlist = self.coarse_centroids.shape[0]
+        self._lists = [np.zeros(0, dtype=np.int64) for _ in range(nlist)]
+        self._list_sizes = np.zeros(nlist, dtype=np.int64)
+
+    def _encode(self, vectors: np.ndarray):
+        lists = assign_to_nearest(vectors, self.coarse_centroids)
+        residuals = vectors - self.coarse_centroids[lists]
+        sub_dimensions = self.dimensions // self.m
+        codes = np.empty((vectors.shape[0], self.m), dtype=self._code_dtype)
+        for j in range(self.m):
+            codes[:, j] = assign_to_nearest(residuals[:, j * sub_dimensions:(j + 1) * sub_dimensions],
+                                            self.codebooks[j])
+        return lists, codes
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = normalise_rows(vectors)
+        with self._lock:
+            if not self.is_trained:
+                # the first batch doubles as the training set
+                self.train(vectors)
+                if self.training_path:
+                    try:
+                        os.makedirs(os.path.dirname(self.training_path) or ".", exist_ok=True)
+                        self.save(self.training_path, quantizers_only=True)
+                    except OSError as e:
+                        print(f"Saving the IVF-PQ quantizers to {self.training_path} failed: {e}")
+            lists, codes = self._encode(vectors)
+            count = vectors.shape[0]
+            positions = np.arange(self.size, self.size + count)
+            self._codes = grow_rows(self._codes, self.size + count)
+            self._list_of = grow_rows(self._list_of, self.size + count)
+            self._deleted = grow_rows(self._deleted, self.size + count, fill_value=False)
+            self._codes[positions] = codes
+            self._list_of[positions] = lists
+            if self._full_vectors is not None:
+                self._append_full_vectors(vectors)
+            for list_id in np.unique(lists).tolist():
+                members = positions[lists == list_id]
+                size = self._list_sizes[list_id]
+                self._lists[list_id] = grow_rows(self._lists[list_id], size + members.size)
+                self._lists[list_id][size:size + members.size] = members
+                self._list_sizes[list_id] = size + members.size
+            self.size += count
+            return positions
+
+    def _append_full_vectors(self, vectors: np.ndarray):
+        """Appends re-rank vectors to the file behind _full_vectors and maps it again with the new rows."""
+        if self._vectors_file is None:
+            # unlinked on creation, the file is removed when the index is garbage collected
+            self._vectors_file = tempfile.TemporaryFile(dir=IVFPQ_RERANK_VECTORS_DIR or None)
+            # a loaded index maps its read-only .vectors.npy, copy those rows over first
+            for start in range(0, self.size, _ASSIGN_CHUNK_ROWS):
+                self._vectors_file.write(np.ascontiguousarray(self._full_vectors[start:start + _ASSIGN_CHUNK_ROWS],
+                                                              dtype=np.float32).tobytes())
+        self._vectors_file.seek(0, os.SEEK_END)
+        self._vectors_file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        self._vectors_file.flush()
+        self._full_vectors = np.memmap(self._vectors_file, dtype=np.float32, mode="r",
+                                       shape=(self.size + vectors.shape[0], self.dimensions))
+
+    def get_vectors(self, positions) -> np.ndarray:
+        """Vectors at `positions`: the re-rank vectors when kept, else the reconstruction from the PQ codes."""
+        positions = np.asarray(positions, dtype=np.int64)
+        with self._lock:
+            if self._full_vectors is not None:
+                return np.asarray(self._full_vectors[positions], dtype=np.float32)
+            sub_vectors = self.codebooks[np.arange(self.m), self._codes[positions]]  # (positions, m, dimensions / m)
+            vectors = self.coarse_centroids[self._list_of[positions]] + sub_vectors.reshape(positions.size, -1)
+        return normalise_rows(vectors)
+
+    def delete(self, positions):
+        with self._lock:
+            self._deleted[np.asarray(positions, dtype=np.int64)] = True
+
+    def _distance_tables(self, residual_queries: np.ndarray) -> np.ndarray:
+        """
+        (lists, m, ksub) squared L2 distances between each sub-vector of each residual query and each sub-centroid,
+        as ||r||^2 - 2 r.c + ||c||^2 with one batched matmul over all probed lists.
+        """
+        sub_queries = residual_queries.reshape(residual_queries.shape[0], self.m, -1).transpose(1, 0, 2)
+        dots = np.matmul(sub_queries, self.codebooks.transpose(0, 2, 1))  # (m, lists, ksub)
+        sub_query_norms = (sub_queries ** 2).sum(axis=2)  # (m, lists)
+        tables = sub_query_norms[:, :, None] - 2 * dots + self._codebook_norms[:, None, :]
+        return tables.transpose(1, 0, 2)
+
+    def search(self, query_vector: np.ndarray, k: int, mask: np.ndarray = None, exact: bool = False,
+               nprobe: int = None):
+        if self.size == 0 or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        with self._lock:
+            allowed = get_allowed_positions(self._deleted, self.size, mask)
+            if exact and self._full_vectors is not None:
+                similarities = np.where(allowed, self._full_vectors[:self.size] @ query_vector, -np.inf)
+                return top_k(similarities, min(k, int(allowed.sum())))
+
+            nprobe = min(nprobe or self.nprobe, self.coarse_centroids.shape[0])
+            probe_lists, _ = top_k(self.coarse_centroids @ query_vector, nprobe)
+            tables = self._distance_tables(query_vector - self.coarse_centroids[probe_lists])
+            subspaces = np.arange(self.m)
+            candidates, distances = [], []
+            for table, list_id in zip(tables, probe_lists.tolist()):
+                members = self._lists[list_id][:self._list_sizes[list_id]]
+                members = members[allowed[members]]
+                if members.size == 0:
+                    continue
+                distances.append(table[subspaces, self._codes[members]].sum(axis=1))
+                candidates.append(members)
+            if not candidates:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            candidates = np.concatenate(candidates)
+            # for unit vectors: cosine similarity = 1 - ||q - x||^2 / 2
+            similarities = (1 - np.concatenate(distances) / 2).astype(np.float32)
+
+            if self._full_vectors is None or self.rerank_factor <= 0:
+                best, similarities = top_k(similarities, k)
+                return candidates[best], similarities
+            shortlist, _ = top_k(similarities, k * self.rerank_factor)
+            shortlist = candidates[shortlist]
+            best, similarities = top_k(self._full_vectors[shortlist] @ query_vector, k)
+            return shortlist[best], similarities
+
+    def memory_bytes(self) -> int:
+        """Bytes held in RAM for the compressed index; the re-rank vectors are memory-mapped and not counted."""
+        return int(self._codes[:self.size].nbytes + self._list_of[:self.size].nbytes
+                   + self.coarse_centroids.nbytes + self.codebooks.nbytes + 8 * self.size)
+
+    # persistence
+
+    def save(self, path: str, quantizers_only: bool = False):
+        """
+        Saves the index to `path` (.npz). Full re-rank vectors go to a separate `path`.vectors.npy that load()
+        memory-maps, so they do not have to fit in RAM.
+        """
+        params = {"dimensions": self.dimensions, "nlist": self.nlist, "nprobe": self.nprobe, "m": self.m,
+                  "nbits": self.nbits, "rerank_factor": self.rerank_factor}
+        arrays = {"params": np.array(json.dumps(params)), "training": np.array(json.dumps(self.training)),
+                  "coarse_centroids": self.coarse_centroids, "codebooks": self.codebooks}
+        if not quantizers_only:
+            arrays.update(codes=self._codes[:self.size], list_of=self._list_of[:self.size],
+                          deleted=self._deleted[:self.size])
+            if self._full_vectors is not None:
+                np.save(f"{path}.vectors.npy", np.asarray(self._full_vectors[:self.size]))
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path: str, **overrides):
+        """Loads an index saved with save(); query parameters such as nprobe can be overridden."""
+        with np.load(path) as saved:
+            params = {**json.loads(str(saved["params"])), **overrides}
+            index = cls(**params)
+            index.coarse_centroids = saved["coarse_centroids"]
+            index.codebooks = saved["codebooks"]
+            # files saved before the training set size was recorded count as trained on nothing
+            index.training_size = json.loads(str(saved["training"]))["training_size"] if "training" in saved else 0
+            index._prepare_lists_and_tables()
+            if "codes" not in saved:
+                return index
+            index._codes = saved["codes"]
+            index._list_of = saved["list_of"]
+            index._deleted = saved["deleted"]
+        index.size = index._codes.shape[0]
+        if index._full_vectors is not None:
+            try:
+                index._full_vectors = np.load(f"{path}.vectors.npy", mmap_mode="r")
+            except FileNotFoundError:
+                index._full_vectors = None
+        for list_id in range(index.coarse_centroids.shape[0]):
+            members = np.flatnonzero(index._list_of == list_id)
+            index._lists[list_id] = members
+            index._list_sizes[list_id] = members.size
+        return index
+
+
+def get_training_path(db_name: str, collection_name: str, dimensions: int) -> str:
+    return os.path.join(IVFPQ_TRAINING_DIR, f"{db_name}.{collection_name}.{dimensions}d.npz")
+
+
+def get_retraining_reason(index: IVFPQVectorIndex, dimensions: int, collection_size: int):
+    """Why quantizers loaded from a file do not fit the collection, None when they can be reused."""
+    configured = (dimensions, IVFPQ_NLIST, IVFPQ_M, IVFPQ_NBITS)
+    trained = (index.dimensions, index.nlist, index.m, index.nbits)
+    if trained != configured:
+        return f"trained with (dimensions, nlist, m, nbits) {trained}, not {configured}"
+    training = index.training
+    if training["nlist"] < min(IVFPQ_NLIST, collection_size) or training["ksub"] < min(2 ** IVFPQ_NBITS,
+                                                                                       collection_size):
+        return f"trained with {training['nlist']} lists and {training['ksub']} sub-centroids only"
+    if training["training_size"] * IVFPQ_RETRAIN_GROWTH < collection_size:
+        return f"trained on {training['training_size']} vectors, the collection has {collection_size}"
+    return None
+
+
+def create_ivfpq_vector_index(dimensions: int, db_name: str = None, collection_name: str = None,
+                              collection_size: int = 0) -> IVFPQVectorIndex:
+    """
+    IVF-PQ index configured from the environment. The quantizers of a collection are saved after training and reused
+    while they were trained with the same settings on a training set that still represents the collection; otherwise
+    the index trains again and overwrites them. Indexes without a database and collection (e.g. the benchmark's)
+    always train.
+    """
+    if not (IVFPQ_TRAINING_DIR and db_name and collection_name):
+        return IVFPQVectorIndex(dimensions=dimensions)
+    training_path = get_training_path(db_name, collection_name, dimensions)
+    try:
+        index = IVFPQVectorIndex.load(training_path, nprobe=IVFPQ_NPROBE, rerank_factor=IVFPQ_RERANK_FACTOR)
+        reason = get_retraining_reason(index, dimensions=dimensions, collection_size=collection_size)
+        if reason is None:
+            return index
+        print(f"Retraining IVF-PQ quantizers, {training_path} was {reason}")
+    except FileNotFoundError:
+        pass
+    return IVFPQVectorIndex(dimensions=dimensions, training_path=training_path)
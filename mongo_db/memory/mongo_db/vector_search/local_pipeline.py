@@ -0,0 +1,281 @@
+"""
+Evaluates the subset of the MongoDB aggregation language used by the search pipelines in this project against
+in-memory documents, so pipelines built for Atlas can run on the local vector search backend unchanged.
+
+Documents flow through the stages as (document, vector_search_score) pairs; the score is what
+{"$meta": "vectorSearchScore"} resolves to.
+"""
+import re
+from functools import cmp_to_key
+
+MISSING = object()
+
+
+def get_field(doc, path: str):
+    """Resolves a dotted path; arrays along the path fan out into a list of the matching values."""
+    value = doc
+    parts = path.split(".")
+    for i, part in enumerate(parts):
+        if isinstance(value, dict):
+            value = value.get(part, MISSING)
+        elif isinstance(value, list):
+            rest = ".".join(parts[i:])
+            values = [get_field(item, rest) for item in value if isinstance(item, dict)]
+            return [v for v in values if v is not MISSING]
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+
+def set_field(doc: dict, path: str, value) -> dict:
+    """Returns a copy of doc with path set; only the dicts along the path are copied."""
+    head, _, rest = path.partition(".")
+    doc = dict(doc)
+    if rest:
+        child = doc.get(head)
+        doc[head] = set_field(child if isinstance(child, dict) else {}, rest, value)
+    else:
+        doc[head] = value
+    return doc
+
+
+def _compare(a, b) -> int:
+    # null and missing sort before everything else, as in MongoDB
+    if a is None or a is MISSING:
+        return 0 if (b is None or b is MISSING) else -1
+    if b is None or b is MISSING:
+        return 1
+    try:
+        return (a > b) - (a < b)
+    except TypeError:
+        return (str(a) > str(b)) - (str(a) < str(b))
+
+
+def _matches_value(value, condition) -> bool:
+    if isinstance(condition, re.Pattern):
+        return isinstance(value, str) and condition.search(value) is not None
+    return value == condition
+
+
+def _any_value(value, predicate) -> bool:
+    # a condition on an array field matches when the array itself or any element matches
+    if isinstance(value, list):
+        return predicate(value) or any(predicate(v) for v in value)
+    return predicate(value)
+
+
+def _comparable(value, operand, test) -> bool:
+    if value is MISSING or value is None or operand is None:
+        return False
+    try:
+        return test(value, operand)
+    except TypeError:
+        return False
+
+
+def _matches_operator(value, operator: str, operand) -> bool:
+    if operator == "$eq":
+        return _any_value(value, lambda v: _matches_value(v, operand))
+    if operator == "$ne":
+        return not _any_value(value, lambda v: _matches_value(v, operand))
+    if operator == "$gt":
+        return _any_value(value, lambda v: _comparable(v, operand, lambda x, y: x > y))
+    if operator == "$gte":
+        return _any_value(value, lambda v: _comparable(v, operand, lambda x, y: x >= y))
+    if operator == "$lt":
+        return _any_value(value, lambda v: _comparable(v, operand, lambda x, y: x < y))
+    if operator == "$lte":
+        return _any_value(value, lambda v: _comparable(v, operand, lambda x, y: x <= y))
+    if operator == "$in":
+        return any(_any_value(value, lambda v, o=o: _matches_value(v, o)) for o in operand)
+    if operator == "$nin":
+        return not any(_any_value(value, lambda v, o=o: _matches_value(v, o)) for o in operand)
+    if operator == "$exists":
+        return (value is not MISSING) == bool(operand)
+    if operator == "$regex":
+        pattern = operand if isinstance(operand, re.Pattern) else re.compile(operand)
+        return _any_value(value, lambda v: _matches_value(v, pattern))
+    if operator == "$not":
+        return not _matches_condition(value, operand)
+    raise ValueError(f"Unsupported query operator {operator} in local vector search backend")
+
+
+def _matches_condition(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+        return all(_matches_operator(value, op, operand) for op, operand in condition.items())
+    if value is MISSING:
+        return condition is None
+    return _any_value(value, lambda v: _matches_value(v, condition))
+
+
+def match_document(doc: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(match_document(doc, q) for q in condition):
+                return False
+        elif key == "$or":
+            if not any(match_document(doc, q) for q in condition):
+                return False
+        elif key == "$nor":
+            if any(match_document(doc, q) for q in condition):
+                return False
+        elif not _matches_condition(get_field(doc, key), condition):
+            return False
+    return True
+
+
+def _arithmetic(values: list, op):
+    if any(v is None or v is MISSING for v in values):
+        return None
+    result = values[0]
+    for v in values[1:]:
+        result = op(result, v)
+    return result
+
+
+def evaluate_expression(doc: dict, score, expression):
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = get_field(doc, expression[1:])
+        return None if value is MISSING else value
+    if isinstance(expression, list):
+        return [evaluate_expression(doc, score, e) for e in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) == 1:
+        operator, operand = next(iter(expression.items()))
+        if operator.startswith("$"):
+            if operator == "$literal":
+                return operand
+            if operator == "$meta":
+                if operand in ("vectorSearchScore", "searchScore"):
+                    return score
+                raise ValueError(f"Unsupported $meta {operand} in local vector search backend")
+            args = [evaluate_expression(doc, score, a) for a in (operand if isinstance(operand, list) else [operand])]
+            if operator == "$add":
+                return _arithmetic(args, lambda x, y: x + y)
+            if operator == "$subtract":
+                return _arithmetic(args, lambda x, y: x - y)
+            if operator == "$multiply":
+                return _arithmetic(args, lambda x, y: x * y)
+            if operator == "$divide":
+                return _arithmetic(args, lambda x, y: x / y)
+            if operator == "$ifNull":
+                return next((a for a in args if a is not None), None)
+            if operator == "$avg":
+                numbers = [a for a in (args[0] if len(args) == 1 and isinstance(args[0], list) else args)
+                           if isinstance(a, (int, float))]
+                return sum(numbers) / len(numbers) if numbers else None
+            raise ValueError(f"Unsupported expression operator {operator} in local vector search backend")
+    return {k: evaluate_expression(doc, score, v) for k, v in expression.items()}
+
+
+def _is_inclusion(value) -> bool:
+    return value is True or (isinstance(value, (int, float)) and not isinstance(value, bool) and value != 0)
+
+
+def _is_exclusion(value) -> bool:
+    return value is False or (isinstance(value, (int, float)) and not isinstance(value, bool) and value == 0)
+
+
+def _copy_path(source: dict, target: dict, path: str) -> dict:
+    head, _, rest = path.partition(".")
+    if head not in source:
+        return target
+    if not rest:
+        return {**target, head: source[head]}
+    child = source[head]
+    existing = target.get(head, {})
+    if isinstance(child, dict):
+        return {**target, head: _copy_path(child, existing, rest)}
+    if isinstance(child, list):
+        items = [_copy_path(item, {}, rest) if isinstance(item, dict) else item for item in child]
+        return {**target, head: items}
+    return target
+
+
+def _remove_path(doc: dict, path: str) -> dict:
+    head, _, rest = path.partition(".")
+    if head not in doc:
+        return doc
+    doc = dict(doc)
+    if rest and isinstance(doc[head], dict):
+        doc[head] = _remove_path(doc[head], rest)
+    elif not rest:
+        del doc[head]
+    return doc
+
+
+def project_document(doc: dict, score, projection: dict) -> dict:
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    inclusion = any(not _is_exclusion(v) for v in fields.values())
+    if inclusion:
+        result = {}
+        if not _is_exclusion(projection.get("_id", 1)) and "_id" in doc:
+            result["_id"] = doc["_id"]
+        for path, value in fields.items():
+            if _is_inclusion(value):
+                result = _copy_path(doc, result, path)
+            else:
+                result = set_field(result, path, evaluate_expression(doc, score, value))
+        return result
+    result = doc
+    for path, value in projection.items():
+        if _is_exclusion(value):
+            result = _remove_path(result, path)
+    return result
+
+
+def sort_documents(rows: list, sort_spec: dict) -> list:
+    def compare(a, b):
+        for path, direction in sort_spec.items():
+            if isinstance(direction, dict):  # {"$meta": "vectorSearchScore"}
+                left, right = a[1], b[1]
+                direction = -1
+            else:
+                left, right = get_field(a[0], path), get_field(b[0], path)
+            result = _compare(left, right)
+            if result:
+                return result if direction > 0 else -result
+        return 0
+    return sorted(rows, key=cmp_to_key(compare))
+
+
+def apply_stage(rows: list, stage: dict) -> list:
+    """Applies one aggregation stage to a list of (document, score) pairs."""
+    (name, spec), = stage.items()
+    if name == "$match":
+        return [(doc, score) for doc, score in rows if match_document(doc, spec)]
+    if name == "$project":
+        return [(project_document(doc, score, spec), score) for doc, score in rows]
+    if name in ("$addFields", "$set"):
+        result = []
+        for doc, score in rows:
+            new_doc = doc
+            for path, expression in spec.items():
+                # expressions see the document as it was before the stage, like MongoDB
+                new_doc = set_field(new_doc, path, evaluate_expression(doc, score, expression))
+            result.append((new_doc, score))
+        return result
+    if name == "$unset":
+        paths = [spec] if isinstance(spec, str) else spec
+        result = []
+        for doc, score in rows:
+            for path in paths:
+                doc = _remove_path(doc, path)
+            result.append((doc, score))
+        return result
+    if name == "$sort":
+        return sort_documents(rows, spec)
+    if name == "$limit":
+        return rows[:spec]
+    if name == "$skip":
+        return rows[spec:]
+    raise ValueError(f"Unsupported stage {name} in local vector search backend")
+
+
+def run_pipeline(rows: list, stages: list) -> list:
+    for stage in stages:
+        rows = apply_stage(rows, stage)
+    return [doc for doc, _ in rows]
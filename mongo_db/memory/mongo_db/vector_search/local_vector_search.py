@@ -0,0 +1,318 @@
+"""
+In-process stand-in for Atlas $vectorSearch.
+
+Embeddings of a collection are loaded once into a vector index (see vector_index and hnsw_index); the exact index
+answers a query with one matrix-vector product over a contiguous float32 matrix and an argpartition top-k. The
+remaining pipeline stages run through local_pipeline, so the pipelines built for Atlas are executed unchanged.
+The documents are kept without their embeddings, the index holds the vectors once; results get the vector of the
+index back only when a later stage or the caller may read it (e.g. MMR).
+
+The HNSW graph of a collection is saved after it is built (see hnsw_index.HNSW_GRAPH_DIR). A process starting later,
+or a reload after the collection's generation changed, syncs the saved graph with the documents: only documents
+that are new or whose embedding changed are inserted, and the ones that are gone are deleted.
+"""
+import os
+import threading
+
+import numpy as np
+
+from common_utils import get_env_key
+from memory.mongo_db.service.collection_generation_service import get_collection_generation
+from memory.mongo_db.vector_search.hnsw_index import HNSWVectorIndex, HNSW_GRAPH_DIR, create_hnsw_vector_index, \
+    get_graph_path
+from memory.mongo_db.vector_search.ivfpq_index import create_ivfpq_vector_index
+from memory.mongo_db.vector_search.local_pipeline import match_document, run_pipeline
+from memory.mongo_db.vector_search.pipeline_optimizer import WHOLE_DOCUMENT, get_paths_needed_by_stages
+from memory.mongo_db.vector_search.vector_encoding import decode_vector, get_full_precision_field_name
+from memory.mongo_db.vector_search.vector_index import ExactVectorIndex, normalise_rows
+
+# "atlas" runs $vectorSearch on MongoDB Atlas, "local" runs it in-process
+VECTOR_SEARCH_BACKEND = get_env_key('VECTOR_SEARCH_BACKEND', 'atlas')
+# where the local backend reads documents from: "mongo" (any MongoDB, e.g. a local community server) or
+# "huggingface" (the sample dataset, no database needed)
+VECTOR_SEARCH_LOCAL_DATA_SOURCE = get_env_key('VECTOR_SEARCH_LOCAL_DATA_SOURCE', 'mongo')
+
+# index over the loaded vectors: "exact" (brute force), "hnsw" (approximate graph index) or
+# "ivfpq" (compressed inverted file index)
+VECTOR_SEARCH_LOCAL_INDEX = get_env_key('VECTOR_SEARCH_LOCAL_INDEX', 'exact')
+
+# Atlas rejects numCandidates above this
+MAX_NUM_CANDIDATES = 10000
+
+# rows of indexed vectors compared at a time when syncing a collection
+_SYNC_CHUNK_ROWS = 65536
+
+
+def is_local_vector_search_backend() -> bool:
+    return VECTOR_SEARCH_BACKEND == "local"
+
+
+def create_vector_index(dimensions: int, index_type: str = VECTOR_SEARCH_LOCAL_INDEX, db_name: str = None,
+                        collection_name: str = None, collection_size: int = 0):
+    if index_type == "hnsw":
+        # the saved graph of the collection, see create_hnsw_vector_index
+        return create_hnsw_vector_index(dimensions=dimensions, db_name=db_name, collection_name=collection_name)
+    if index_type == "ivfpq":
+        # the quantizers are trained per collection, see create_ivfpq_vector_index
+        return create_ivfpq_vector_index(dimensions=dimensions, db_name=db_name, collection_name=collection_name,
+                                         collection_size=collection_size)
+    if index_type == "exact":
+        return ExactVectorIndex(dimensions=dimensions)
+    raise ValueError(f"Unknown local vector index type '{index_type}'")
+
+
+class LocalVectorCollection:
+    """
+    Documents of one collection plus the vector index over their embedding field. Exposes `name` and
+    `aggregate(pipeline)` like a pymongo Collection, for pipelines that start with $vectorSearch.
+    """
+
+    def __init__(self, name: str, documents: list, embedding_field: str,
+                 index_type: str = VECTOR_SEARCH_LOCAL_INDEX, database_name: str = None):
+        self.name = name
+        self.database_name = database_name
+        # generation of the collection the documents were loaded at, see collection_generation_service
+        self.generation = 0
+        self.embedding_field = embedding_field
+        full_precision_field = get_full_precision_field_name(embedding_field)
+        self._embedding_fields = (embedding_field, full_precision_field)
+
+        embedded = [doc for doc in documents if self._embedding_of(doc) is not None]
+        # results carry the indexed vector under the field the vectors were read from
+        self.vector_field = full_precision_field if any(full_precision_field in doc for doc in embedded) \
+            else embedding_field
+        self.dimensions = len(self._embedding_of(embedded[0])) if embedded else 0
+        self.index = create_vector_index(dimensions=self.dimensions, index_type=index_type, db_name=database_name,
+                                         collection_name=name, collection_size=len(embedded))
+
+        # documents[position] is the document, without its embeddings, of the vector at that index position;
+        # deleted ones become None
+        self.documents = []
+        self._positions_by_id = {}
+        # filters repeat across queries, so the boolean mask of each distinct filter is computed once
+        self._filter_masks = {}
+        self._lock = threading.Lock()
+        saved_ids = self.index.metadata.get("ids") if isinstance(self.index, HNSWVectorIndex) else None
+        if saved_ids is not None and len(saved_ids) == self.index.size:
+            self.documents = [None] * self.index.size
+            self.sync_documents(embedded, ids_by_position=saved_ids)
+        else:
+            self.insert_documents(embedded)
+
+    def _embedding_of(self, doc: dict):
+        # quantized collections keep a full-precision copy next to the indexed field, prefer it
+        embedding = doc.get(get_full_precision_field_name(self.embedding_field), doc.get(self.embedding_field))
+        if embedding is None or (isinstance(embedding, list) and not embedding):
+            return None
+        return decode_vector(embedding)
+
+    def _without_embeddings(self, doc: dict) -> dict:
+        return {field: value for field, value in doc.items() if field not in self._embedding_fields}
+
+    def insert_documents(self, documents: list):
+        """Adds documents to the index; a document whose _id is already indexed replaces the old version."""
+        embeddings = [(doc, self._embedding_of(doc)) for doc in documents]
+        embeddings = [(doc, vector) for doc, vector in embeddings if vector is not None
+                      and vector.shape[0] == self.dimensions]
+        if not embeddings:
+            return
+        documents = [self._without_embeddings(doc) for doc, _ in embeddings]
+        self.delete_documents([doc["_id"] for doc in documents if "_id" in doc])
+        vectors = np.stack([vector for _, vector in embeddings])
+        positions = self.index.add(vectors)
+        with self._lock:
+            self.documents.extend([None] * (int(positions[-1]) + 1 - len(self.documents)))
+            for position, doc in zip(positions.tolist(), documents):
+                self.documents[position] = doc
+                if "_id" in doc:
+                    self._positions_by_id[doc["_id"]] = position
+            self._filter_masks = {}
+
+    def delete_documents(self, ids: list):
+        with self._lock:
+            positions = [self._positions_by_id.pop(_id) for _id in ids if _id in self._positions_by_id]
+            if not positions:
+                return
+            for position in positions:
+                self.documents[position] = None
+            self._filter_masks = {}
+        self.index.delete(positions)
+
+    def sync_documents(self, documents: list, ids_by_position: list = None) -> dict:
+        """
+        Brings the collection in line with `documents`, its complete current contents: documents whose _id is indexed
+        with the same embedding keep their vector, changed and new ones are inserted and the rest are deleted.
+        ids_by_position holds repr(_id) of each indexed position (None for none), by default of the loaded documents.
+        Returns the number of kept, inserted and deleted documents.
+        """
+        if ids_by_position is None:
+            ids_by_position = [repr(doc["_id"]) if doc is not None and "_id" in doc else None
+                               for doc in self.documents]
+        indexed = {_id: position for position, _id in enumerate(ids_by_position) if _id is not None}
+        kept, inserted = [], []
+        for doc in documents:
+            vector = self._embedding_of(doc)
+            if vector is None or vector.shape[0] != self.dimensions:
+                continue
+            position = indexed.pop(repr(doc["_id"]), None) if "_id" in doc else None
+            if position is None:
+                inserted.append(doc)
+            else:
+                kept.append((doc, position, vector))
+
+        # the indexed vector of each kept document is compared with its current embedding, in chunks
+        unchanged_count = 0
+        for start in range(0, len(kept), _SYNC_CHUNK_ROWS):
+            chunk = kept[start:start + _SYNC_CHUNK_ROWS]
+            vectors = normalise_rows(np.stack([vector for _, _, vector in chunk]))
+            indexed_vectors = self.index.get_vectors([position for _, position, _ in chunk])
+            unchanged = np.all(np.abs(indexed_vectors - vectors) <= 1e-6, axis=1)
+            for (doc, position, _), is_unchanged in zip(chunk, unchanged.tolist()):
+                if is_unchanged:
+                    self.documents[position] = self._without_embeddings(doc)
+                    unchanged_count += 1
+                else:
+                    indexed[repr(doc["_id"])] = position
+                    inserted.append(doc)
+
+        # positions of removed and changed documents; positions without an _id cannot be matched (or are already
+        # deleted) and are deleted too
+        unmatched = {position for position, _id in enumerate(ids_by_position) if _id is None}
+        stale = sorted(set(indexed.values()) | unmatched)
+        with self._lock:
+            for position in stale:
+                self.documents[position] = None
+            self._positions_by_id = {doc["_id"]: position for position, doc in enumerate(self.documents)
+                                     if doc is not None and "_id" in doc}
+            self._filter_masks = {}
+        if stale:
+            self.index.delete(stale)
+        self.insert_documents(inserted)
+        return {"kept": unchanged_count, "inserted": len(inserted), "deleted": len(set(indexed.values()))}
+
+    def save_index(self):
+        """Saves the HNSW graph with the _id of each position, for sync_documents in a later process."""
+        if not (isinstance(self.index, HNSWVectorIndex) and HNSW_GRAPH_DIR and self.database_name):
+            return
+        path = get_graph_path(self.database_name, self.name, self.dimensions)
+        ids = [repr(doc["_id"]) if doc is not None and "_id" in doc else None for doc in self.documents]
+        ids += [None] * (self.index.size - len(ids))
+        try:
+            os.makedirs(HNSW_GRAPH_DIR, exist_ok=True)
+            self.index.save(path, metadata={"ids": ids})
+        except OSError as e:
+            print(f"Saving the HNSW graph to {path} failed: {e}")
+
+    def filter_mask(self, filters: dict):
+        if not filters:
+            return None
+        key = repr(filters)
+        mask = self._filter_masks.get(key)
+        if mask is None:
+            documents = self.documents
+            mask = np.fromiter((doc is not None and match_document(doc, filters) for doc in documents),
+                               dtype=bool, count=len(documents))
+            with self._lock:
+                if len(documents) == len(self.documents):
+                    self._filter_masks[key] = mask
+        return mask
+
+    def needs_vectors(self, stages: list) -> bool:
+        """Whether the stages after $vectorSearch, or the caller when they return whole documents, read the vector."""
+        needed = get_paths_needed_by_stages(stages)
+        return needed is WHOLE_DOCUMENT or any(path.split(".")[0] == self.vector_field for path in needed)
+
+    def vector_search(self, vector_search: dict, with_vectors: bool = True) -> list:
+        """
+        Answers a $vectorSearch stage with (document, vectorSearchScore) pairs, best first; with_vectors adds the
+        indexed vector to each document under vector_field.
+        """
+        if vector_search.get("path") != self.embedding_field:
+            raise ValueError(f"Local vector search index covers '{self.embedding_field}', "
+                             f"not '{vector_search.get('path')}'")
+        limit = vector_search["limit"]
+        exact = vector_search.get("exact", False)
+        num_candidates = vector_search.get("numCandidates", limit)
+        if not exact and not (limit <= num_candidates <= MAX_NUM_CANDIDATES):
+            raise ValueError(f"numCandidates must be between limit ({limit}) and {MAX_NUM_CANDIDATES}")
+
+        query_vector = decode_vector(vector_search["queryVector"])
+        if query_vector.shape[0] != self.dimensions:
+            raise ValueError(f"queryVector has {query_vector.shape[0]} dimensions, index has {self.dimensions}")
+        norm = np.linalg.norm(query_vector)
+        query_vector = query_vector / norm if norm else query_vector
+
+        mask = self.filter_mask(vector_search.get("filter"))
+        # the ANN candidate set is numCandidates wide; the best `limit` of those are returned
+        positions, similarities = self.index.search(query_vector, limit if exact else num_candidates, mask=mask,
+                                                    exact=exact)
+        positions, similarities = positions[:limit], similarities[:limit]
+
+        # Atlas reports cosine similarity normalised to [0, 1]
+        scores = (1 + similarities) / 2
+        documents = [self.documents[p] for p in positions]
+        if with_vectors and positions.size:
+            documents = [{**doc, self.vector_field: vector.tolist()}
+                         for doc, vector in zip(documents, self.index.get_vectors(positions))]
+        return list(zip(documents, scores.tolist()))
+
+    def aggregate(self, pipeline: list) -> list:
+        if not pipeline or "$vectorSearch" not in pipeline[0]:
+            raise ValueError("Local vector search backend only runs pipelines starting with $vectorSearch")
+        rows = self.vector_search(pipeline[0]["$vectorSearch"], with_vectors=self.needs_vectors(pipeline[1:]))
+        return run_pipeline(rows, pipeline[1:])
+
+
+def _load_documents(db_name: str, collection_name: str) -> list:
+    if VECTOR_SEARCH_LOCAL_DATA_SOURCE == "huggingface":
+        # imported here since the sample data service itself refreshes this backend after ingestion
+        from memory.mongo_db.service.mongo_sample_data_service import load_sample_data_from_huggingface
+        documents = load_sample_data_from_huggingface()
+        # the Listing model does not keep _id, give every document a stable one
+        return [{"_id": i, **doc} for i, doc in enumerate(documents)]
+
+    from memory.mongo_db.db.mongo_client import MongoConnection
+    mclient = MongoConnection.initialise_client()
+    return list(mclient.get_database(db_name).get_collection(collection_name).find({}))
+
+
+def _has_dimensions(collection: LocalVectorCollection, documents: list) -> bool:
+    vector = next((v for v in map(collection._embedding_of, documents) if v is not None), None)
+    return vector is not None and vector.shape[0] == collection.dimensions
+
+
+_local_collections = {}
+_local_collections_lock = threading.Lock()
+
+
+def get_local_vector_collection(db_name: str, collection_name: str, embedding_field: str) -> LocalVectorCollection:
+    key = (db_name, collection_name, embedding_field)
+    # a bumped generation means another process, e.g. `manage.py ingest`, changed the collection: reload it
+    generation = get_collection_generation(db_name, collection_name)
+    collection = _local_collections.get(key)
+    if collection is None or collection.generation != generation:
+        with _local_collections_lock:
+            collection = _local_collections.get(key)
+            if collection is None or collection.generation != generation:
+                documents = _load_documents(db_name=db_name, collection_name=collection_name)
+                if collection is not None and isinstance(collection.index, HNSWVectorIndex) \
+                        and collection.index.size and _has_dimensions(collection, documents):
+                    # the graph is kept, only what changed since the last generation is inserted or deleted
+                    counts = collection.sync_documents(documents)
+                    print(f"Synced {db_name}.{collection_name} in the local vector search backend: {counts}")
+                else:
+                    collection = LocalVectorCollection(name=collection_name, documents=documents,
+                                                       embedding_field=embedding_field, database_name=db_name)
+                    print(f"Loaded {len(collection.documents)} vectors of {collection.dimensions} dimensions "
+                          f"from {db_name}.{collection_name} into the local vector search backend")
+                collection.save_index()
+                collection.generation = generation
+                _local_collections[key] = collection
+    return collection
+
+
+def invalidate_local_vector_collection(db_name: str, collection_name: str):
+    """Drops loaded vectors so the next search reloads the collection, e.g. after ingestion."""
+    with _local_collections_lock:
+        for key in [k for k in _local_collections if k[:2] == (db_name, collection_name)]:
+            del _local_collections[key]
@@ -0,0 +1,219 @@
+"""
+Maximal marginal relevance (MMR) re-ranking of vector search results.
+
+The search fetches MMR_CANDIDATE_FACTOR * k candidates with their embeddings, then picks k of them one at a time,
+each maximising
+    lambda * similarity(query, candidate) - (1 - lambda) * max similarity(candidate, already picked)
+so near-duplicate listings (same building, same host) give way to different ones. lambda 1 is plain relevance order,
+lambda 0 maximal diversity.
+
+Similarities come from the full-precision vectors, so the relevance term is the exact cosine similarity for every
+encoding. Leading $match stages of the additional stages filter the candidates before the selection; the other
+stages run on the k picked, in-process (see local_pipeline), with the vectorSearchScore being the exact similarity.
+The candidates are projected on the server to the fields those stages read, _id and the embeddings.
+"""
+import time
+
+import numpy as np
+
+from common_utils import get_env_key
+from memory.mongo_db.vector_search.local_pipeline import run_pipeline
+from memory.mongo_db.vector_search.mongo_vector_search import get_pipeline_for_query_embedding, profile_query, \
+    profile_query_async
+from memory.mongo_db.vector_search.pipeline_optimizer import WHOLE_DOCUMENT, get_paths_needed_by_stages, \
+    get_projection_for_paths
+from memory.mongo_db.vector_search.result_cache import get_vector_search_result_cache, get_collection_namespace, \
+    get_vector_search_cache_key
+from memory.mongo_db.vector_search.search_planner import plan_vector_search, plan_vector_search_async
+from memory.mongo_db.vector_search.vector_encoding import decode_vector, get_full_precision_field_name, \
+    is_quantized_encoding
+from vectorizer.openai.service.openai_service import get_embedding, get_embedding_async
+
+MMR_LAMBDA = float(get_env_key('MMR_LAMBDA', '0.7'))
+# candidates fetched per result picked
+MMR_CANDIDATE_FACTOR = int(get_env_key('MMR_CANDIDATE_FACTOR', '4'))
+
+
+def mmr_select(query_vector, candidate_vectors, k: int, lambda_mult: float = MMR_LAMBDA) -> tuple:
+    """
+    Positions of the k candidates picked by MMR in pick order, and their cosine similarity to the query.
+    Every step is a vector operation over all candidates; the candidate similarity matrix is computed once.
+    """
+    vectors = np.asarray(candidate_vectors, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query_vector = np.asarray(query_vector, dtype=np.float32)
+    query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+
+    relevance = vectors @ query_vector
+    similarities = vectors @ vectors.T
+    k = min(k, len(vectors))
+
+    selected = []
+    # highest similarity of each candidate to the picked ones; nothing is picked yet
+    max_similarity = np.full(len(vectors), -np.inf, dtype=np.float32)
+    available = np.ones(len(vectors), dtype=bool)
+    for _ in range(k):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity if selected else relevance.copy()
+        scores[~available] = -np.inf
+        position = int(np.argmax(scores))
+        selected.append(position)
+        available[position] = False
+        max_similarity = np.maximum(max_similarity, similarities[position])
+    return selected, relevance[selected]
+
+
+def get_document_vector(document: dict, text_embedding_field: str):
+    value = document.get(get_full_precision_field_name(text_embedding_field))
+    if value is None:
+        value = document.get(text_embedding_field)
+    return decode_vector(value) if value is not None else None
+
+
+def split_leading_match_stages(additional_stages: list) -> tuple:
+    """The leading $match stages (filters, run before the selection) and the stages after them."""
+    position = 0
+    while position < len(additional_stages) and "$match" in additional_stages[position]:
+        position += 1
+    return additional_stages[:position], additional_stages[position:]
+
+
+def rerank_with_mmr(documents: list, query_embedding: list, text_embedding_field: str, k: int,
+                    lambda_mult: float = MMR_LAMBDA, additional_stages: list = []) -> list:
+    match_stages, other_stages = split_leading_match_stages(additional_stages)
+    documents = run_pipeline([(doc, None) for doc in documents], match_stages)
+    vectors = [get_document_vector(doc, text_embedding_field) for doc in documents]
+    documents = [doc for doc, vector in zip(documents, vectors) if vector is not None]
+    if not documents:
+        return []
+
+    vectors = np.stack([vector for vector in vectors if vector is not None])
+    selected, relevance = mmr_select(query_embedding, vectors, k=k, lambda_mult=lambda_mult)
+
+    embedding_fields = (text_embedding_field, get_full_precision_field_name(text_embedding_field))
+    # scores normalised to [0, 1] like the cosine vectorSearchScore
+    rows = [({f: v for f, v in documents[position].items() if f not in embedding_fields}, float((1 + similarity) / 2))
+            for position, similarity in zip(selected, relevance.tolist())]
+    return run_pipeline(rows, other_stages)
+
+
+def get_mmr_candidate_stages(additional_stages: list, text_embedding_field: str) -> list:
+    """
+    Last stage of the candidate query: the fields the additional stages read after the selection, _id and the
+    embeddings the selection reads. Nothing is projected when those stages need whole documents.
+    """
+    needed = get_paths_needed_by_stages(additional_stages)
+    if needed is WHOLE_DOCUMENT:
+        return []
+    return [get_projection_for_paths(needed | {"_id", text_embedding_field,
+                                               get_full_precision_field_name(text_embedding_field)})]
+
+
+def get_mmr_candidate_pipeline(query_embedding: list, vector_index: str, text_embedding_field: str,
+                               filters: dict, k: int, candidate_factor: int = MMR_CANDIDATE_FACTOR,
+                               additional_stages: list = []) -> list:
+    """additional_stages: the stages run after the selection, they decide which fields are fetched."""
+    # a quantized search projects the full-precision vectors and the fields of the stages itself, the stages run
+    # after re-scoring
+    stages = additional_stages if is_quantized_encoding() else \
+        get_mmr_candidate_stages(additional_stages=additional_stages, text_embedding_field=text_embedding_field)
+    return get_pipeline_for_query_embedding(query_embedding=query_embedding,
+                                            vector_index=vector_index,
+                                            text_embedding_field=text_embedding_field,
+                                            additional_stages=stages,
+                                            filters=filters,
+                                            limit=k * candidate_factor)
+
+
+def get_mmr_cache_key(cache, db, collection, pipeline: list, additional_stages: list, k: int,
+                      lambda_mult: float, generation: int = None) -> str:
+    """generation is the collection's, read with cache.get_generation when not given (coroutines await it)."""
+    namespace = get_collection_namespace(db, collection)
+    if generation is None:
+        generation = cache.get_generation(namespace)
+    return get_vector_search_cache_key(namespace=namespace, pipeline=pipeline,
+                                       additional_stages=additional_stages + [{"$mmr": {"k": k,
+                                                                                        "lambda": lambda_mult}}],
+                                       generation=generation)
+
+
+def run_mmr_vs_for_query(db, collection,
+                         query: str,
+                         vector_index: str,
+                         text_embedding_field: str,
+                         k: int,
+                         lambda_mult: float = MMR_LAMBDA,
+                         additional_stages: list = [],
+                         filters: dict = {}):
+    """MMR counterpart of run_vs_for_query, returning k diverse results."""
+    query_embedding = get_embedding(query)
+
+    if query_embedding is None:
+        return "Invalid query or embedding generation failed."
+
+    pipeline = get_mmr_candidate_pipeline(query_embedding=query_embedding, vector_index=vector_index,
+                                          text_embedding_field=text_embedding_field, filters=filters, k=k,
+                                          additional_stages=additional_stages)
+    pipeline = plan_vector_search(db=db, collection=collection, pipeline=pipeline)
+
+    def search():
+        print("Execute the search")
+
+        started_at = time.perf_counter()
+        candidates = list(collection.aggregate(pipeline))
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        profile_query(db=db, collection=collection, pipeline=pipeline, elapsed_ms=elapsed_ms)
+
+        return rerank_with_mmr(documents=candidates, query_embedding=query_embedding,
+                               text_embedding_field=text_embedding_field, k=k, lambda_mult=lambda_mult,
+                               additional_stages=additional_stages)
+
+    cache = get_vector_search_result_cache()
+    if cache is None:
+        return search()
+    cache_key = get_mmr_cache_key(cache, db=db, collection=collection, pipeline=pipeline,
+                                  additional_stages=additional_stages, k=k, lambda_mult=lambda_mult)
+    return cache.get_or_compute(cache_key, search)
+
+
+async def run_mmr_vs_for_query_async(db, collection,
+                                     query: str,
+                                     vector_index: str,
+                                     text_embedding_field: str,
+                                     k: int,
+                                     lambda_mult: float = MMR_LAMBDA,
+                                     additional_stages: list = [],
+                                     filters: dict = {}):
+    """Coroutine version of run_mmr_vs_for_query. `db` and `collection` come from AsyncMongoConnection."""
+    query_embedding = await get_embedding_async(query)
+
+    if query_embedding is None:
+        return "Invalid query or embedding generation failed."
+
+    pipeline = get_mmr_candidate_pipeline(query_embedding=query_embedding, vector_index=vector_index,
+                                          text_embedding_field=text_embedding_field, filters=filters, k=k,
+                                          additional_stages=additional_stages)
+    pipeline = await plan_vector_search_async(db=db, collection=collection, pipeline=pipeline)
+
+    cache = get_vector_search_result_cache()
+    if cache is not None:
+        generation = await cache.get_generation_async(get_collection_namespace(db, collection))
+        cache_key = get_mmr_cache_key(cache, db=db, collection=collection, pipeline=pipeline,
+                                      additional_stages=additional_stages, k=k, lambda_mult=lambda_mult,
+                                      generation=generation)
+        results = cache.get(cache_key)
+        if results is not None:
+            return results
+    print("Execute the search")
+
+    started_at = time.perf_counter()
+    cursor = await collection.aggregate(pipeline)
+    candidates = await cursor.to_list()
+    await profile_query_async(db=db, collection=collection, pipeline=pipeline,
+                              elapsed_ms=(time.perf_counter() - started_at) * 1000)
+
+    results = rerank_with_mmr(documents=candidates, query_embedding=query_embedding,
+                              text_embedding_field=text_embedding_field, k=k, lambda_mult=lambda_mult,
+                              additional_stages=additional_stages)
+    if cache is not None:
+        cache.set(cache_key, results)
+    return results
@@ -1,10 +1,20 @@
 import time
 from pymongo.operations import SearchIndexModel
 
-from vectorizer.openai.service.openai_service import get_embedding
+from memory.mongo_db.vector_search.local_pipeline import run_pipeline
+from memory.mongo_db.vector_search.pipeline_optimizer import WHOLE_DOCUMENT, get_paths_needed_by_stages, \
+    get_projection_for_paths
+from memory.mongo_db.vector_search.query_profiler import query_profiler, parse_vector_search_explain
+from memory.mongo_db.vector_search.result_cache import get_vector_search_result_cache, get_collection_namespace, \
+    get_vector_search_cache_key
+from memory.mongo_db.vector_search.search_index_manager import search_index_manager
+from memory.mongo_db.vector_search.search_planner import plan_vector_search, plan_vector_search_async
+from memory.mongo_db.vector_search.vector_encoding import VECTOR_EMBEDDING_ENCODING, VECTOR_RESCORE_FACTOR, \
+    is_quantized_encoding, encode_vector, rescore_with_full_precision, get_full_precision_field_name
+from vectorizer.openai.service.openai_service import get_embedding, get_embedding_async
 
 
-def print_query_stats(db, collection, pipeline):
+def get_query_stats(db, collection, pipeline) -> dict:
     explain_query_execution = db.command(  # sends a database command directly to the MongoDB server
         'explain', {  # return information about how MongoDB executes a query or command without actually running it
             'aggregate': collection.name,  # specifies the name of the collection on which the aggregation is performed
@@ -13,13 +23,81 @@ def print_query_stats(db, collection, pipeline):
         },
         verbosity='executionStats')  # detailed statistics about the execution of each stage of the aggregation pipeline
 
-    vector_search_explain = explain_query_execution['stages'][0]['$vectorSearch']
-    millis_elapsed = vector_search_explain['explain']['collectStats']['allCollectorStats']['millisElapsed']
+    return parse_vector_search_explain(explain_query_execution)
 
-    print(f"Total time for the execution to complete on the database server: {millis_elapsed} milliseconds")
 
+async def get_query_stats_async(db, collection, pipeline) -> dict:
+    explain_query_execution = await db.command(
+        'explain', {
+            'aggregate': collection.name,
+            'pipeline': pipeline,
+            'cursor': {}
+        },
+        verbosity='executionStats')
+
+    return parse_vector_search_explain(explain_query_execution)
+
+
+def profile_query(db, collection, pipeline, elapsed_ms: float):
+    # explain only the sampled or slow queries, never on the hot path of every search
+    if db is None:  # local backend, nothing to explain on a server
+        return
+    reason = query_profiler.get_explain_reason(elapsed_ms=elapsed_ms)
+    if reason is None:
+        return
+    try:
+        explain_stats = get_query_stats(db=db, collection=collection, pipeline=pipeline)
+    except Exception as e:
+        explain_stats = {"explain_error": str(e)}
+    query_profiler.record(pipeline=pipeline, elapsed_ms=elapsed_ms, reason=reason, explain_stats=explain_stats)
+
+
+async def profile_query_async(db, collection, pipeline, elapsed_ms: float):
+    reason = query_profiler.get_explain_reason(elapsed_ms=elapsed_ms)
+    if reason is None:
+        return
+    try:
+        explain_stats = await get_query_stats_async(db=db, collection=collection, pipeline=pipeline)
+    except Exception as e:
+        explain_stats = {"explain_error": str(e)}
+    query_profiler.record(pipeline=pipeline, elapsed_ms=elapsed_ms, reason=reason, explain_stats=explain_stats)
+
+
+def get_search_mapping_fields(fields: dict) -> dict:
+    """Atlas Search mappings do not take dotted paths: {"address.country": spec} becomes a nested document mapping."""
+    mapping = {}
+    for path, spec in fields.items():
+        head, _, rest = path.partition(".")
+        if rest:
+            nested = mapping.setdefault(head, {"type": "document", "fields": {}})
+            nested["fields"] = {**nested["fields"], **get_search_mapping_fields({rest: spec})}
+        else:
+            mapping[head] = spec
+    return mapping
+
+
+def get_vs_index_model(vector_search_index_name: str, vector_embedding_field_name: str, filters: dict,
+                       encoding: str = VECTOR_EMBEDDING_ENCODING):
+    if is_quantized_encoding(encoding):
+        # BSON binary vectors can only be indexed by a vectorSearch type index
+        return SearchIndexModel(
+            definition={
+                "fields": [
+                    {
+                        "type": "vector",
+                        "path": vector_embedding_field_name,
+                        "numDimensions": 1536,
+                        # int1 vectors only support euclidean (hamming) distance
+                        "similarity": "euclidean" if encoding == "binary" else "cosine",
+                    },
+                    # fields that can be used in the $vectorSearch filter
+                    *[{"type": "filter", "path": field_name} for field_name in filters],
+                ]
+            },
+            name=vector_search_index_name,
+            type="vectorSearch",
+        )
 
-def get_vs_index_model(vector_search_index_name: str, vector_embedding_field_name: str, filters: dict):
     vs_index_model = SearchIndexModel(
         definition={
             "mappings": {  # describes how fields in the database documents are indexed and stored
@@ -30,7 +108,7 @@ def get_vs_index_model(vector_search_index_name: str, vector_embedding_field_nam
                         "similarity": "cosine",  # algorithm used to compute the similarity between vectors
                         "type": "knnVector",  # selection of similar vectors: KNN Algo
                     },
-                    **filters
+                    **get_search_mapping_fields(filters)
                 },
             }
         },
@@ -40,32 +118,6 @@ def get_vs_index_model(vector_search_index_name: str, vector_embedding_field_nam
     return vs_index_model
 
 
-def create_vs_index(collection_conn, vector_search_index_name: str, vector_search_index_model: dict) -> bool:
-    # Check if the index already exists
-    index_exists = False
-    for index in collection_conn.list_indexes():
-        # print(index['name'])
-        if index['name'] == vector_search_index_name:
-            index_exists = True
-            break
-
-    # Create the index if it doesn't exist
-    if not index_exists:
-        try:
-            result = collection_conn.create_search_index(model=vector_search_index_model)
-            print("Creating index...")
-            time.sleep(20)  # add 20 sec sleep to ensure vector index has compeleted inital sync before utilization
-            print("Wait a few minutes before conducting search with index to ensure index intialization")
-            print("Index created successfully:", result)
-            return True
-        except Exception as e:
-            print(f"Error creating vector search index: {str(e)}")
-            return False
-    else:
-        print(f"Index '{vector_search_index_name}' already exists.")
-        return False
-
-
 def run_vs_for_query(db, collection,
                      query: str,
                      vector_index: str,
@@ -93,48 +145,205 @@ def run_vs_for_query(db, collection,
     if query_embedding is None:
         return "Invalid query or embedding generation failed."
 
+    pipeline = get_pipeline_for_query_embedding(query_embedding=query_embedding,
+                                                vector_index=vector_index,
+                                                text_embedding_field=text_embedding_field,
+                                                additional_stages=additional_stages,
+                                                filters=filters,
+                                                limit=limit)
+    # exact or ANN with numCandidates for the selectivity of the filter, see search_planner
+    pipeline = plan_vector_search(db=db, collection=collection, pipeline=pipeline)
+
+    def search():
+        print("Execute the search")
+
+        # Execute the search using aggregate framework
+        started_at = time.perf_counter()
+        results = list(collection.aggregate(pipeline))
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+
+        # Optional step: sampled explain, see query_profiler
+        profile_query(db=db, collection=collection, pipeline=pipeline, elapsed_ms=elapsed_ms)
+
+        if is_quantized_encoding():
+            return rescore_quantized_vs_results(results=results, query_embedding=query_embedding,
+                                                text_embedding_field=text_embedding_field,
+                                                additional_stages=additional_stages, limit=limit)
+        return results
+
+    # identical searches are answered from the result cache, see result_cache
+    cache = get_vector_search_result_cache()
+    if cache is None:
+        return search()
+    namespace = get_collection_namespace(db, collection)
+    cache_key = get_vector_search_cache_key(namespace=namespace, pipeline=pipeline,
+                                            additional_stages=additional_stages,
+                                            generation=cache.get_generation(namespace))
+    return cache.get_or_compute(cache_key, search)
+
+
+async def run_vs_for_query_async(db, collection,
+                                 query: str,
+                                 vector_index: str,
+                                 text_embedding_field: str,
+                                 additional_stages: list = [],
+                                 filters: dict = {},
+                                 limit: int = 20, ):
+    """
+    Coroutine version of run_vs_for_query. `db` and `collection` come from AsyncMongoConnection.
+    """
+    query_embedding = await get_embedding_async(query)
+
+    if query_embedding is None:
+        return "Invalid query or embedding generation failed."
+
+    pipeline = get_pipeline_for_query_embedding(query_embedding=query_embedding,
+                                                vector_index=vector_index,
+                                                text_embedding_field=text_embedding_field,
+                                                additional_stages=additional_stages,
+                                                filters=filters,
+                                                limit=limit)
+    pipeline = await plan_vector_search_async(db=db, collection=collection, pipeline=pipeline)
+
+    cache = get_vector_search_result_cache()
+    if cache is not None:
+        namespace = get_collection_namespace(db, collection)
+        cache_key = get_vector_search_cache_key(namespace=namespace, pipeline=pipeline,
+                                                additional_stages=additional_stages,
+                                                generation=await cache.get_generation_async(namespace))
+        results = cache.get(cache_key)
+        if results is not None:
+            return results
+    print("Execute the search")
+
+    started_at = time.perf_counter()
+    cursor = await collection.aggregate(pipeline)
+    results = await cursor.to_list()
+    elapsed_ms = (time.perf_counter() - started_at) * 1000
+
+    # Optional step: sampled explain, see query_profiler
+    await profile_query_async(db=db, collection=collection, pipeline=pipeline, elapsed_ms=elapsed_ms)
+
+    if is_quantized_encoding():
+        results = rescore_quantized_vs_results(results=results, query_embedding=query_embedding,
+                                               text_embedding_field=text_embedding_field,
+                                               additional_stages=additional_stages, limit=limit)
+    if cache is not None:
+        cache.set(cache_key, results)
+    return results
+
+
+def get_pipeline_for_query_embedding(query_embedding: list,
+                                     vector_index: str,
+                                     text_embedding_field: str,
+                                     additional_stages: list = [],
+                                     filters: dict = {},
+                                     limit: int = 20) -> list:
+    if is_quantized_encoding():
+        # the additional stages run after re-scoring, see rescore_quantized_vs_results
+        return get_quantized_vs_pipeline(query_embedding=query_embedding,
+                                         vector_index=vector_index,
+                                         text_embedding_field=text_embedding_field,
+                                         additional_stages=additional_stages,
+                                         filters=filters,
+                                         limit=limit)
+    return get_vs_pipeline(query_embedding=query_embedding,
+                           vector_index=vector_index,
+                           text_embedding_field=text_embedding_field,
+                           additional_stages=additional_stages,
+                           filters=filters,
+                           limit=limit,
+                           # numCandidates may not be below the limit, e.g. for the MMR candidates
+                           num_candidates=max(150, limit))
+
+
+def get_vs_pipeline(query_embedding: list,
+                    vector_index: str,
+                    text_embedding_field: str,
+                    additional_stages: list = [],
+                    filters: dict = {},
+                    limit: int = 20,
+                    num_candidates: int = 150) -> list:
     # Define the vector search stage using $vectorSearch Operator
     vector_search_stage = {
         "$vectorSearch": {
             "index": vector_index,  # specifies the index to use for the search
             "queryVector": query_embedding,  # the vector representing the query
             "path": text_embedding_field,  # field in the documents containing the vectors to search against
-            "numCandidates": 150,  # number of candidate matches to consider
+            "numCandidates": num_candidates,  # number of candidate matches to consider
             "limit": limit,
             "filter": filters,
         }
     }
 
     # Define the aggregate pipeline with the vector search stage and additional stages
-    pipeline = [vector_search_stage] + additional_stages
-    print("Execute the search")
+    return [vector_search_stage] + additional_stages
 
-    # Execute the search using aggregate framework
-    results = collection.aggregate(pipeline)
-    # print(list(results))
 
-    # Optional step
-    print_query_stats(db=db, collection=collection, pipeline=pipeline)
+def get_rescoring_projection_stage(additional_stages: list, text_embedding_field: str) -> dict:
+    """
+    Last stage of a quantized search: only the full-precision vector for re-scoring and the fields the additional
+    stages, run in-process after re-scoring, read. When those need whole documents only the quantized vector is
+    dropped.
+    """
+    needed = get_paths_needed_by_stages(additional_stages)
+    if needed is WHOLE_DOCUMENT:
+        return {"$unset": text_embedding_field}
+    return get_projection_for_paths(needed | {get_full_precision_field_name(text_embedding_field)})
+
 
-    return list(results)
+def get_quantized_vs_pipeline(query_embedding: list,
+                              vector_index: str,
+                              text_embedding_field: str,
+                              additional_stages: list = [],
+                              filters: dict = {},
+                              limit: int = 20) -> list:
+    # search the quantized vectors for a wider candidate set; the additional stages run after re-scoring
+    candidate_limit = limit * VECTOR_RESCORE_FACTOR
+    projection = get_rescoring_projection_stage(additional_stages=additional_stages,
+                                                text_embedding_field=text_embedding_field)
+    return get_vs_pipeline(query_embedding=encode_vector(query_embedding),
+                           vector_index=vector_index,
+                           text_embedding_field=text_embedding_field,
+                           additional_stages=[projection],
+                           filters=filters,
+                           limit=candidate_limit,
+                           num_candidates=max(150, candidate_limit))
+
+
+def rescore_quantized_vs_results(results: list, query_embedding: list, text_embedding_field: str,
+                                 additional_stages: list = [], limit: int = 20) -> list:
+    """
+    Re-ranks the candidates of a quantized search against their full-precision vectors, keeps the best `limit` and
+    then applies the additional stages in-process, with vectorSearchScore being the re-scored similarity.
+    """
+    rows = rescore_with_full_precision(documents=results, query_vector=query_embedding,
+                                       vector_embedding_field_name=text_embedding_field, limit=limit)
+    return run_pipeline(rows, additional_stages)
 
 
 def index_vector_embeddings(collection_conn,
                             vector_search_index_name: str,
                             vector_embedding_field_name: str,
-                            vector_index_pre_filters: dict = {}) -> bool:
+                            vector_index_pre_filters: dict = {},
+                            wait: bool = True) -> bool:
     """
     vector_search_index_name:  MongoDB Atlas Vector Search index name
     vector_embedding_field_name:  The field containing the text embeddings on each document
     vector_index_pre_filters: The filters to be added at the time index creation
+    wait: block until the index is queryable
 
     Creates an index of vector embeddings based on the vector embeddings present in vector embedding field of the
-    document inside the Mongo collection
+    document inside the Mongo collection, or updates it when its definition changed
     """
 
     vector_search_index_model = get_vs_index_model(vector_search_index_name=vector_search_index_name,
                                                    vector_embedding_field_name=vector_embedding_field_name,
                                                    filters=vector_index_pre_filters)
-    return create_vs_index(collection_conn=collection_conn,
-                           vector_search_index_name=vector_search_index_name,
-                           vector_search_index_model=vector_search_index_model)
+    try:
+        return search_index_manager.ensure_index(collection_conn=collection_conn,
+                                                 search_index_model=vector_search_index_model,
+                                                 wait=wait)
+    except Exception as e:
+        print(f"Error creating vector search index: {str(e)}")
+        return False
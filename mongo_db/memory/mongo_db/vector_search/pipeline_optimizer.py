@@ -0,0 +1,212 @@
+"""
+Rewrites the additional stages of a search pipeline into an equivalent, cheaper list before it is run.
+
+    merge    adjacent $addFields / $set stages become one; a field of the first stage that the second reads is
+             inlined as its expression, since the expressions of one stage see the document as it was before it
+    prune    fields added but never read by a later stage or the final $project are dropped, and stages that do
+             nothing ($match {}, $addFields {}, $skip 0, ...) are removed
+    project  when the stages end in an inclusion $project, a $project of only the fields the stages read and return
+             is inserted after the leading $match stages, so $addFields and $sort no longer carry whole listings with
+             their embeddings
+
+The leading $match stages stay in front: the MMR search runs them before its selection (see mmr). Stages the
+optimizer does not know (e.g. $lookup) make it assume that the whole document is needed.
+"""
+from common_utils import get_env_key
+
+VS_PIPELINE_OPTIMIZER_ENABLED = get_env_key('VS_PIPELINE_OPTIMIZER_ENABLED', 'true').lower() == 'true'
+
+# stands for "every field of the document"
+WHOLE_DOCUMENT = None
+
+_ADD_FIELDS_STAGES = ("$addFields", "$set")
+
+
+def _stage(stage: dict) -> tuple:
+    (name, spec), = stage.items()
+    return name, spec
+
+
+def _is_inclusion(value) -> bool:
+    return value is True or (isinstance(value, (int, float)) and not isinstance(value, bool) and value != 0)
+
+
+def _is_exclusion(value) -> bool:
+    return value is False or (isinstance(value, (int, float)) and not isinstance(value, bool) and value == 0)
+
+
+def _overlaps(path: str, other: str) -> bool:
+    """Whether one of the paths is the other or lies under it."""
+    return path == other or path.startswith(f"{other}.") or other.startswith(f"{path}.")
+
+
+def expression_paths(expression, paths: set) -> bool:
+    """Adds the field paths an aggregation expression reads to `paths`; False when it reads the whole document."""
+    if isinstance(expression, str):
+        if expression.startswith("$$"):
+            return not expression.split(".")[0] in ("$$ROOT", "$$CURRENT")
+        if expression.startswith("$"):
+            paths.add(expression[1:])
+        return True
+    if isinstance(expression, list):
+        return all(expression_paths(e, paths) for e in expression)
+    if isinstance(expression, dict):
+        return all(expression_paths(v, paths) for k, v in expression.items() if k != "$literal")
+    return True
+
+
+def match_paths(query: dict, paths: set) -> bool:
+    for key, condition in query.items():
+        if key in ("$and", "$or", "$nor"):
+            if not all(match_paths(q, paths) for q in condition):
+                return False
+        elif key == "$expr":
+            if not expression_paths(condition, paths):
+                return False
+        elif not key.startswith("$"):
+            paths.add(key)
+    return True
+
+
+def inline_fields(expression, fields: dict):
+    """The expression with every reference to a field of `fields` replaced by that field's expression."""
+    if isinstance(expression, str) and expression.startswith("$") and not expression.startswith("$$"):
+        return fields.get(expression[1:], expression)
+    if isinstance(expression, list):
+        return [inline_fields(e, fields) for e in expression]
+    if isinstance(expression, dict):
+        return {k: v if k == "$literal" else inline_fields(v, fields) for k, v in expression.items()}
+    return expression
+
+
+def merge_add_fields(first: dict, second: dict):
+    """One $addFields spec equivalent to `first` followed by `second`, or None when they cannot be combined."""
+    read = set()
+    if not all(expression_paths(e, read) for e in second.values()):
+        return None
+    for path in read:
+        # only references to a whole field of the first stage can be inlined
+        if any(_overlaps(path, key) and path != key for key in first):
+            return None
+    for key in second:
+        if any(_overlaps(key, other) and key != other for other in first):
+            return None
+    return {**first, **{key: inline_fields(expression, first) for key, expression in second.items()}}
+
+
+def merge_adjacent_stages(stages: list) -> list:
+    merged = []
+    for stage in stages:
+        name, spec = _stage(stage)
+        if merged and name in _ADD_FIELDS_STAGES and _stage(merged[-1])[0] in _ADD_FIELDS_STAGES:
+            combined = merge_add_fields(_stage(merged[-1])[1], spec)
+            if combined is not None:
+                merged[-1] = {"$addFields": combined}
+                continue
+        merged.append(stage)
+    return merged
+
+
+def is_noop_stage(stage: dict) -> bool:
+    name, spec = _stage(stage)
+    if name in ("$match", "$sort", "$unset") + _ADD_FIELDS_STAGES:
+        return not spec
+    return name == "$skip" and spec == 0
+
+
+def get_needed_paths(stage: dict, needed):
+    """
+    The fields a stage needs from its input for the fields `needed` from its output, WHOLE_DOCUMENT for all of them.
+    """
+    name, spec = _stage(stage)
+    paths = set()
+    if name == "$project":
+        fields = {k: v for k, v in spec.items() if k != "_id"}
+        if all(_is_exclusion(v) for v in fields.values()):
+            return needed
+        if not _is_exclusion(spec.get("_id", 1)):
+            paths.add("_id")
+        for path, value in fields.items():
+            if _is_inclusion(value):
+                paths.add(path)
+            elif not expression_paths(value, paths):
+                return WHOLE_DOCUMENT
+        return paths
+    if name in _ADD_FIELDS_STAGES:
+        if needed is WHOLE_DOCUMENT:
+            return WHOLE_DOCUMENT
+        # fields the stage sets completely are not needed from its input
+        paths = {p for p in needed if not any(p == key or p.startswith(f"{key}.") for key in spec)}
+        for key, expression in spec.items():
+            if not expression_paths(expression, paths):
+                return WHOLE_DOCUMENT
+        return paths
+    if name == "$match":
+        if needed is WHOLE_DOCUMENT or not match_paths(spec, paths):
+            return WHOLE_DOCUMENT
+        return needed | paths
+    if name == "$sort":
+        if needed is WHOLE_DOCUMENT:
+            return WHOLE_DOCUMENT
+        return needed | {path for path, direction in spec.items() if not isinstance(direction, dict)}
+    if name in ("$limit", "$skip", "$unset"):
+        return needed
+    return WHOLE_DOCUMENT
+
+
+def get_paths_needed_by_stages(stages: list):
+    """The fields the stages read from their input, WHOLE_DOCUMENT when they read or return whole documents."""
+    needed = WHOLE_DOCUMENT
+    for stage in reversed(stages):
+        needed = get_needed_paths(stage, needed)
+    return needed
+
+
+def prune_add_fields(stage: dict, needed) -> dict:
+    """The $addFields stage without the fields nothing after it reads."""
+    name, spec = _stage(stage)
+    if name not in _ADD_FIELDS_STAGES or needed is WHOLE_DOCUMENT:
+        return stage
+    return {name: {key: expression for key, expression in spec.items()
+                   if any(_overlaps(key, path) for path in needed)}}
+
+
+def get_projection_for_paths(paths: set) -> dict:
+    # a path under another one would be a path collision in $project
+    paths = sorted(p for p in paths if not any(p.startswith(f"{other}.") for other in paths))
+    projection = {} if "_id" in paths else {"_id": 0}
+    projection.update({path: 1 for path in paths})
+    return {"$project": projection}
+
+
+def optimize_stages(stages: list) -> list:
+    """Returns stages equivalent to `stages`, see the module docstring."""
+    stages = [stage for stage in merge_adjacent_stages(stages) if not is_noop_stage(stage)]
+
+    # backwards: prune each stage for what the stages after it need
+    needed = WHOLE_DOCUMENT
+    pruned = []
+    for stage in reversed(stages):
+        stage = prune_add_fields(stage, needed)
+        if is_noop_stage(stage):
+            continue
+        needed = get_needed_paths(stage, needed)
+        pruned.append((stage, needed))
+    pruned.reverse()
+    stages = [stage for stage, _ in pruned]
+
+    leading_matches = 0
+    while leading_matches < len(stages) and _stage(stages[leading_matches])[0] == "$match":
+        leading_matches += 1
+    if leading_matches == len(stages) or _stage(stages[leading_matches])[0] == "$project":
+        return stages
+    needed = pruned[leading_matches][1]
+    if needed is WHOLE_DOCUMENT:
+        return stages
+    return stages[:leading_matches] + [get_projection_for_paths(needed)] + stages[leading_matches:]
+
+
+def get_optimized_stages(stages: list) -> list:
+    if not VS_PIPELINE_OPTIMIZER_ENABLED:
+        return stages
+    return optimize_stages(stages)
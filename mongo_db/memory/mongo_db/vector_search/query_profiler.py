@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import deque
+
+from common_utils import get_env_key
+
+# explain collection is opt-in: it sends a second aggregate with executionStats to the cluster
+VS_PROFILING_ENABLED = get_env_key('VS_PROFILING_ENABLED', 'false').lower() == 'true'
+# explain 1 in N queries; 0 disables sampling
+VS_PROFILING_SAMPLE_RATE = int(get_env_key('VS_PROFILING_SAMPLE_RATE', '100'))
+# always explain queries whose client side latency is at least this; 0 disables the slow query log
+VS_SLOW_QUERY_THRESHOLD_MS = float(get_env_key('VS_SLOW_QUERY_THRESHOLD_MS', '500'))
+# number of profiles kept in memory
+VS_PROFILE_LOG_SIZE = int(get_env_key('VS_PROFILE_LOG_SIZE', '500'))
+
+
+def parse_vector_search_explain(explain_query_execution: dict) -> dict:
+    """Extracts the $vectorSearch collector stats from an explain(executionStats) response."""
+    vector_search_explain = explain_query_execution['stages'][0]['$vectorSearch']
+    collector_stats = vector_search_explain['explain']['collectStats']['allCollectorStats']
+    return {
+        "server_millis_elapsed": collector_stats.get('millisElapsed'),
+        "collector_stats": collector_stats,
+    }
+
+
+def summarise_pipeline(pipeline: list) -> dict:
+    # the query vector is 1536 floats; keep only the parameters that explain the cost of the query
+    vector_search = pipeline[0].get("$vectorSearch", {}) if pipeline else {}
+    return {
+        "index": vector_search.get("index"),
+        "num_candidates": vector_search.get("numCandidates"),
+        "exact": bool(vector_search.get("exact")),
+        "limit": vector_search.get("limit"),
+        "filter": vector_search.get("filter"),
+        "additional_stages": [list(stage.keys())[0] for stage in pipeline[1:]],
+    }
+
+
+class QueryProfiler:
+    """
+    Decides which vector searches get an explain and keeps the parsed results in a bounded ring buffer.
+    """
+
+    def __init__(self, enabled: bool = VS_PROFILING_ENABLED,
+                 sample_rate: int = VS_PROFILING_SAMPLE_RATE,
+                 slow_query_threshold_ms: float = VS_SLOW_QUERY_THRESHOLD_MS,
+                 max_profiles: int = VS_PROFILE_LOG_SIZE):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.slow_query_threshold_ms = slow_query_threshold_ms
+        self._profiles = deque(maxlen=max_profiles)
+        self._query_count = 0
+        self._lock = threading.Lock()
+
+    def get_explain_reason(self, elapsed_ms: float):
+        """Returns why a query should be explained ("slow" or "sampled"), or None to skip the explain."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._query_count += 1
+            query_count = self._query_count
+        if self.slow_query_threshold_ms > 0 and elapsed_ms >= self.slow_query_threshold_ms:
+            return "slow"
+        if self.sample_rate > 0 and query_count % self.sample_rate == 0:
+            return "sampled"
+        return None
+
+    def record(self, pipeline: list, elapsed_ms: float, reason: str, explain_stats: dict):
+        profile = {
+            "timestamp": time.time(),
+            "reason": reason,
+            "elapsed_ms": elapsed_ms,
+            **summarise_pipeline(pipeline),
+            **explain_stats,
+        }
+        with self._lock:
+            self._profiles.append(profile)
+
+    def get_profiles(self, slow_only: bool = False, limit: int = None) -> list:
+        """Most recent profiles first."""
+        with self._lock:
+            profiles = list(reversed(self._profiles))
+        if slow_only:
+            profiles = [p for p in profiles if p["reason"] == "slow"]
+        return profiles[:limit] if limit else profiles
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+
+
+query_profiler = QueryProfiler()
@@ -0,0 +1,196 @@
+"""
+Cache of vector search results.
+
+Entries are keyed by a hash of the collection, the aggregation pipeline (with the query vector) and the stages run
+after it, plus the collection's generation. Ingestion and index rebuilds bump the generation, which makes every
+older entry of that collection unreachable; they age out of the cache by LRU or TTL. Generations are shared by
+all processes, see collection_generation_service.
+
+Two backends:
+    memory  in-process LRU bounded by the pickled size of the results; concurrent identical queries wait for the
+            first one instead of all running the search
+    django  Django's cache framework (CACHES[VS_RESULT_CACHE_DJANGO_ALIAS]), e.g. Redis or Memcached shared by all
+            gunicorn workers
+"""
+import hashlib
+import json
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+from bson.binary import Binary
+
+from common_utils import get_env_key
+from memory.mongo_db.service.collection_generation_service import collection_generations
+
+VS_RESULT_CACHE_ENABLED = get_env_key('VS_RESULT_CACHE_ENABLED', 'false').lower() == 'true'
+# "memory" or "django"
+VS_RESULT_CACHE_BACKEND = get_env_key('VS_RESULT_CACHE_BACKEND', 'memory')
+VS_RESULT_CACHE_DJANGO_ALIAS = get_env_key('VS_RESULT_CACHE_DJANGO_ALIAS', 'default')
+VS_RESULT_CACHE_MAX_BYTES = int(get_env_key('VS_RESULT_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+VS_RESULT_CACHE_TTL_SECONDS = int(get_env_key('VS_RESULT_CACHE_TTL_SECONDS', '300'))
+
+
+def _canonical(value):
+    """JSON serialisable form of pipeline values; equal pipelines give equal output."""
+    if isinstance(value, re.Pattern):
+        return {"$regex": value.pattern, "$flags": value.flags}
+    if isinstance(value, (bytes, Binary)):
+        return {"$binary": bytes(value).hex()}
+    return str(value)
+
+
+def get_vector_search_cache_key(namespace: tuple, pipeline: list, additional_stages: list = (),
+                                generation: int = 0) -> str:
+    digest = hashlib.sha256()
+    stages = []
+    for stage in pipeline:
+        vector_search = stage.get("$vectorSearch")
+        if vector_search is not None and isinstance(vector_search.get("queryVector"), list):
+            # hashing the raw float32 bytes is much cheaper than serialising 1536 floats as text
+            digest.update(np.asarray(vector_search["queryVector"], dtype=np.float32).tobytes())
+            stage = {"$vectorSearch": {k: v for k, v in vector_search.items() if k != "queryVector"}}
+        stages.append(stage)
+    digest.update(json.dumps({"namespace": namespace, "generation": generation, "pipeline": stages,
+                              "additional_stages": list(additional_stages)},
+                             sort_keys=True, default=_canonical).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class MemoryResultCache:
+
+    def __init__(self, max_bytes: int = VS_RESULT_CACHE_MAX_BYTES, ttl_seconds: int = VS_RESULT_CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (created_at, pickled results)
+        self._bytes = 0
+        self._in_flight = {}  # key -> Future of the search being run for it
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_generation(self, namespace: tuple) -> int:
+        return collection_generations.get(namespace)
+
+    async def get_generation_async(self, namespace: tuple) -> int:
+        return await collection_generations.get_async(namespace)
+
+    def _pop(self, key: str):
+        _, data = self._entries.pop(key)
+        self._bytes -= len(data)
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl_seconds > 0 and time.time() - entry[0] > self.ttl_seconds:
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            data = entry[1]
+        # unpickling hands every caller its own copy of the results
+        return pickle.loads(data)
+
+    def set(self, key: str, results: list):
+        data = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (time.time(), data)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def get_or_compute(self, key: str, compute_fn):
+        """Runs compute_fn once for concurrent callers of the same key."""
+        results = self.get(key)
+        if results is not None:
+            return results
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+        if not owner:
+            return pickle.loads(pickle.dumps(future.result()))
+        try:
+            results = compute_fn()
+            future.set_result(results)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+        if isinstance(results, list):
+            self.set(key, results)
+        return results
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "items": len(self._entries), "bytes": self._bytes,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class DjangoResultCache:
+
+    def __init__(self, alias: str = VS_RESULT_CACHE_DJANGO_ALIAS, ttl_seconds: int = VS_RESULT_CACHE_TTL_SECONDS):
+        from django.core.cache import caches
+        self._cache = caches[alias]
+        self.ttl_seconds = ttl_seconds or None
+
+    def get_generation(self, namespace: tuple) -> int:
+        return collection_generations.get(namespace)
+
+    async def get_generation_async(self, namespace: tuple) -> int:
+        return await collection_generations.get_async(namespace)
+
+    def get(self, key: str):
+        return self._cache.get("vs_result:" + key)
+
+    def set(self, key: str, results: list):
+        self._cache.set("vs_result:" + key, results, timeout=self.ttl_seconds)
+
+    def get_or_compute(self, key: str, compute_fn):
+        results = self.get(key)
+        if results is None:
+            results = compute_fn()
+            if isinstance(results, list):
+                self.set(key, results)
+        return results
+
+    def stats(self) -> dict:
+        return {}
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_vector_search_result_cache():
+    """Returns the process wide result cache, or None when it is disabled."""
+    global _result_cache
+    if not VS_RESULT_CACHE_ENABLED:
+        return None
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = DjangoResultCache() if VS_RESULT_CACHE_BACKEND == "django" else MemoryResultCache()
+    return _result_cache
+
+
+def get_collection_namespace(db, collection) -> tuple:
+    """(database name, collection name) of a pymongo collection or a LocalVectorCollection."""
+    if db is None:
+        return getattr(collection, "database_name", None), collection.name
+    return db.name, collection.name
@@ -0,0 +1,52 @@
+"""
+$project stages derived from the Pydantic model that search results are parsed into.
+
+Only the fields the model declares are fetched: nested models are projected field by field (address.location.type,
+...), any other type projects the whole field. A field named `score` receives the vectorSearchScore.
+"""
+import types
+import typing
+
+from pydantic import BaseModel
+
+# result model field that receives {"$meta": "vectorSearchScore"}
+VECTOR_SEARCH_SCORE_FIELD_NAME = "score"
+
+
+def _nested_model(annotation):
+    """The BaseModel inside an annotation such as Address, Optional[Address] or List[Review], else None."""
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation
+    if typing.get_origin(annotation) in (typing.Union, types.UnionType, list, typing.List):
+        models = [m for m in (_nested_model(arg) for arg in typing.get_args(annotation)) if m is not None]
+        return models[0] if len(models) == 1 else None
+    return None
+
+
+def get_projected_paths(model: type[BaseModel], prefix: str = "") -> list:
+    paths = []
+    for name, field in model.model_fields.items():
+        # the document field may be aliased, e.g. `id: int = Field(alias="_id")`
+        path = f"{prefix}{field.alias or name}"
+        nested_model = _nested_model(field.annotation)
+        if nested_model is not None:
+            paths += get_projected_paths(nested_model, prefix=f"{path}.")
+        else:
+            paths.append(path)
+    return paths
+
+
+def get_projection_stage_for_model(model: type[BaseModel], with_score: bool = None) -> dict:
+    """
+    $project stage returning exactly the fields of `model`. The score is projected when the model has a `score`
+    field, unless with_score says otherwise.
+    """
+    if with_score is None:
+        with_score = VECTOR_SEARCH_SCORE_FIELD_NAME in model.model_fields
+    paths = [p for p in get_projected_paths(model) if p != VECTOR_SEARCH_SCORE_FIELD_NAME]
+
+    projection = {} if "_id" in paths else {"_id": 0}
+    projection.update({path: 1 for path in paths})
+    if with_score:
+        projection[VECTOR_SEARCH_SCORE_FIELD_NAME] = {"$meta": "vectorSearchScore"}
+    return {"$project": projection}
@@ -0,0 +1,138 @@
+"""
+Lifecycle of Atlas Search / Vector Search indexes.
+
+Search indexes are not returned by list_indexes(), only by list_search_indexes(). The manager looks an index up by
+name, creates it when missing, updates it only when its definition changed, and polls until Atlas reports it
+queryable. Definitions and status are cached per process, so ensuring an index that is known to be ready costs no
+round trip.
+"""
+import threading
+import time
+
+from common_utils import get_env_key
+from memory.mongo_db.service.collection_generation_service import bump_collection_generation
+
+SEARCH_INDEX_READY_TIMEOUT_SECONDS = float(get_env_key('SEARCH_INDEX_READY_TIMEOUT_SECONDS', '600'))
+SEARCH_INDEX_POLL_INTERVAL_SECONDS = float(get_env_key('SEARCH_INDEX_POLL_INTERVAL_SECONDS', '5'))
+
+
+def definition_matches(expected, actual) -> bool:
+    """True when every setting of `expected` is present in `actual`; Atlas adds defaults to stored definitions."""
+    if isinstance(expected, dict):
+        return isinstance(actual, dict) and all(k in actual and definition_matches(v, actual[k])
+                                                for k, v in expected.items())
+    if isinstance(expected, list):
+        return isinstance(actual, list) and len(expected) == len(actual) and \
+            all(any(definition_matches(e, a) for a in actual) for e in expected)
+    return expected == actual
+
+
+def is_index_ready(index: dict) -> bool:
+    # an updated index stays queryable on its old definition while it is rebuilt, so READY is required as well
+    return index.get("status") == "READY" and bool(index.get("queryable"))
+
+
+class SearchIndexManager:
+
+    def __init__(self,
+                 ready_timeout_seconds: float = SEARCH_INDEX_READY_TIMEOUT_SECONDS,
+                 poll_interval_seconds: float = SEARCH_INDEX_POLL_INTERVAL_SECONDS):
+        self.ready_timeout_seconds = ready_timeout_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        # (db, collection, index name) -> {"definition": ..., "status": ..., "queryable": ...}
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(collection_conn, name: str) -> tuple:
+        return collection_conn.database.name, collection_conn.name, name
+
+    def get_search_index(self, collection_conn, name: str):
+        return next(iter(collection_conn.list_search_indexes(name)), None)
+
+    def get_statuses(self) -> list:
+        with self._lock:
+            return [{"database": key[0], "collection": key[1], "name": key[2], "status": index.get("status"),
+                     "queryable": bool(index.get("queryable"))} for key, index in self._indexes.items()]
+
+    def _remember(self, key: tuple, definition: dict, index: dict):
+        with self._lock:
+            self._indexes[key] = {"definition": definition, "status": index.get("status"),
+                                  "queryable": index.get("queryable")}
+
+    def ensure_index(self, collection_conn, search_index_model, wait: bool = True) -> bool:
+        """
+        Makes sure the index of `search_index_model` exists with its definition, creating or updating it as needed.
+        With wait=True blocks until it is queryable. Returns whether the index is ready.
+        """
+        document = search_index_model.document
+        name, definition = document["name"], document["definition"]
+        key = self._key(collection_conn, name)
+
+        with self._lock:
+            cached = self._indexes.get(key)
+        if cached and cached["definition"] == definition and cached["status"] == "READY" and cached["queryable"]:
+            return True
+
+        index = self.get_search_index(collection_conn, name)
+        if index is None:
+            print(f"Creating search index '{name}' on {key[0]}.{key[1]}")
+            collection_conn.create_search_index(model=search_index_model)
+        elif not definition_matches(definition, index.get("latestDefinition", {})):
+            print(f"Search index '{name}' definition changed, updating it")
+            collection_conn.update_search_index(name, definition)
+        else:
+            self._remember(key, definition, index)
+            if is_index_ready(index) or not wait:
+                return is_index_ready(index)
+
+        # results cached before the rebuild may differ from what the new index returns
+        bump_collection_generation(key[0], key[1])
+        if not wait:
+            self._remember(key, definition, {"status": "PENDING"})
+            return False
+        return self.wait_until_ready(collection_conn, name, definition)
+
+    def get_status(self, collection_conn, name: str) -> dict:
+        """The status Atlas reports for the index, for clients polling an index ensured with wait=False."""
+        key = self._key(collection_conn, name)
+        index = self.get_search_index(collection_conn, name) or {"status": "DOES_NOT_EXIST"}
+        with self._lock:
+            cached = self._indexes.get(key)
+        if cached is not None:
+            if is_index_ready(index) and not (cached["status"] == "READY" and cached["queryable"]):
+                # as in wait_until_ready, for results cached from the old index while the new one was built
+                bump_collection_generation(key[0], key[1])
+            self._remember(key, cached["definition"], index)
+        return {"name": name, "status": index.get("status"), "queryable": bool(index.get("queryable"))}
+
+    def wait_until_ready(self, collection_conn, name: str, definition: dict) -> bool:
+        key = self._key(collection_conn, name)
+        started_at = time.monotonic()
+        while True:
+            index = self.get_search_index(collection_conn, name) or {"status": "DOES_NOT_EXIST"}
+            self._remember(key, definition, index)
+            if is_index_ready(index):
+                print(f"Search index '{name}' is ready after {time.monotonic() - started_at:.0f}s")
+                # and again for results cached from the old index while the new one was built
+                bump_collection_generation(key[0], key[1])
+                return True
+            if index.get("status") == "FAILED":
+                print(f"Search index '{name}' failed to build: {index.get('message')}")
+                return False
+            if time.monotonic() - started_at > self.ready_timeout_seconds:
+                print(f"Search index '{name}' is not ready after {self.ready_timeout_seconds:.0f}s, "
+                      f"status {index.get('status')}")
+                return False
+            time.sleep(self.poll_interval_seconds)
+
+    def forget(self, collection_conn=None, name: str = None):
+        """Drops cached status, e.g. after an index was changed outside this process."""
+        with self._lock:
+            if collection_conn is None:
+                self._indexes = {}
+            else:
+                self._indexes.pop(self._key(collection_conn, name), None)
+
+
+search_index_manager = SearchIndexManager()
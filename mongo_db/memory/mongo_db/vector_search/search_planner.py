@@ -0,0 +1,222 @@
+"""
+Chooses how a $vectorSearch runs from the selectivity of its filter.
+
+    exact  ENN search ("exact": true) when at most VS_PLANNER_EXACT_MAX_DOCUMENTS documents match the filter:
+           scoring every match is cheap and has perfect recall
+    ann    HNSW search with numCandidates = limit * VS_PLANNER_CANDIDATES_PER_RESULT / selectivity, so a selective
+           filter, which discards most of the graph neighbours visited, gets proportionally more candidates and a
+           broad one no more than it needs
+
+The planner is off unless VS_PLANNER_ENABLED is set. Selectivity is the number of documents matching the filter over
+the number in the collection. Both are counted off the request path, in the background, and cached per filter for
+VS_PLANNER_STATS_TTL_SECONDS or until ingestion changes the collection's generation (see
+collection_generation_service): a query whose filter has no counts yet runs as built, one whose counts expired is
+planned with them while they are counted again. A plan is printed when a filter and limit are first planned and
+whenever their plan or the power of two the selectivity falls in changes; VS_PLANNER_DEBUG prints the plan of
+every query.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common_utils import get_env_key
+from memory.mongo_db.service.collection_generation_service import get_collection_generation, \
+    get_collection_generation_async
+
+VS_PLANNER_ENABLED = get_env_key('VS_PLANNER_ENABLED', 'false').lower() == 'true'
+# print the plan of every query, not only when it changes
+VS_PLANNER_DEBUG = get_env_key('VS_PLANNER_DEBUG', 'false').lower() == 'true'
+VS_PLANNER_EXACT_MAX_DOCUMENTS = int(get_env_key('VS_PLANNER_EXACT_MAX_DOCUMENTS', '5000'))
+# candidates per result without a filter; raise it for a higher recall (`manage.py benchmark_vector_search`)
+VS_PLANNER_CANDIDATES_PER_RESULT = float(get_env_key('VS_PLANNER_CANDIDATES_PER_RESULT', '10'))
+VS_PLANNER_STATS_TTL_SECONDS = int(get_env_key('VS_PLANNER_STATS_TTL_SECONDS', '600'))
+
+# Atlas Vector Search limit
+MAX_NUM_CANDIDATES = 10000
+# floor of the selectivity used for scaling, a filter matching almost nothing would otherwise ask for the maximum
+MIN_SELECTIVITY = 0.001
+
+
+def _filter_key(namespace: tuple, filters: dict) -> tuple:
+    return (namespace, hashlib.sha256(json.dumps(filters, sort_keys=True, default=str).encode("utf-8")).hexdigest(),
+            get_collection_generation(*namespace))
+
+
+def choose_plan(matching: int, total: int, limit: int,
+                exact_max_documents: int = VS_PLANNER_EXACT_MAX_DOCUMENTS,
+                candidates_per_result: float = VS_PLANNER_CANDIDATES_PER_RESULT) -> dict:
+    selectivity = matching / total if total else 1.0
+    if matching <= exact_max_documents:
+        return {"mode": "exact", "num_candidates": None, "limit": limit, "matching": matching, "total": total,
+                "selectivity": selectivity}
+    num_candidates = math.ceil(limit * candidates_per_result / max(selectivity, MIN_SELECTIVITY))
+    num_candidates = max(limit, min(num_candidates, MAX_NUM_CANDIDATES, matching))
+    return {"mode": "ann", "num_candidates": num_candidates, "limit": limit, "matching": matching, "total": total,
+            "selectivity": selectivity}
+
+
+def get_plan_signature(plan: dict) -> tuple:
+    """What a printed plan stands for: plans of a filter and limit with the same signature are printed once."""
+    selectivity_bucket = math.floor(math.log2(max(plan["selectivity"], MIN_SELECTIVITY)))
+    return plan["mode"], plan["num_candidates"], selectivity_bucket
+
+
+def apply_plan(pipeline: list, plan: dict) -> list:
+    """Returns the pipeline with its $vectorSearch stage running as planned."""
+    vector_search = {k: v for k, v in pipeline[0]["$vectorSearch"].items() if k not in ("numCandidates", "exact")}
+    if plan["mode"] == "exact":
+        vector_search["exact"] = True
+    else:
+        vector_search["numCandidates"] = plan["num_candidates"]
+    return [{"$vectorSearch": vector_search}] + pipeline[1:]
+
+
+def format_plan(plan: dict) -> str:
+    candidates = f", numCandidates {plan['num_candidates']}" if plan["mode"] == "ann" else ""
+    return (f"Vector search plan: {plan['mode']}{candidates}, limit {plan['limit']}, "
+            f"{plan['matching']}/{plan['total']} documents match the filter ({plan['selectivity']:.2%})")
+
+
+class SearchPlanner:
+
+    def __init__(self, ttl_seconds: int = VS_PLANNER_STATS_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        # (namespace, filter hash) -> (counted_at, matching, total)
+        self._counts = {}
+        # ((namespace, filter hash, generation), limit) -> signature of the plan printed last
+        self._printed_plans = {}
+        # filter keys being counted, and the tasks counting on an event loop
+        self._counting = set()
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def _get_cached(self, key: tuple) -> tuple:
+        """The cached (matching, total) or None, and whether they need counting (missing or expired)."""
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl_seconds:
+                return (entry[1], entry[2]), False
+            is_due = key not in self._counting
+            if is_due:
+                self._counting.add(key)
+        return (entry[1], entry[2]) if entry else None, is_due
+
+    def _remember(self, key: tuple, matching: int, total: int):
+        with self._lock:
+            self._counts[key] = (time.time(), matching, total)
+
+    def _counted(self, key: tuple):
+        with self._lock:
+            self._counting.discard(key)
+
+    def _count(self, collection, key: tuple, filters: dict):
+        try:
+            total = collection.estimated_document_count()
+            matching = collection.count_documents(filters) if filters else total
+            self._remember(key, matching, total)
+        except Exception as e:
+            print(f"Vector search planner could not count the filter, its queries run as built: {e}")
+        finally:
+            self._counted(key)
+
+    async def _count_async(self, collection, key: tuple, filters: dict):
+        try:
+            total = await collection.estimated_document_count()
+            matching = await collection.count_documents(filters) if filters else total
+            self._remember(key, matching, total)
+        except Exception as e:
+            print(f"Vector search planner could not count the filter, its queries run as built: {e}")
+        finally:
+            self._counted(key)
+
+    def get_counts(self, collection, namespace: tuple, filters: dict):
+        """
+        Cached (matching, total) of the filter, None before its first count. Missing and expired counts are counted
+        on the planner's thread; the query does not wait for them.
+        """
+        key = _filter_key(namespace, filters)
+        counts, is_due = self._get_cached(key)
+        if is_due:
+            _planner_executor.submit(self._count, collection, key, filters)
+        return counts
+
+    async def get_counts_async(self, collection, namespace: tuple, filters: dict):
+        """Coroutine version of get_counts, counting in a task of the running loop."""
+        key = _filter_key(namespace, filters)
+        counts, is_due = self._get_cached(key)
+        if is_due:
+            task = asyncio.get_running_loop().create_task(self._count_async(collection, key, filters))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return counts
+
+    def is_new_plan(self, namespace: tuple, filters: dict, plan: dict) -> bool:
+        """Whether the plan differs from the one printed last for the filter and limit, remembering it if so."""
+        key = _filter_key(namespace, filters), plan["limit"]
+        signature = get_plan_signature(plan)
+        with self._lock:
+            if self._printed_plans.get(key) == signature:
+                return False
+            self._printed_plans[key] = signature
+            return True
+
+    def invalidate(self, db_name: str, collection_name: str):
+        with self._lock:
+            self._counts = {k: v for k, v in self._counts.items() if k[0] != (db_name, collection_name)}
+            self._printed_plans = {k: v for k, v in self._printed_plans.items()
+                                   if k[0][0] != (db_name, collection_name)}
+
+
+_planner_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vs-planner")
+search_planner = SearchPlanner()
+
+
+def _is_plannable(db, pipeline: list) -> bool:
+    # the local backend has no ANN/ENN distinction to plan
+    return VS_PLANNER_ENABLED and db is not None and bool(pipeline) and "$vectorSearch" in pipeline[0]
+
+
+def _planned(pipeline: list, namespace: tuple, filters: dict, counts) -> list:
+    if counts is None:
+        if VS_PLANNER_DEBUG:
+            print(f"Vector search plan: as built, the filter of {namespace[0]}.{namespace[1]} is being counted")
+        return pipeline
+    plan = choose_plan(matching=counts[0], total=counts[1], limit=pipeline[0]["$vectorSearch"]["limit"])
+    if search_planner.is_new_plan(namespace, filters, plan) or VS_PLANNER_DEBUG:
+        print(format_plan(plan))
+    return apply_plan(pipeline, plan)
+
+
+def plan_vector_search(db, collection, pipeline: list) -> list:
+    """Returns the pipeline with numCandidates or exact chosen by the planner; unchanged when it is disabled."""
+    if not _is_plannable(db, pipeline):
+        return pipeline
+    namespace, filters = (db.name, collection.name), pipeline[0]["$vectorSearch"].get("filter") or {}
+    try:
+        counts = search_planner.get_counts(collection, namespace, filters)
+    except Exception as e:
+        print(f"Vector search planner failed, running the query as built: {e}")
+        return pipeline
+    return _planned(pipeline, namespace, filters, counts)
+
+
+async def plan_vector_search_async(db, collection, pipeline: list) -> list:
+    if not _is_plannable(db, pipeline):
+        return pipeline
+    namespace, filters = (db.name, collection.name), pipeline[0]["$vectorSearch"].get("filter") or {}
+    try:
+        # read without blocking the loop; the cache keys of the counts and plans below then find it up to date
+        await get_collection_generation_async(*namespace)
+        counts = await search_planner.get_counts_async(collection, namespace, filters)
+    except Exception as e:
+        print(f"Vector search planner failed, running the query as built: {e}")
+        return pipeline
+    return _planned(pipeline, namespace, filters, counts)
+
+
+def invalidate_search_planner(db_name: str, collection_name: str):
+    search_planner.invalidate(db_name, collection_name)
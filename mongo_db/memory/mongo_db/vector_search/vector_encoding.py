@@ -0,0 +1,105 @@
+"""
+Storage encodings of the embedding field.
+
+    float   BSON array of doubles (8 bytes per dimension), indexed as knnVector; the original format
+    int8    BSON binary vector of int8 (1 byte per dimension), scalar quantized per vector
+    binary  BSON binary vector of packed bits (1 bit per dimension), the sign of each dimension
+
+With the quantized encodings a float32 copy of the vector is stored next to it as a BSON binary vector
+(4 bytes per dimension, not indexed). The ANN search runs on the quantized vectors with a wider limit and the
+candidates are re-scored against the full-precision copy.
+"""
+import numpy as np
+from bson.binary import Binary, BinaryVectorDtype
+
+from common_utils import get_env_key
+
+VECTOR_EMBEDDING_ENCODING = get_env_key('VECTOR_EMBEDDING_ENCODING', 'float')
+# quantized searches fetch limit * this many candidates for re-scoring at full precision
+VECTOR_RESCORE_FACTOR = int(get_env_key('VECTOR_RESCORE_FACTOR', '4'))
+
+VECTOR_ENCODINGS = ("float", "int8", "binary")
+FULL_PRECISION_FIELD_SUFFIX = "_full_precision"
+
+
+def is_quantized_encoding(encoding: str = VECTOR_EMBEDDING_ENCODING) -> bool:
+    if encoding not in VECTOR_ENCODINGS:
+        raise ValueError(f"Unknown vector encoding '{encoding}', expected one of {VECTOR_ENCODINGS}")
+    return encoding != "float"
+
+
+def get_full_precision_field_name(vector_embedding_field_name: str) -> str:
+    return f"{vector_embedding_field_name}{FULL_PRECISION_FIELD_SUFFIX}"
+
+
+def quantize_int8(vector) -> Binary:
+    vector = np.asarray(vector, dtype=np.float32)
+    # per vector scale: cosine similarity does not depend on the vector's length
+    scale = np.abs(vector).max()
+    quantized = np.round(vector / scale * 127) if scale else np.zeros_like(vector)
+    return Binary.from_vector(quantized.astype(np.int8).tolist(), BinaryVectorDtype.INT8)
+
+
+def quantize_binary(vector) -> Binary:
+    vector = np.asarray(vector, dtype=np.float32)
+    packed = np.packbits(vector > 0)
+    return Binary.from_vector(packed.tolist(), BinaryVectorDtype.PACKED_BIT, padding=(-len(vector)) % 8)
+
+
+def encode_full_precision(vector) -> Binary:
+    return Binary.from_vector(np.asarray(vector, dtype=np.float32).tolist(), BinaryVectorDtype.FLOAT32)
+
+
+def encode_vector(vector, encoding: str = VECTOR_EMBEDDING_ENCODING):
+    """Encodes a document or query vector the way the index expects it."""
+    if encoding == "int8":
+        return quantize_int8(vector)
+    if encoding == "binary":
+        return quantize_binary(vector)
+    return vector
+
+
+def decode_vector(value) -> np.ndarray:
+    """Float32 array from a BSON array or binary vector; packed bits become +1/-1 per dimension."""
+    if isinstance(value, Binary):
+        binary_vector = value.as_vector()
+        if binary_vector.dtype == BinaryVectorDtype.PACKED_BIT:
+            bits = np.unpackbits(np.asarray(binary_vector.data, dtype=np.uint8))
+            bits = bits[:bits.size - binary_vector.padding]
+            return bits.astype(np.float32) * 2 - 1
+        return np.asarray(binary_vector.data, dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def encode_document_embeddings(document: dict, vector_embedding_field_name: str,
+                               encoding: str = VECTOR_EMBEDDING_ENCODING) -> dict:
+    """Returns the document with its embedding stored in `encoding`, plus the full-precision copy when quantized."""
+    vector = document.get(vector_embedding_field_name)
+    if not is_quantized_encoding(encoding) or vector is None:
+        return document
+    return {
+        **document,
+        vector_embedding_field_name: encode_vector(vector, encoding=encoding),
+        get_full_precision_field_name(vector_embedding_field_name): encode_full_precision(vector),
+    }
+
+
+def rescore_with_full_precision(documents: list, query_vector, vector_embedding_field_name: str,
+                                limit: int) -> list:
+    """
+    Re-ranks ANN candidates by exact cosine similarity against their full-precision vectors. Returns the best
+    `limit` as (document, score) pairs, score normalised to [0, 1] like vectorSearchScore, with the full-precision
+    field removed from the documents.
+    """
+    full_precision_field = get_full_precision_field_name(vector_embedding_field_name)
+    candidates = [doc for doc in documents if doc.get(full_precision_field) is not None]
+    if not candidates:
+        return []
+    vectors = np.stack([decode_vector(doc[full_precision_field]) for doc in candidates])
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query_vector = np.asarray(query_vector, dtype=np.float32)
+    query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+    similarities = vectors @ query_vector
+    order = np.argsort(-similarities, kind="stable")[:limit]
+    return [({k: v for k, v in candidates[i].items() if k != full_precision_field}, float((1 + similarities[i]) / 2))
+            for i in order.tolist()]
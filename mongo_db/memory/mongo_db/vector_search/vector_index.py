@@ -0,0 +1,92 @@
+"""
+Vector indexes used by the local vector search backend.
+
+Every index stores unit vectors addressed by position (the order they were added in) and implements
+    add(vectors) -> positions, delete(positions), search(query_vector, k, mask) -> (positions, similarities),
+    get_vectors(positions) -> (len(positions), dimensions) unit vectors
+where `mask` is an optional boolean array over positions that restricts which vectors may be returned, and
+`exact=True` asks an approximate index for the exact answer.
+"""
+import numpy as np
+
+
+def normalise_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(vectors / norms, dtype=np.float32)
+
+
+def top_k(similarities: np.ndarray, k: int):
+    """Positions and values of the k largest similarities, best first."""
+    k = min(k, similarities.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    positions = np.argpartition(-similarities, k - 1)[:k]
+    positions = positions[np.argsort(-similarities[positions], kind="stable")]
+    return positions, similarities[positions]
+
+
+def grow_rows(array: np.ndarray, min_rows: int, fill_value=0) -> np.ndarray:
+    """Returns `array` with at least min_rows rows, doubling the capacity to keep appends amortised O(1)."""
+    if array.shape[0] >= min_rows:
+        return array
+    capacity = max(min_rows, 2 * array.shape[0], 16)
+    grown = np.full((capacity,) + array.shape[1:], fill_value, dtype=array.dtype)
+    grown[:array.shape[0]] = array
+    return grown
+
+
+def get_allowed_positions(deleted: np.ndarray, size: int, mask: np.ndarray = None) -> np.ndarray:
+    """Boolean array over the first `size` positions: not deleted and, when given, selected by mask."""
+    allowed = ~deleted[:size]
+    if mask is not None:
+        covered = min(size, mask.shape[0])
+        allowed[:covered] &= mask[:covered]
+        allowed[covered:] = False
+    return allowed
+
+
+def recall_at_k(approximate_positions, exact_positions) -> float:
+    """Fraction of the exact top-k that the approximate search also returned."""
+    exact = set(int(p) for p in exact_positions)
+    if not exact:
+        return 1.0
+    return len(exact.intersection(int(p) for p in approximate_positions)) / len(exact)
+
+
+class ExactVectorIndex:
+    """Brute force cosine search over unit vectors."""
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+        self.size = 0
+        self._vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self._deleted = np.zeros(0, dtype=bool)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[:self.size]
+
+    def get_vectors(self, positions) -> np.ndarray:
+        return self._vectors[np.asarray(positions, dtype=np.int64)]
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = normalise_rows(vectors)
+        positions = np.arange(self.size, self.size + vectors.shape[0])
+        self._vectors = grow_rows(self._vectors, self.size + vectors.shape[0])
+        self._deleted = grow_rows(self._deleted, self.size + vectors.shape[0], fill_value=False)
+        self._vectors[positions] = vectors
+        self.size += vectors.shape[0]
+        return positions
+
+    def delete(self, positions):
+        self._deleted[np.asarray(positions, dtype=np.int64)] = True
+
+    def search(self, query_vector: np.ndarray, k: int, mask: np.ndarray = None, exact: bool = True):
+        similarities = self.vectors @ query_vector
+        allowed = get_allowed_positions(self._deleted, self.size, mask)
+        similarities = np.where(allowed, similarities, -np.inf)
+        return top_k(similarities, min(k, int(allowed.sum())))
@@ -0,0 +1,35 @@
+"""
+Which predicates of the post $match stages filter_pushdown moves into the $vectorSearch filter.
+
+Run with `python -m pytest memory/tests` from mongo_db/.
+"""
+import re
+
+from memory.mongo_db.service.mongo_sample_data_service import get_post_filter_stage_for_sample_data, \
+    get_vector_index_filter_fields_for_sample_data
+from memory.mongo_db.vector_search.filter_pushdown import PUSHDOWN_OVERFETCH_FACTOR, push_down_filters
+
+FILTER_FIELDS = get_vector_index_filter_fields_for_sample_data()
+
+
+def test_keeps_the_substring_country_regex_in_the_match():
+    filters, stages, limit = push_down_filters(filters={}, additional_stages=[get_post_filter_stage_for_sample_data()],
+                                               filter_fields=FILTER_FIELDS, limit=20)
+
+    assert filters == {"accommodates": {"$gt": 1, "$lt": 5}}
+    assert stages == [{"$match": {"address.country": re.compile(r"United States")}}, {"$limit": 20}]
+    assert limit == 20 * PUSHDOWN_OVERFETCH_FACTOR
+
+
+def test_pushes_only_exact_match_regexes():
+    match = {"$match": {"address.country": re.compile(r"^United States$")}}
+    regexes = [re.compile(pattern) for pattern in (r"United States", r"^United", r"States$", r"^United.*$")]
+    for regex in regexes + [{"$regex": "Spain"}, {"$regex": "^Spain$", "$options": "i"}]:
+        filters, stages, _ = push_down_filters(filters={}, additional_stages=[{"$match": {"address.country": regex}}],
+                                               filter_fields=FILTER_FIELDS)
+        assert filters == {} and len(stages) == 1
+
+    filters, stages, _ = push_down_filters(filters={}, additional_stages=[match], filter_fields=FILTER_FIELDS)
+
+    assert filters == {"address.country": {"$eq": "United States"}}
+    assert stages == []
@@ -0,0 +1,88 @@
+"""
+Recall and persistence of the HNSW index of the local vector search backend.
+
+Run with `python -m pytest memory/tests` from mongo_db/. The recall test builds a graph slightly larger than
+HNSW_BRUTE_FORCE_THRESHOLD, so unfiltered searches go through the graph rather than the exact fallback.
+"""
+import numpy as np
+import pytest
+
+from memory.mongo_db.vector_search.hnsw_index import HNSWVectorIndex, HNSW_BRUTE_FORCE_THRESHOLD
+from memory.mongo_db.vector_search.local_vector_search import LocalVectorCollection
+from memory.mongo_db.vector_search.vector_index import normalise_rows
+
+DIMENSIONS = 32
+K = 20
+
+
+def get_clustered_vectors(count: int, seed: int = 0) -> np.ndarray:
+    # listings embed in clusters rather than uniformly, which is the harder case for a proximity graph
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((100, DIMENSIONS))
+    return (centers[rng.integers(0, 100, count)] + 0.5 * rng.standard_normal((count, DIMENSIONS))).astype(np.float32)
+
+
+def get_queries(vectors: np.ndarray, count: int, seed: int = 1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), count)] + 0.3 * rng.standard_normal((count, DIMENSIONS))
+    return normalise_rows(queries.astype(np.float32))
+
+
+def get_recall(index: HNSWVectorIndex, vectors: np.ndarray, queries: np.ndarray) -> float:
+    similarities = normalise_rows(vectors) @ queries.T
+    recalls = []
+    for i, query in enumerate(queries):
+        truth = np.argpartition(-similarities[:, i], K)[:K]
+        positions, _ = index.search(query, K)
+        recalls.append(len(set(truth.tolist()) & set(positions.tolist())) / K)
+    return float(np.mean(recalls))
+
+
+@pytest.fixture(scope="module")
+def vectors() -> np.ndarray:
+    return get_clustered_vectors(HNSW_BRUTE_FORCE_THRESHOLD + 500)
+
+
+@pytest.fixture(scope="module")
+def index(vectors) -> HNSWVectorIndex:
+    index = HNSWVectorIndex(dimensions=DIMENSIONS)
+    index.add(vectors)
+    return index
+
+
+def test_recall_at_20_above_brute_force_threshold(index, vectors):
+    assert index.size > index.brute_force_threshold
+
+    assert get_recall(index, vectors, get_queries(vectors, 100)) >= 0.95
+
+
+def test_saved_graph_answers_like_the_built_one(index, vectors, tmp_path):
+    path = str(tmp_path / "graph.npz")
+    index.delete([0, 1, 2])
+
+    index.save(path, metadata={"ids": ["a"]})
+    loaded = HNSWVectorIndex.load(path)
+
+    assert loaded.metadata == {"ids": ["a"]}
+    assert loaded.size == index.size
+    for query in get_queries(vectors, 10, seed=2):
+        assert loaded.search(query, K)[0].tolist() == index.search(query, K)[0].tolist()
+    assert not {0, 1, 2} & set(loaded.search(normalise_rows(vectors[:1])[0], K)[0].tolist())
+
+
+def test_sync_only_inserts_new_and_changed_documents():
+    vectors = get_clustered_vectors(50)
+    documents = [{"_id": i, "embedding": vector.tolist()} for i, vector in enumerate(vectors)]
+    collection = LocalVectorCollection(name="listings", documents=documents, embedding_field="embedding",
+                                       index_type="hnsw")
+
+    changed = {"_id": 0, "embedding": (-vectors[0]).tolist()}
+    new = {"_id": 50, "embedding": vectors[1].tolist()}
+    counts = collection.sync_documents([changed] + documents[1:49] + [new])
+
+    assert counts == {"kept": 48, "inserted": 2, "deleted": 2}
+    assert collection.index.size == 52
+    best, _ = collection.vector_search({"path": "embedding", "queryVector": (-vectors[0]).tolist(), "limit": 1,
+                                        "numCandidates": 10})[0]
+    assert best["_id"] == 0
+    assert 49 not in collection._positions_by_id
@@ -0,0 +1,108 @@
+"""
+Rewrites of pipeline_optimizer on the document boosting stages of the sample data.
+
+Run with `python -m pytest memory/tests` from mongo_db/. The explain test runs the optimized stages against the
+sample collection and is skipped when MONGO_URI is not set.
+"""
+import pytest
+
+from memory.mongo_db.db.mongo_client import MONGO_URI, MongoConnection
+from memory.mongo_db.service.mongo_sample_data_service import get_db_and_collection_for_sample_data, \
+    get_post_filter_stage_for_sample_data, \
+    get_average_review_score_based_document_boosting_post_filter_for_sample_data, \
+    get_weighted_average_review_based_document_boosting_post_filter_for_sample_data, \
+    get_sorting_based_document_boosting_post_filter_for_sample_data
+from memory.mongo_db.vector_search.local_pipeline import run_pipeline
+from memory.mongo_db.vector_search.pipeline_optimizer import optimize_stages
+
+RESULT_PROJECTION_STAGE = {"$project": {"_id": 0, "name": 1, "combinedScore": 1}}
+
+
+def get_boosting_stages() -> list:
+    # the stages of RunRAGQueryWithDocumentBoosting, ending in the projection of its result model
+    return [
+        get_post_filter_stage_for_sample_data(),
+        get_average_review_score_based_document_boosting_post_filter_for_sample_data(),
+        get_weighted_average_review_based_document_boosting_post_filter_for_sample_data(),
+        get_sorting_based_document_boosting_post_filter_for_sample_data(),
+        RESULT_PROJECTION_STAGE,
+    ]
+
+
+def get_listing(name: str, scores: list, number_of_reviews: int, accommodates: int = 2) -> dict:
+    keys = ["accuracy", "cleanliness", "checkin", "communication", "location", "value"]
+    return {
+        "_id": name,
+        "name": name,
+        "accommodates": accommodates,
+        "address": {"country": "United States"},
+        "number_of_reviews": number_of_reviews,
+        "review_scores": {f"review_scores_{key}": score for key, score in zip(keys, scores)},
+        "text_embeddings": [0.1, 0.2, 0.3],
+    }
+
+
+def test_merges_adjacent_add_fields():
+    stages = optimize_stages(get_boosting_stages())
+
+    add_fields = [stage for stage in stages if "$addFields" in stage]
+    assert len(add_fields) == 1
+    # averageReviewScore is inlined into combinedScore
+    assert "$averageReviewScore" not in str(add_fields[0])
+
+
+def test_prunes_unread_fields_and_noop_stages():
+    stages = [{"$match": {}}] + get_boosting_stages() + [{"$skip": 0}]
+
+    stages = optimize_stages(stages)
+
+    assert {"$match": {}} not in stages
+    assert {"$skip": 0} not in stages
+    (add_fields,) = [stage["$addFields"] for stage in stages if "$addFields" in stage]
+    assert list(add_fields) == ["combinedScore"]
+
+
+def test_inserts_early_project_after_leading_match():
+    stages = optimize_stages(get_boosting_stages())
+
+    assert list(stages[0]) == ["$match"]
+    early_projection = stages[1]["$project"]
+    assert early_projection["_id"] == 0
+    assert "name" in early_projection and "number_of_reviews" in early_projection
+    assert "text_embeddings" not in early_projection
+    assert stages[-1] == RESULT_PROJECTION_STAGE
+
+
+def test_keeps_whole_documents_for_unknown_stages():
+    lookup_stage = {"$lookup": {"from": "reviews", "localField": "_id", "foreignField": "listing_id", "as": "r"}}
+    stages = get_boosting_stages()[:-1] + [lookup_stage]
+
+    stages = optimize_stages(stages)
+
+    assert not any("$project" in stage for stage in stages)
+
+
+def test_optimized_stages_return_the_same_results():
+    listings = [
+        get_listing("a", [5, 5, 5, 5, 5, 5], 10),
+        get_listing("b", [4, 4, 4, 4, 4, 4], 90),
+        get_listing("c", [3, 3, 3, 3, 3, 3], 1000, accommodates=8),
+    ]
+    rows = [(listing, 1.0) for listing in listings]
+
+    assert run_pipeline(rows, optimize_stages(get_boosting_stages())) == run_pipeline(rows, get_boosting_stages())
+
+
+@pytest.mark.skipif(not MONGO_URI, reason="MONGO_URI is not set, no cluster to explain against")
+def test_server_accepts_optimized_stages():
+    db_name, collection_name = get_db_and_collection_for_sample_data()
+    db = MongoConnection.initialise_client().get_database(db_name)
+    stages = optimize_stages(get_boosting_stages())
+
+    explain = db.command("explain", {"aggregate": collection_name, "pipeline": stages, "cursor": {}},
+                         verbosity="queryPlanner")
+
+    assert explain["ok"] == 1
+    collection = db.get_collection(collection_name)
+    expected = [doc["combinedScore"] for doc in collection.aggregate(get_boosting_stages())]
+    assert [doc["combinedScore"] for doc in collection.aggregate(stages)] == expected
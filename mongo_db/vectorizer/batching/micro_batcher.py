@@ -0,0 +1,66 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Coalesces single item requests arriving from concurrent threads into one batched call.
+
+    Callers block on submit(); a background thread collects whatever arrives within max_wait_ms (or until
+    max_batch_size items are queued), calls batch_fn once with the whole list and hands every caller its own result.
+    batch_fn must return one result per input, in input order.
+
+    With num_workers > 1 several batches are processed at once. max_queue_size bounds the number of waiting items
+    (0 is unbounded); when the queue is full, submitting blocks for at most put_timeout and then raises queue.Full.
+    """
+
+    def __init__(self, batch_fn, max_batch_size: int = 256, max_wait_ms: float = 5, name: str = "micro-batcher",
+                 num_workers: int = 1, max_queue_size: int = 0):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._workers = [threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+                         for i in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def submit_future(self, item, put_timeout: float = None) -> Future:
+        future = Future()
+        self._queue.put((item, future), timeout=put_timeout)
+        return future
+
+    def submit(self, item, timeout: float = None, put_timeout: float = None):
+        return self.submit_future(item, put_timeout=put_timeout).result(timeout=timeout)
+
+    def _collect_batch(self) -> list:
+        batch = [self._queue.get()]
+        # the first item opens the window; wait at most max_wait for companions
+        deadline = time.monotonic() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            items = [item for item, _ in batch]
+            try:
+                results = self.batch_fn(items)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
@@ -0,0 +1,82 @@
+import hashlib
+import threading
+import time
+import unicodedata
+from array import array
+
+from common_utils import get_env_key
+from vectorizer.cache.two_tier_cache import TwoTierCache
+
+EMBEDDING_CACHE_ENABLED = get_env_key('EMBEDDING_CACHE_ENABLED', 'true').lower() == 'true'
+# in-process LRU tier
+EMBEDDING_CACHE_MAX_ITEMS = int(get_env_key('EMBEDDING_CACHE_MAX_ITEMS', '10000'))
+# persistent SQLite tier
+EMBEDDING_CACHE_DB_PATH = get_env_key('EMBEDDING_CACHE_DB_PATH', 'embedding_cache.sqlite3')
+EMBEDDING_CACHE_MAX_DB_ITEMS = int(get_env_key('EMBEDDING_CACHE_MAX_DB_ITEMS', '200000'))
+# entries older than this are treated as missing in both tiers
+EMBEDDING_CACHE_TTL_SECONDS = int(get_env_key('EMBEDDING_CACHE_TTL_SECONDS', str(30 * 24 * 60 * 60)))
+
+# run the size based eviction of the persistent tier once every N writes instead of on every write
+_DB_EVICTION_INTERVAL = 500
+
+
+def normalise_text(text: str) -> str:
+    """Normalises unicode form and collapses whitespace so trivially different queries share a cache entry."""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def get_embedding_cache_key(text: str, model: str, dimensions: int) -> str:
+    raw_key = f"{model}\x1f{dimensions}\x1f{normalise_text(text)}"
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache(TwoTierCache):
+    """
+    Two tier cache of embeddings keyed by (normalised text, model, dimensions), see TwoTierCache. Vectors are stored
+    as packed float32 blobs in the persistent tier.
+    """
+
+    table = "embeddings"
+    value_columns = ("embedding BLOB NOT NULL",)
+    description = "embedding cache"
+
+    def __init__(self, db_path: str = EMBEDDING_CACHE_DB_PATH,
+                 max_items: int = EMBEDDING_CACHE_MAX_ITEMS,
+                 max_db_items: int = EMBEDDING_CACHE_MAX_DB_ITEMS,
+                 ttl_seconds: int = EMBEDDING_CACHE_TTL_SECONDS):
+        super().__init__(db_path=db_path, max_items=max_items, max_db_items=max_db_items, ttl_seconds=ttl_seconds,
+                         eviction_interval=_DB_EVICTION_INTERVAL)
+
+    def _encode(self, entry: tuple) -> tuple:
+        return (array('f', entry[1]).tobytes(),)
+
+    def _decode(self, row: tuple, created_at: float) -> tuple:
+        return created_at, array('f', row[0]).tolist()
+
+    def get(self, text: str, model: str, dimensions: int):
+        entry = self.get_entry(get_embedding_cache_key(text=text, model=model, dimensions=dimensions))
+        return entry[1] if entry is not None else None
+
+    def set(self, text: str, model: str, dimensions: int, embedding: list):
+        self.put_entry(get_embedding_cache_key(text=text, model=model, dimensions=dimensions), (time.time(), embedding))
+
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """Returns the process wide embedding cache, or None when caching is disabled."""
+    global _embedding_cache
+    if not EMBEDDING_CACHE_ENABLED:
+        return None
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                _embedding_cache = EmbeddingCache()
+    return _embedding_cache
+
+
+def get_embedding_cache_stats() -> dict:
+    cache = get_embedding_cache()
+    return cache.stats() if cache is not None else {}
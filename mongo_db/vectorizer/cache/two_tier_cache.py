@@ -0,0 +1,207 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from common_utils import get_env_key
+
+# hits only update last_access (and hit counts) of the persistent tier in batches, at most this many seconds apart
+CACHE_HIT_FLUSH_SECONDS = float(get_env_key('CACHE_HIT_FLUSH_SECONDS', '30'))
+
+# flush the pending hits earlier once this many keys were hit
+_MAX_PENDING_HITS = 1000
+
+
+class TwoTierCache:
+    """
+    Two tier cache base: tier 1 is a bounded in-process LRU, tier 2 a SQLite file shared across processes and
+    restarts. Both tiers evict by size and by TTL; the persistent one by last access, in a pass every
+    eviction_interval writes.
+
+    Entries are tuples starting with their created_at. Subclasses name the table and its value columns and convert
+    entries to and from rows (_encode / _decode). Hits are counted in memory and written in one batch every
+    CACHE_HIT_FLUSH_SECONDS, so a lookup served from memory does not write to SQLite.
+    """
+
+    table = None
+    # SQL definitions of the value columns, in row order
+    value_columns = ()
+    # the table has a hits column counting the hits of each entry
+    counts_hits = False
+    description = "cache"
+
+    def __init__(self, db_path: str, max_items: int, max_db_items: int, ttl_seconds: int,
+                 eviction_interval: int, hit_flush_seconds: float = CACHE_HIT_FLUSH_SECONDS):
+        self.max_items = max_items
+        self.max_db_items = max_db_items
+        self.ttl_seconds = ttl_seconds
+        self.eviction_interval = eviction_interval
+        self.hit_flush_seconds = hit_flush_seconds
+
+        self._lru = OrderedDict()  # key -> entry
+        self._lock = threading.Lock()
+        self._writes_since_eviction = 0
+        self._pending_hits = {}  # key -> (hits, last_access)
+        self._hits_flushed_at = time.monotonic()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # value column names, without the ones filled by their default (hits)
+        self._columns = [column.split()[0] for column in self.value_columns if "DEFAULT" not in column]
+        self._conn = None
+        if db_path:
+            try:
+                self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                    f"key TEXT PRIMARY KEY, {', '.join(self.value_columns)}, created_at REAL NOT NULL, "
+                    f"last_access REAL NOT NULL)"
+                )
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_access "
+                                   f"ON {self.table} (last_access)")
+            except sqlite3.Error as e:
+                print(f"Error opening {self.description} at {db_path}, using in-process cache only: {e}")
+                self._conn = None
+
+    def _encode(self, entry: tuple) -> tuple:
+        """Values of the value columns for an entry."""
+        raise NotImplementedError
+
+    def _decode(self, row: tuple, created_at: float) -> tuple:
+        """Entry of the values of the value columns."""
+        raise NotImplementedError
+
+    def _on_hit(self, entry: tuple):
+        pass
+
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - created_at > self.ttl_seconds
+
+    def _put_in_memory(self, key: str, entry: tuple):
+        self._lru[key] = entry
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_items:
+            self._lru.popitem(last=False)
+            self.evictions += 1
+
+    def _record_hit(self, key: str, now: float, entry: tuple):
+        self._on_hit(entry)
+        if self._conn is None:
+            return
+        hits, _ = self._pending_hits.get(key, (0, now))
+        self._pending_hits[key] = (hits + 1, now)
+        if len(self._pending_hits) >= _MAX_PENDING_HITS or \
+                time.monotonic() - self._hits_flushed_at >= self.hit_flush_seconds:
+            self._flush_hits()
+
+    def _flush_hits(self):
+        self._hits_flushed_at = time.monotonic()
+        if not self._pending_hits or self._conn is None:
+            return
+        pending, self._pending_hits = self._pending_hits, {}
+        if self.counts_hits:
+            self._conn.executemany(f"UPDATE {self.table} SET hits = hits + ?, last_access = MAX(last_access, ?) "
+                                   f"WHERE key = ?", [(hits, at, key) for key, (hits, at) in pending.items()])
+        else:
+            self._conn.executemany(f"UPDATE {self.table} SET last_access = MAX(last_access, ?) WHERE key = ?",
+                                   [(at, key) for key, (_, at) in pending.items()])
+
+    def get_entry(self, key: str):
+        now = time.time()
+        with self._lock:
+            try:
+                entry = self._lru.get(key)
+                if entry is not None:
+                    if not self._is_expired(entry[0], now):
+                        self._lru.move_to_end(key)
+                        self.memory_hits += 1
+                        self._record_hit(key, now, entry)
+                        return entry
+                    del self._lru[key]
+                    self.evictions += 1
+
+                if self._conn is not None:
+                    row = self._conn.execute(f"SELECT {', '.join(self._columns)}, created_at FROM {self.table} "
+                                             f"WHERE key = ?", (key,)).fetchone()
+                    if row is not None:
+                        created_at = row[-1]
+                        if not self._is_expired(created_at, now):
+                            entry = self._decode(row[:-1], created_at)
+                            self._put_in_memory(key, entry)
+                            self.disk_hits += 1
+                            self._record_hit(key, now, entry)
+                            return entry
+                        self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                        self.evictions += 1
+            except sqlite3.Error as e:
+                print(f"Error reading {self.description}: {e}")
+
+            self.misses += 1
+            return None
+
+    def put_entry(self, key: str, entry: tuple):
+        with self._lock:
+            self._put_in_memory(key, entry)
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute(f"INSERT OR REPLACE INTO {self.table} "
+                                   f"(key, {', '.join(self._columns)}, created_at, last_access) "
+                                   f"VALUES ({', '.join('?' * (len(self._columns) + 3))})",
+                                   (key, *self._encode(entry), entry[0], entry[0]))
+                self._pending_hits.pop(key, None)
+                self._writes_since_eviction += 1
+                if self._writes_since_eviction >= self.eviction_interval:
+                    self._evict_from_db(entry[0])
+                    self._writes_since_eviction = 0
+            except sqlite3.Error as e:
+                print(f"Error writing {self.description}: {e}")
+
+    def _evict_from_db(self, now: float):
+        # the least recently used rows are only known once the pending hits are written
+        self._flush_hits()
+        if self.ttl_seconds > 0:
+            deleted = self._conn.execute(f"DELETE FROM {self.table} WHERE created_at < ?",
+                                         (now - self.ttl_seconds,)).rowcount
+            self.evictions += max(deleted, 0)
+        (count,) = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        overflow = count - self.max_db_items
+        if overflow > 0:
+            # drop the least recently used rows
+            deleted = self._conn.execute(f"DELETE FROM {self.table} WHERE key IN "
+                                         f"(SELECT key FROM {self.table} ORDER BY last_access ASC LIMIT ?)",
+                                         (overflow,)).rowcount
+            self.evictions += max(deleted, 0)
+
+    def flush(self):
+        """Writes the pending hits to the persistent tier."""
+        with self._lock:
+            try:
+                self._flush_hits()
+            except sqlite3.Error as e:
+                print(f"Error writing {self.description}: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self._pending_hits = {}
+            if self._conn is not None:
+                self._conn.execute(f"DELETE FROM {self.table}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "memory_items": len(self._lru),
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
@@ -1,9 +1,151 @@
+import threading
+from functools import partial
+
 import openai
 from common_utils import get_env_key
+from vectorizer.batching.micro_batcher import MicroBatcher
+from vectorizer.cache.embedding_cache import get_embedding_cache
+
+try:
+    import tiktoken
+except ImportError:  # token counts fall back to a character based estimate
+    tiktoken = None
 
 OPENAI_API_KEY = get_env_key('OPENAI_API_KEY')
 openai.api_key = OPENAI_API_KEY
 
+# created on first use so processes that never run async code do not open an extra HTTP connection pool
+_async_openai_client = None
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 1536
+
+# OpenAI embeddings endpoint limits: inputs per request, tokens per input and tokens per request
+EMBEDDING_MAX_BATCH_ITEMS = 2048
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+EMBEDDING_MAX_BATCH_TOKENS = 300000
+
+# Coalesce get_embedding calls from concurrent requests into one provider call
+EMBEDDING_MICRO_BATCHING_ENABLED = get_env_key('EMBEDDING_MICRO_BATCHING_ENABLED', 'false').lower() == 'true'
+EMBEDDING_MICRO_BATCH_MAX_WAIT_MS = float(get_env_key('EMBEDDING_MICRO_BATCH_MAX_WAIT_MS', '5'))
+EMBEDDING_MICRO_BATCH_MAX_SIZE = int(get_env_key('EMBEDDING_MICRO_BATCH_MAX_SIZE', '256'))
+
+_tokenizer = None
+_micro_batcher = None
+_micro_batcher_lock = threading.Lock()
+
+
+def _get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+    return _tokenizer
+
+
+def count_embedding_tokens(text: str) -> int:
+    if tiktoken is None:
+        return len(text) // 4 + 1
+    return len(_get_tokenizer().encode(text, disallowed_special=()))
+
+
+def truncate_for_embedding(text: str, max_tokens: int = EMBEDDING_MAX_INPUT_TOKENS) -> str:
+    """The first max_tokens tokens of the text, the endpoint rejects longer inputs."""
+    if tiktoken is None:
+        # the character based estimate of count_embedding_tokens
+        return text[:max_tokens * 4]
+    tokens = _get_tokenizer().encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else _get_tokenizer().decode(tokens[:max_tokens])
+
+
+def batch_texts_for_embedding(texts: list,
+                              max_items: int = EMBEDDING_MAX_BATCH_ITEMS,
+                              max_tokens: int = EMBEDDING_MAX_BATCH_TOKENS) -> list:
+    """
+    Packs texts into batches that respect the provider's item and token limits.
+    Returns a list of batches, each a list of positions into `texts`.
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for position, text in enumerate(texts):
+        tokens = min(count_embedding_tokens(text), EMBEDDING_MAX_INPUT_TOKENS)
+        if tiktoken is None and tokens >= EMBEDDING_MAX_INPUT_TOKENS:
+            # the estimate may be short of the real count, if the input is still too long it fails on its own
+            batches.append([position])
+            continue
+        if current and (len(current) >= max_items or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(position)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _create_embeddings(texts: list) -> list:
+    response = openai.embeddings.create(input=texts, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+    # the API does not promise to keep input order, each item carries its index
+    embeddings = [None] * len(texts)
+    for item in response.data:
+        embeddings[item.index] = item.embedding
+    return embeddings
+
+
+def get_embeddings(texts: list, lookup_cache: bool = True) -> list:
+    """
+    Generate embeddings for many texts with as few OpenAI calls as possible. Texts longer than
+    EMBEDDING_MAX_INPUT_TOKENS are embedded from their first EMBEDDING_MAX_INPUT_TOKENS tokens.
+    Returns the vectors in input order; invalid inputs or failed batches yield None in their position.
+    lookup_cache=False skips the cache lookup for texts the caller already missed, new embeddings are still cached.
+    """
+    embeddings = [None] * len(texts)
+    cache = get_embedding_cache()
+
+    # resolve cache hits and de-duplicate, so every distinct text is sent at most once
+    pending = {}
+    for position, text in enumerate(texts):
+        if not text or not isinstance(text, str):
+            continue
+        if cache is not None and lookup_cache:
+            embedding = cache.get(text, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+            if embedding is not None:
+                embeddings[position] = embedding
+                continue
+        pending.setdefault(text, []).append(position)
+
+    unique_texts = list(pending.keys())
+    # the cache stays keyed by the full text
+    inputs = [truncate_for_embedding(text) for text in unique_texts]
+    for batch in batch_texts_for_embedding(inputs):
+        batch_texts = [unique_texts[i] for i in batch]
+        try:
+            batch_embeddings = _create_embeddings([inputs[i] for i in batch])
+        except Exception as e:
+            print(f"Error in get_embeddings: {e}")
+            continue
+        for text, embedding in zip(batch_texts, batch_embeddings):
+            if embedding is None:
+                continue
+            if cache is not None:
+                cache.set(text, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS, embedding=embedding)
+            for position in pending[text]:
+                embeddings[position] = embedding
+
+    return embeddings
+
+
+def get_embedding_micro_batcher():
+    global _micro_batcher
+    if _micro_batcher is None:
+        with _micro_batcher_lock:
+            if _micro_batcher is None:
+                # get_embedding looked every text up in the cache before submitting it
+                _micro_batcher = MicroBatcher(batch_fn=partial(get_embeddings, lookup_cache=False),
+                                              max_batch_size=EMBEDDING_MICRO_BATCH_MAX_SIZE,
+                                              max_wait_ms=EMBEDDING_MICRO_BATCH_MAX_WAIT_MS,
+                                              name="openai-embedding-batcher")
+    return _micro_batcher
+
 
 def get_embedding(text):
     """Generate an embedding for the given text using OpenAI's API."""
@@ -12,12 +154,63 @@ def get_embedding(text):
     if not text or not isinstance(text, str):
         return None
 
+    # Repeated queries are served from the embedding cache instead of a round trip to OpenAI
+    cache = get_embedding_cache()
+    if cache is not None:
+        embedding = cache.get(text, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+        if embedding is not None:
+            return embedding
+
+    if EMBEDDING_MICRO_BATCHING_ENABLED:
+        try:
+            return get_embedding_micro_batcher().submit(text)
+        except Exception as e:
+            print(f"Error in get_embedding: {e}")
+            return None
+
     try:
         # Call OpenAI API to get the embedding
         embedding = openai.embeddings.create(
-            input=text,
-            model="text-embedding-3-small", dimensions=1536).data[0].embedding
-        return embedding
+            input=truncate_for_embedding(text),
+            model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS).data[0].embedding
     except Exception as e:
         print(f"Error in get_embedding: {e}")
         return None
+
+    if cache is not None:
+        cache.set(text, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS, embedding=embedding)
+    return embedding
+
+
+def get_async_openai_client():
+    global _async_openai_client
+    if _async_openai_client is None:
+        _async_openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY)
+    return _async_openai_client
+
+
+async def get_embedding_async(text):
+    """Coroutine version of get_embedding built on the async OpenAI client."""
+
+    # Check for valid input
+    if not text or not isinstance(text, str):
+        return None
+
+    cache = get_embedding_cache()
+    if cache is not None:
+        embedding = cache.get(text, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+        if embedding is not None:
+            return embedding
+
+    try:
+        response = await get_async_openai_client().embeddings.create(
+            input=truncate_for_embedding(text),
+            model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+        embedding = response.data[0].embedding
+    except Exception as e:
+        print(f"Error in get_embedding_async: {e}")
+        return None
+
+    if cache is not None:
+        cache.set(text, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS, embedding=embedding)
+    return embedding
@@ -16,7 +16,11 @@ JINA_EMBEDDINGS_BEARER_TOKEN = get_env_key('JINA_EMBEDDINGS_BEARER_TOKEN')
 #             "新しいメイクのトレンドは鮮やかな色と革新的な技術に焦点を当てています: 今シーズンのメイクアップトレンドは、大胆な色彩と革新的な技術に注目しています。ネオンアイライナーからホログラフィックハイライターまで、クリエイティビティを解き放ち、毎回ユニークなルックを演出しましょう。" # noqa : E501
 #         ]
 
-def jina_text_to_vector(text_list):
+# Jina embeddings API accepts at most this many inputs per request
+JINA_MAX_BATCH_ITEMS = int(get_env_key('JINA_MAX_BATCH_ITEMS', '512'))
+
+
+def _jina_embeddings_request(text_list):
     url = JINA_EMBEDDINGS_URL
 
     headers = {
@@ -36,3 +40,28 @@ def jina_text_to_vector(text_list):
     response = requests.post(url, headers=headers, json=data)
     # print(response.json())
     return response.json()
+
+
+def jina_text_to_vector(text_list, batch_size=JINA_MAX_BATCH_ITEMS):
+    """
+    Embeds text_list in chunks of batch_size and merges the chunk responses into one response, with every item's
+    `index` pointing back into text_list so the vectors keep input order.
+    """
+    if len(text_list) <= batch_size:
+        return _jina_embeddings_request(text_list)
+
+    merged = None
+    for offset in range(0, len(text_list), batch_size):
+        response = _jina_embeddings_request(text_list[offset:offset + batch_size])
+        if "data" not in response:
+            # surface the provider error as is
+            return response
+        for item in response["data"]:
+            item["index"] += offset
+        if merged is None:
+            merged = response
+            continue
+        merged["data"].extend(response["data"])
+        for key, value in response.get("usage", {}).items():
+            merged.setdefault("usage", {})[key] = merged["usage"].get(key, 0) + value
+    return merged